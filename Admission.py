@@ -0,0 +1,288 @@
+import Bank
+import Metrics
+import MySQLConnector
+import concurrent.futures
+import collections
+import contextlib
+import threading
+import argparse
+import logging
+import random
+import time
+
+# Defaults (0 - no limit)
+MAX_IN_FLIGHT     = 0       # operations running at once
+ACCOUNT_IN_FLIGHT = 0       # deposits, withdrawals and transfers running at once on one account
+QUEUE_SIZE        = 64      # callers waiting for a slot before new ones are shed
+QUEUE_TIMEOUT     = 0.1     # seconds a caller waits for a slot before it is shed (0 - shed at once)
+CLIENT_RATE       = 0       # operations per second per client
+CLIENT_BURST      = 0       # token bucket size per client (0 - one second of CLIENT_RATE)
+CLIENTS_KEPT      = 10000   # token buckets kept, least recently used dropped first
+
+# Shed reasons
+SHED_RATE_LIMITED = "rate_limited"     # the client's token bucket is empty
+SHED_QUEUE_FULL   = "queue_full"       # QUEUE_SIZE callers are already waiting
+SHED_TIMEOUT      = "queue_timeout"    # no slot freed up within QUEUE_TIMEOUT
+
+# Benchmark
+BENCH_CLIENTS  = 64
+BENCH_ACCOUNTS = 1000
+BENCH_HOT      = 0.5     # share of the operations that are transfers into the hot account 1
+BENCH_SECONDS  = 3.0
+
+
+# Rejected - class
+### Raised instead of running an operation that admission control shed
+### reason is one of the SHED_* reasons, retryAfter the seconds after which a retry may be admitted
+class Rejected(Exception):
+
+    def __init__(self, reason, retryAfter):
+        super().__init__(f"Operation shed: {reason}")
+        self.reason = reason
+        self.retryAfter = retryAfter
+
+
+# AdmissionControl - class
+### Admission control in front of a Bank (or ShardedBank), with the same operations plus a client argument
+### Every operation needs a slot: one of maxInFlight globally and, for deposits, withdrawals and transfers,
+### one of accountInFlight on every account it changes - so a hot account queues in memory instead of on
+### its row lock, holding a database connection. Slots are taken all at once under one lock, so two callers
+### never hold part of what the other needs. A caller waits up to queueTimeout for its slots; callers beyond
+### queueSize waiting, or still waiting at the timeout, are shed with Rejected so overload fails fast.
+### Each client also has a token bucket of rate operations per second (burst tokens); an empty bucket sheds
+### the operation at once. Unset limits (0) are skipped, so with none set operations go straight through.
+### Other attributes (takeSnapshot, history, dbObj, ...) are those of the Bank behind it.
+##    __init__
+##    admit          ## Context manager holding the slots of one operation, or raising Rejected
+##    takeToken      ## Take one token from the client's bucket
+##    createAccount, checkBalance, getAccount, deposit, withdraw, transfer, applyBatch, balanceAsOf, statement
+##    getStats       ## Bank stats with the admission counters
+##    exportMetrics  ## Bank metrics with in-flight and queued operations as gauges
+class AdmissionControl():
+
+    def __init__(self, bank, maxInFlight=MAX_IN_FLIGHT, accountInFlight=ACCOUNT_IN_FLIGHT, queueSize=QUEUE_SIZE,
+                 queueTimeout=QUEUE_TIMEOUT, rate=CLIENT_RATE, burst=CLIENT_BURST, clients=CLIENTS_KEPT):
+        self.bank = bank
+        self.maxInFlight = maxInFlight
+        self.accountInFlight = accountInFlight
+        self.queueSize = queueSize
+        self.queueTimeout = queueTimeout
+        self.rate = rate
+        self.burst = burst or rate
+        self.clients = clients
+
+        self.lock = threading.Condition()
+        self.inFlight = 0
+        self.accounts = collections.Counter()       # acc_no -> operations running on it
+        self.queued = 0                             # callers waiting for slots
+        self.buckets = collections.OrderedDict()    # client -> (tokens, last refill), most recently used last
+        self.stats = {"admitted": 0, "waited": 0, "max_queued": 0,
+                      f"shed_{SHED_RATE_LIMITED}": 0, f"shed_{SHED_QUEUE_FULL}": 0, f"shed_{SHED_TIMEOUT}": 0}
+
+    def __getattr__(self, name):
+        return getattr(self.bank, name)
+
+    def available(self, accounts):
+        # Caller must hold the lock
+        if self.maxInFlight > 0 and self.inFlight >= self.maxInFlight: return False
+        return all(self.accounts[acc_no] < self.accountInFlight for acc_no in accounts)
+
+    def shed(self, reason, retryAfter):
+        # Caller must hold the lock
+        self.stats[f"shed_{reason}"] += 1
+        Metrics.METRICS.inc("bank_admission_shed_total", (("reason", reason),))
+        raise Rejected(reason, retryAfter)
+
+    @contextlib.contextmanager
+    def admit(self, client=None, accounts=()):
+        # admit
+        ## Take a token from the client's bucket (rate_limited if it is empty)
+        ## Take a global slot and a slot on every account at once, waiting up to queueTimeout if they are taken
+        ## (queue_full if queueSize callers are waiting already, queue_timeout if none frees up in time)
+        ## Release the slots and wake the waiting callers when the operation is done
+        if self.rate > 0: self.takeToken(client)
+        accounts = set(accounts) if self.accountInFlight > 0 else ()
+        if self.maxInFlight <= 0 and not accounts:
+            yield
+            return
+
+        with self.lock:
+            if not self.available(accounts):
+                if self.queued >= self.queueSize: self.shed(SHED_QUEUE_FULL, self.queueTimeout)
+                self.queued += 1
+                self.stats["waited"] += 1
+                Metrics.METRICS.inc("bank_admission_waited_total")
+                self.stats["max_queued"] = max(self.stats["max_queued"], self.queued)
+                try:
+                    admitted = self.lock.wait_for(lambda: self.available(accounts), self.queueTimeout)
+                finally:
+                    self.queued -= 1
+                if not admitted: self.shed(SHED_TIMEOUT, self.queueTimeout)
+            self.inFlight += 1
+            for acc_no in accounts: self.accounts[acc_no] += 1
+            self.stats["admitted"] += 1
+            Metrics.METRICS.inc("bank_admission_admitted_total")
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.inFlight -= 1
+                for acc_no in accounts:
+                    self.accounts[acc_no] -= 1
+                    if not self.accounts[acc_no]: del self.accounts[acc_no]
+                # Only a global slot freed up: one waiter can use it. An account slot may be wanted by any of them
+                if self.accountInFlight > 0: self.lock.notify_all()
+                else: self.lock.notify()
+
+    def takeToken(self, client):
+        # Refill the bucket for the time since its last use, then take one token or shed
+        now = time.monotonic()
+        with self.lock:
+            tokens, last = self.buckets.pop(client, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            self.buckets[client] = (tokens - 1 if tokens >= 1 else tokens, now)
+            while len(self.buckets) > self.clients: self.buckets.popitem(last=False)
+            if tokens < 1: self.shed(SHED_RATE_LIMITED, (1 - tokens) / self.rate)
+
+    def createAccount(self, name=Bank.DEFAULT_ACCOUNT_NAME, balance=Bank.DEFAULT_BALANCE, v=Bank.VERBOSE_MAIN_FUNCTIONS, key=None,
+                      currency=Bank.DEFAULT_CURRENCY, client=None):
+        with self.admit(client): return self.bank.createAccount(name, balance, v, key=key, currency=currency)
+
+    def checkBalance(self, acc_no, v=Bank.VERBOSE_MAIN_FUNCTIONS, client=None):
+        with self.admit(client): return self.bank.checkBalance(acc_no, v)
+
+    def getAccount(self, acc_no, client=None):
+        with self.admit(client): return self.bank.getAccount(acc_no)
+
+    def deposit(self, acc_no, deposit_amount, v=Bank.VERBOSE_MAIN_FUNCTIONS, key=None, client=None):
+        with self.admit(client, (acc_no,)): return self.bank.deposit(acc_no, deposit_amount, v, key=key)
+
+    def withdraw(self, acc_no, withdraw_amount, v=Bank.VERBOSE_MAIN_FUNCTIONS, key=None, client=None):
+        with self.admit(client, (acc_no,)): return self.bank.withdraw(acc_no, withdraw_amount, v, key=key)
+
+    def transfer(self, src_acc_no, trgt_acc_no, transfer_amount, v=Bank.VERBOSE_MAIN_FUNCTIONS, mode=None, key=None, client=None):
+        with self.admit(client, (src_acc_no, trgt_acc_no)):
+            return self.bank.transfer(src_acc_no, trgt_acc_no, transfer_amount, v, mode=mode, key=key)
+
+    def applyBatch(self, ops, chunkSize=Bank.BATCH_CHUNK_SIZE, v=Bank.VERBOSE_MAIN_FUNCTIONS, key=None, client=None):
+        # A batch may touch thousands of accounts - it takes a global slot only
+        with self.admit(client): return self.bank.applyBatch(ops, chunkSize, v, key=key)
+
+    def balanceAsOf(self, acc_no, ts, client=None):
+        with self.admit(client): return self.bank.balanceAsOf(acc_no, ts)
+
+    def statement(self, acc_no, start, end, client=None):
+        with self.admit(client): return self.bank.statement(acc_no, start, end)
+
+    def getStats(self):
+        # getStats
+        ## Stats of the Bank behind, with "admission": limits, current in-flight/queued and shed counters
+        with self.lock:
+            admission = dict(self.stats, in_flight=self.inFlight, queued=self.queued, busy_accounts=len(self.accounts),
+                             clients=len(self.buckets), max_in_flight=self.maxInFlight, account_in_flight=self.accountInFlight,
+                             queue_size=self.queueSize, queue_timeout=self.queueTimeout, rate=self.rate, burst=self.burst)
+        return dict(self.bank.getStats(), admission=admission)
+
+    def exportMetrics(self):
+        # Admitted, waited and shed operations are counters of Metrics.METRICS (bank_admission_*_total, shed by
+        # reason); only what is running and queued right now is a gauge
+        with self.lock:
+            admission = {"in_flight": self.inFlight, "queued": self.queued}
+        return self.bank.exportMetrics() + Metrics.formatGauges(Metrics.gauges(admission=admission))
+
+
+# settings
+## AdmissionControl keyword arguments from the [ADMISSION] section of config.ini
+def settings():
+    return {"maxInFlight": Bank.ADMISSION_MAX_IN_FLIGHT, "accountInFlight": Bank.ADMISSION_ACCOUNT_IN_FLIGHT,
+            "queueSize": Bank.ADMISSION_QUEUE_SIZE, "queueTimeout": Bank.ADMISSION_QUEUE_TIMEOUT,
+            "rate": Bank.ADMISSION_RATE, "burst": Bank.ADMISSION_BURST}
+
+
+########## Benchmark ##########
+
+# runSpike
+## clients threads for seconds, each operation a transfer of 1 into the hot account 1 (share hot) or a deposit into a
+## random other account; a shed operation is counted and the client waits its retryAfter, like a client told to Retry-After
+## Return {"hot"/"cold": sorted latencies of completed operations, "shed": count, "seconds": elapsed}
+def runSpike(bank, accounts, clients, seconds, hot):
+    def client(seed):
+        rng = random.Random(seed)
+        latencies, shed = {"hot": [], "cold": []}, 0
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            kind = "hot" if rng.random() < hot else "cold"
+            start = time.perf_counter()
+            try:
+                if kind == "hot": bank.transfer(rng.randrange(2, accounts + 1), 1, 1)
+                else: bank.deposit(rng.randrange(2, accounts + 1), 1)
+            except Rejected as e:
+                shed += 1
+                time.sleep(e.retryAfter)
+                continue
+            latencies[kind].append(time.perf_counter() - start)
+        return latencies, shed
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=clients) as executor:
+        results = list(executor.map(client, range(clients)))
+    return {"hot": sorted(l for latencies, _ in results for l in latencies["hot"]),
+            "cold": sorted(l for latencies, _ in results for l in latencies["cold"]),
+            "shed": sum(shed for _, shed in results), "seconds": time.perf_counter() - start}
+
+# percentile
+## p-th percentile (0..1) of sorted samples, in milliseconds
+def percentile(samples, p):
+    return samples[min(len(samples) - 1, int(p * len(samples)))] * 1000 if samples else 0.0
+
+# benchmarkAdmission
+## The same spike against the bare Bank and behind AdmissionControl with each limits dict
+## Return a list of (label, completed ops/s, shed ops/s, hot p50/p99 ms, cold p50/p99 ms)
+def benchmarkAdmission(backend, path, limits, accounts=BENCH_ACCOUNTS, clients=BENCH_CLIENTS, seconds=BENCH_SECONDS, hot=BENCH_HOT):
+    storage = Bank.openStorage(backend, path)
+    bank = Bank.Bank(storage)
+    bank.createAccounts([(f"bench{i}", 10 ** 9) for i in range(accounts)])
+    results = []
+    try:
+        for label, limit in [("off", None)] + [(", ".join(f"{k}={v}" for k, v in l.items()), l) for l in limits]:
+            run = runSpike(bank if limit is None else AdmissionControl(bank, **limit), accounts, clients, seconds, hot)
+            completed = len(run["hot"]) + len(run["cold"])
+            results.append((label, completed / run["seconds"], run["shed"] / run["seconds"],
+                            percentile(run["hot"], 0.5), percentile(run["hot"], 0.99),
+                            percentile(run["cold"], 0.5), percentile(run["cold"], 0.99)))
+            logging.info(f"admission {label}: {completed / run['seconds']:.1f} ops/s, {run['shed']} shed")
+    finally:
+        storage.disconnectDB(MySQLConnector.SAVE_ON_DISCONNECT)
+    return results
+
+
+def main():
+    # main
+    ## Parse the benchmark options
+    ## Run the hot-account spike without admission control, then with a global limit and with per-account limits
+    ## Print completed and shed ops/s and the latency of hot and cold operations
+    parser = argparse.ArgumentParser(description="Measure a hot-account spike with and without admission control")
+    parser.add_argument("--max-in-flight", type=int, default=4)
+    parser.add_argument("--account-in-flight", type=int, default=1)
+    parser.add_argument("--queue-size", type=int, default=QUEUE_SIZE)
+    parser.add_argument("--queue-timeout", type=float, default=0.05)
+    parser.add_argument("--accounts", type=int, default=BENCH_ACCOUNTS)
+    parser.add_argument("--clients", type=int, default=BENCH_CLIENTS)
+    parser.add_argument("--seconds", type=float, default=BENCH_SECONDS)
+    parser.add_argument("--hot", type=float, default=BENCH_HOT, help="share of transfers into the hot account")
+    parser.add_argument("--backend", choices=("mysql", "sqlite", "memory"), default=Bank.STORAGE_BACKEND)
+    parser.add_argument("--path", default="bench.db", help="SQLite database file for --backend sqlite")
+    args = parser.parse_args()
+
+    queue = {"queueSize": args.queue_size, "queueTimeout": args.queue_timeout}
+    limits = [dict(maxInFlight=args.max_in_flight, **queue),
+              dict(accountInFlight=args.account_in_flight, **queue),
+              dict(maxInFlight=args.max_in_flight, accountInFlight=args.account_in_flight, **queue)]
+    results = benchmarkAdmission(args.backend, args.path, limits, args.accounts, args.clients, args.seconds, args.hot)
+    print(f"{'limits':<66} {'ops/s':>9} {'shed/s':>9} {'hot p50':>8} {'hot p99':>8} {'cold p50':>9} {'cold p99':>9}")
+    for label, rate, shedRate, hot50, hot99, cold50, cold99 in results:
+        print(f"{label:<66} {rate:>9.1f} {shedRate:>9.1f} {hot50:>8.2f} {hot99:>8.2f} {cold50:>9.2f} {cold99:>9.2f}")
+    return results
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+import Bank
+import MySQLConnector
+import concurrent.futures
+import functools
+import argparse
+import asyncio
+import logging
+import random
+import time
+
+# Benchmark defaults
+BENCH_CLIENTS  = (1, 16, 256)
+BENCH_REQUESTS = 2000
+BENCH_DEPOSIT_RATIO = 0.2   # share of benchmark requests that are deposits, the rest are balance checks
+
+
+########## AsyncBank Class ##########
+
+# AsyncBank - class
+### Asyncio front end for the Bank service layer
+### Bank operations run on a thread pool sized to the connection pool, so a single event loop can hold
+### thousands of waiting sessions while at most pool-size transactions are in flight at the database
+##    __init__
+##    run                ## Run a Bank method on the executor and await its result
+##    createAccount      ## Coroutine version of Bank.createAccount
+##    checkBalance       ## Coroutine version of Bank.checkBalance
+##    deposit            ## Coroutine version of Bank.deposit
+##    withdraw           ## Coroutine version of Bank.withdraw
+##    transfer           ## Coroutine version of Bank.transfer
+##    applyBatch         ## Coroutine version of Bank.applyBatch
+##    close              ## Wait for running operations and stop the executor
+class AsyncBank():
+
+    def __init__(self, bank, workers=None):
+        # __init__
+        ## bank is a Bank (or BankSession) instance
+        ## workers defaults to the size of the bank's connection pool - more threads would only queue on checkout
+        self.bank = bank
+        self.workers = workers or getattr(bank.dbObj, "size", 1)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="AsyncBank")
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    async def run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    async def createAccount(self, name=Bank.DEFAULT_ACCOUNT_NAME, balance=Bank.DEFAULT_BALANCE, key=None, currency=Bank.DEFAULT_CURRENCY):
+        return await self.run(self.bank.createAccount, name, balance, key=key, currency=currency)
+
+    async def checkBalance(self, acc_no):
+        return await self.run(self.bank.checkBalance, acc_no)
+
+    async def deposit(self, acc_no, deposit_amount, key=None):
+        return await self.run(self.bank.deposit, acc_no, deposit_amount, key=key)
+
+    async def withdraw(self, acc_no, withdraw_amount, key=None):
+        return await self.run(self.bank.withdraw, acc_no, withdraw_amount, key=key)
+
+    async def transfer(self, src_acc_no, trgt_acc_no, transfer_amount, mode=None, key=None):
+        return await self.run(self.bank.transfer, src_acc_no, trgt_acc_no, transfer_amount, mode=mode, key=key)
+
+    async def applyBatch(self, ops, chunkSize=Bank.BATCH_CHUNK_SIZE, key=None):
+        return await self.run(self.bank.applyBatch, list(ops), chunkSize, key=key)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+########## Benchmark: sync Bank vs AsyncBank ##########
+
+# benchmarkRequest
+## Pick the next benchmark request: a deposit of 1 or a balance check on a random account
+def benchmarkRequest(accounts, rng):
+    acc_no = rng.choice(accounts)
+    if rng.random() < BENCH_DEPOSIT_RATIO: return ("deposit", acc_no, 1)
+    return ("checkBalance", acc_no)
+
+# benchmarkSync
+## Drive the sync Bank with one thread per client, each sending requests back to back
+## Return requests/sec
+def benchmarkSync(bank, accounts, clients, requests):
+    per_client = max(1, requests // clients)
+
+    def client(seed):
+        rng = random.Random(seed)
+        for _ in range(per_client):
+            action, *args = benchmarkRequest(accounts, rng)
+            getattr(bank, action)(*args)
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=clients) as executor:
+        list(executor.map(client, range(clients)))
+    return per_client * clients / (time.perf_counter() - start)
+
+# benchmarkAsync
+## Drive AsyncBank with one task per client on a single event loop
+## Return requests/sec
+def benchmarkAsync(bank, accounts, clients, requests):
+    per_client = max(1, requests // clients)
+
+    async def client(asyncBank, seed):
+        rng = random.Random(seed)
+        for _ in range(per_client):
+            action, *args = benchmarkRequest(accounts, rng)
+            await getattr(asyncBank, action)(*args)
+
+    async def run():
+        async with AsyncBank(bank) as asyncBank:
+            start = time.perf_counter()
+            await asyncio.gather(*(client(asyncBank, seed) for seed in range(clients)))
+            return per_client * clients / (time.perf_counter() - start)
+
+    return asyncio.run(run())
+
+# benchmark
+## Compare requests/sec of the sync Bank and AsyncBank at each client count
+## Return a list of (clients, sync req/s, async req/s)
+def benchmark(bank, accounts, clients=BENCH_CLIENTS, requests=BENCH_REQUESTS):
+    results = []
+    for n in clients:
+        sync_rps = benchmarkSync(bank, accounts, n, requests)
+        async_rps = benchmarkAsync(bank, accounts, n, requests)
+        logging.info(f"benchmark clients={n} sync={sync_rps:.1f} req/s async={async_rps:.1f} req/s")
+        results.append((n, sync_rps, async_rps))
+    return results
+
+
+def main():
+    # main
+    ## Parse the benchmark options
+    ## Open the storage backend (MySQL from config.ini unless --backend says otherwise)
+    ## Create the benchmark accounts on local backends
+    ## Run the sync and async benchmark at every client count and print the table
+    parser = argparse.ArgumentParser(description="Compare requests/sec of Bank and AsyncBank")
+    parser.add_argument("--clients", type=int, nargs="+", default=list(BENCH_CLIENTS))
+    parser.add_argument("--requests", type=int, default=BENCH_REQUESTS, help="requests per client count")
+    parser.add_argument("--accounts", type=int, nargs=2, default=(1, 100), metavar=("FIRST", "LAST"),
+                        help="existing account numbers to use")
+    parser.add_argument("--backend", choices=("mysql", "sqlite", "memory"), default=Bank.STORAGE_BACKEND)
+    parser.add_argument("--path", default=Bank.SQLITE_PATH, help="SQLite database file for --backend sqlite")
+    args = parser.parse_args()
+
+    dbObject = Bank.openStorage(args.backend, args.path)
+    if not dbObject.isConnected():
+        Bank.printString("Connection to database was UNSUCCESSFUL", length=Bank.DEFAULT_PAGE_WIDTH)
+        return False
+
+    bank = Bank.Bank(dbObject)
+    accounts = list(range(args.accounts[0], args.accounts[1] + 1))
+    # Local backends start empty - create the accounts first
+    if args.backend != "mysql":
+        for _ in range(args.accounts[1]): bank.createAccount(balance=1000)
+
+    results = benchmark(bank, accounts, args.clients, args.requests)
+    dbObject.disconnectDB(MySQLConnector.SAVE_ON_DISCONNECT)
+
+    print(f"{'clients':>8} {'sync req/s':>12} {'async req/s':>12}")
+    for n, sync_rps, async_rps in results:
+        print(f"{n:>8} {sync_rps:>12.1f} {async_rps:>12.1f}")
+    return True
+
+if __name__ == "__main__":
+    main()
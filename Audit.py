@@ -0,0 +1,284 @@
+import Bank
+import BulkIO
+import MySQLConnector
+import multiprocessing
+import argparse
+import logging
+import random
+import json
+import time
+import os
+import sys
+
+# Defaults
+AUDIT_RANGE_SIZE = 10000    # account numbers checked per task; bounds the memory of one task
+AUDIT_PROCESSES  = multiprocessing.cpu_count()
+AUDIT_CHECKPOINT = "audit_checkpoint.json"
+AUDIT_REPORT     = "audit_report.jsonl"
+
+# Benchmark
+BENCH_ACCOUNTS  = 200000
+BENCH_PROCESSES = (1, 2, 4)
+BENCH_CORRUPT   = 10        # balances changed behind the ledger's back before the audit
+
+# Finding kinds
+FINDING_MISMATCH = "mismatch"   # balance (row plus stripes) differs from the sum of the account's ledger amounts
+FINDING_NEGATIVE = "negative"   # negative balance or stripe, or a negative balance_after in the account's history
+FINDING_ORPHAN   = "orphan"     # ledger entries or stripes of an account number that has no account row
+FINDINGS = (FINDING_MISMATCH, FINDING_NEGATIVE, FINDING_ORPHAN)
+
+
+########## Checking ##########
+
+# judge
+## Finding for one account number from its balance (None - no account row), ledger totals (entries, sum, lowest
+## balance_after) and stripe totals (stripes, sum, lowest), or None if the account is consistent
+## The ledger holds every balance change including the "open" entry, so its amounts add up to the balance
+def judge(acc_no, balance, ledger, stripes):
+    entries, total, lowest = (int(value) for value in ledger) if ledger else (0, 0, 0)
+    count, striped, lowestStripe = (int(value) for value in stripes) if stripes else (0, 0, 0)
+    if balance is None: kind = FINDING_ORPHAN
+    elif balance < 0 or lowestStripe < 0 or lowest < 0: kind = FINDING_NEGATIVE
+    elif balance + striped != total: kind = FINDING_MISMATCH
+    else: return None
+    return {"kind": kind, "account_no": acc_no, "balance": None if balance is None else int(balance),
+            "stripes": striped, "ledger": total, "entries": entries}
+
+# recheck
+## Judge one account again with its row and stripes locked, so no operation can be half way through it:
+## a finding of the unlocked pass caused by an operation committing between its reads goes away here
+def recheck(storage, acc_no):
+    with storage.borrow() as session:
+        try:
+            session.startTransaction()
+            row = session.selectRowByAccNbr(acc_no, lock=True)
+            stripes = [balance for stripe, balance in session.selectStripes(acc_no, lock=True)]
+            ledger = session.selectLedgerTotals(acc_no, acc_no + 1)
+            return judge(acc_no, None if row is None else row[2], ledger[0][1:] if ledger else None,
+                         (len(stripes), sum(stripes), min(stripes)) if stripes else None)
+        finally:
+            session.rollback()
+
+# checkRange
+## Check account numbers first <= account_no < last without locking anything:
+## one query each for the balances, ledger totals and stripe totals of the range, so memory is bounded by the range size
+## Accounts that look wrong are judged again under their locks (recheck)
+## Return (accounts checked, ledger entries checked, [findings])
+def checkRange(storage, first, last):
+    with storage.borrow() as session:
+        balances = dict(session.selectBalanceRange(first, last))
+        ledger = {acc_no: totals for acc_no, *totals in session.selectLedgerTotals(first, last)}
+        stripes = {acc_no: totals for acc_no, *totals in session.selectStripeTotals(first, last)}
+    suspects = [acc_no for acc_no in sorted(balances.keys() | ledger.keys() | stripes.keys())
+                if judge(acc_no, balances.get(acc_no), ledger.get(acc_no), stripes.get(acc_no)) is not None]
+    findings = [finding for finding in (recheck(storage, acc_no) for acc_no in suspects) if finding is not None]
+    return len(balances), sum(int(totals[0]) for totals in ledger.values()), findings
+
+
+########## Worker processes ##########
+
+WORKER_STORAGE = None   # storage of a pool worker process, opened by openWorker
+
+def openWorker(backend, path):
+    global WORKER_STORAGE
+    WORKER_STORAGE = Bank.openStorage(backend, path)
+
+def runRange(bounds):
+    return (bounds[0], *checkRange(WORKER_STORAGE, *bounds))
+
+
+########## Audit ##########
+
+# Audit - class
+### Consistency audit of every account: the balance (row plus stripes) must equal the sum of the account's ledger
+### amounts, no balance, stripe or balance_after may be negative, and no ledger entry or stripe may belong to a
+### missing account. The account numbers between the lowest and highest in use when the audit starts are cut into
+### ranges of rangeSize, checked in parallel by a pool of processes that each open their own storage.
+### Findings are appended to the report file (one JSON object per line) as ranges finish. After every range the
+### checkpoint file is replaced atomically: it holds the bounds, the ranges done (every range below "watermark" and
+### the starts in "done"), the totals and the size of the report at that point. A run that finds a checkpoint of
+### the same audit resumes from it, cutting the report back to that size; a finished audit removes its checkpoint.
+### Private backends (memory, in-memory SQLite) are checked in this process on the given storage.
+##    __init__
+##    run        ## Check every pending range, return the totals
+##    loadState  ## Checkpoint of this audit, or a new one
+##    saveState  ## Replace the checkpoint file
+##    pending    ## (first, last) bounds of the ranges still to check
+##    check      ## Check ranges in this process or on the worker pool
+##    finish     ## Record one checked range: report its findings, add up the totals, save the checkpoint
+##    close      ## Release the storage
+class Audit():
+
+    def __init__(self, backend=None, path=None, processes=AUDIT_PROCESSES, rangeSize=AUDIT_RANGE_SIZE,
+                 checkpoint=AUDIT_CHECKPOINT, report=AUDIT_REPORT, storage=None):
+        # __init__
+        ## Backend and path default to config.ini; storage (opened from them if not given) finds the bounds
+        ## and checks the ranges itself when the backend is private or processes is 1
+        self.backend = Bank.STORAGE_BACKEND if backend is None else backend
+        self.path = Bank.SQLITE_PATH if path is None else path
+        self.private = self.backend == "memory" or (self.backend == "sqlite" and self.path == ":memory:")
+        self.processes = 1 if self.private else max(1, processes)
+        self.rangeSize = rangeSize
+        self.checkpoint = checkpoint
+        self.reportPath = report
+        self.storage = storage if storage is not None else Bank.openStorage(self.backend, self.path)
+
+    def loadState(self):
+        # loadState
+        ## Resume the checkpoint if it belongs to an audit of the same database with the same range size
+        ## Otherwise start a new audit over the account numbers in use now, with an empty report
+        if os.path.exists(self.checkpoint):
+            with open(self.checkpoint) as f: state = json.load(f)
+            if (state["backend"], state["path"], state["range_size"]) == (self.backend, self.path, self.rangeSize):
+                logging.info(f"Resuming audit from {self.checkpoint} at account {state['watermark']}")
+                return state
+            raise ValueError(f"{self.checkpoint} belongs to another audit; remove it to start a new one")
+        with self.storage.borrow() as session: lowest, highest = session.selectAccountBounds()
+        return {"backend": self.backend, "path": self.path, "range_size": self.rangeSize,
+                "lowest": lowest or 0, "highest": highest if highest is not None else -1,
+                "watermark": lowest or 0, "done": [], "report_bytes": 0,
+                "accounts": 0, "entries": 0, "findings": dict.fromkeys(FINDINGS, 0)}
+
+    def saveState(self, state):
+        temporary = self.checkpoint + ".tmp"
+        with open(temporary, "w") as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.checkpoint)
+
+    def pending(self, state):
+        done = set(state["done"])
+        for first in range(state["watermark"], state["highest"] + 1, self.rangeSize):
+            if first not in done: yield first, min(first + self.rangeSize, state["highest"] + 1)
+
+    def check(self, ranges):
+        # Results (first, accounts, entries, findings) of the ranges, in the order they finish
+        if self.processes == 1:
+            for first, last in ranges: yield (first, *checkRange(self.storage, first, last))
+            return
+        with multiprocessing.Pool(self.processes, openWorker, (self.backend, self.path)) as pool:
+            yield from pool.imap_unordered(runRange, ranges)
+
+    def finish(self, state, report, first, accounts, entries, findings):
+        # finish
+        ## Append the findings to the report and make them durable before the checkpoint counts the range as done
+        ## Move the watermark past every range done in a row from it
+        for finding in findings:
+            report.write(json.dumps(finding) + "\n")
+            state["findings"][finding["kind"]] += 1
+        report.flush()
+        os.fsync(report.fileno())
+        state["report_bytes"] = report.tell()
+        state["accounts"] += accounts
+        state["entries"] += entries
+        done = set(state["done"]) | {first}
+        while state["watermark"] in done:
+            done.discard(state["watermark"])
+            state["watermark"] += self.rangeSize
+        state["done"] = sorted(done)
+        self.saveState(state)
+
+    def run(self, progress=None):
+        # run
+        ## Load or start the audit and cut the report back to the size the checkpoint knows about
+        ## Check the pending ranges in this process or on a pool of worker processes, in any order
+        ## Remove the checkpoint once every range is done and return the totals (seconds - of this run)
+        ## progress is called like BulkIO.Progress reports, with the accounts checked in this run
+        state = self.loadState()
+        counter = BulkIO.Progress("audit", progress)
+        start = time.perf_counter()
+        with open(self.reportPath, "a+") as report:
+            report.truncate(state["report_bytes"])
+            report.seek(state["report_bytes"])
+            for result in self.check(list(self.pending(state))):
+                self.finish(state, report, *result)
+                counter.update(result[1])
+        counter.finish()
+        if os.path.exists(self.checkpoint): os.remove(self.checkpoint)
+        totals = {name: state[name] for name in ("lowest", "highest", "accounts", "entries", "findings")}
+        totals["seconds"] = time.perf_counter() - start
+        return totals
+
+    def close(self):
+        self.storage.disconnectDB(MySQLConnector.SAVE_ON_DISCONNECT)
+
+
+########## Benchmark ##########
+
+# benchmarkAudit
+## Create accounts with a ledger history (an opening entry each, a deposit for every tenth and a transfer for
+## every hundredth), change corrupt balances behind the ledger's back and audit the database with each number of processes
+## Return {processes: (seconds, accounts per second, every corrupted account was reported)}
+def benchmarkAudit(backend, path, accounts=BENCH_ACCOUNTS, processes=BENCH_PROCESSES, rangeSize=AUDIT_RANGE_SIZE,
+                   corrupt=BENCH_CORRUPT, checkpoint=AUDIT_CHECKPOINT, report=AUDIT_REPORT):
+    storage = Bank.openStorage(backend, path)
+    bank = Bank.Bank(storage)
+    acc_nos = []
+    for start in range(0, accounts, BulkIO.IMPORT_CHUNK_ROWS):
+        acc_nos += bank.createAccounts([(f"audit{i}", 1000) for i in range(start, min(start + BulkIO.IMPORT_CHUNK_ROWS, accounts))])
+    ops = [("deposit", acc_no, 10) for acc_no in acc_nos[::10]] + \
+          [("transfer", acc_no, acc_nos[-1 - i], 5) for i, acc_no in enumerate(acc_nos[::100])]
+    for start in range(0, len(ops), Bank.BATCH_CHUNK_SIZE): bank.applyBatch(ops[start:start + Bank.BATCH_CHUNK_SIZE])
+
+    corrupted = set(random.Random(0).sample(acc_nos, min(corrupt, len(acc_nos))))
+    with storage.borrow() as session:
+        session.startTransaction()
+        session.updateBalancesByAccNbrs({acc_no: 1 for acc_no in corrupted})
+        session.save()
+
+    results = {}
+    for count in processes:
+        audit = Audit(backend, path, count, rangeSize, checkpoint, report, storage=storage)
+        totals = audit.run()
+        with open(report) as f: found = {finding["account_no"] for finding in map(json.loads, f) if finding["kind"] == FINDING_MISMATCH}
+        results[count] = (totals["seconds"], totals["accounts"] / totals["seconds"], corrupted <= found)
+    storage.disconnectDB(MySQLConnector.SAVE_ON_DISCONNECT)
+    return results
+
+
+def main():
+    # main
+    ## Parse the options
+    ## bench: build a history, corrupt some balances and time the audit against the number of processes
+    ## run: audit the configured database (resuming from the checkpoint file if there is one) and print the totals
+    parser = argparse.ArgumentParser(description="Consistency audit of balances against the ledger")
+    parser.add_argument("command", choices=("run", "bench"))
+    parser.add_argument("--processes", type=int, nargs="+", default=None, help=f"worker processes (bench: one run each, default {BENCH_PROCESSES})")
+    parser.add_argument("--range-size", type=int, default=AUDIT_RANGE_SIZE, help="account numbers per task")
+    parser.add_argument("--checkpoint", default=AUDIT_CHECKPOINT)
+    parser.add_argument("--report", default=AUDIT_REPORT)
+    parser.add_argument("--accounts", type=int, default=BENCH_ACCOUNTS)
+    parser.add_argument("--backend", choices=("mysql", "sqlite", "memory"), default=Bank.STORAGE_BACKEND)
+    parser.add_argument("--path", default=Bank.SQLITE_PATH, help="SQLite database file for --backend sqlite")
+    args = parser.parse_args()
+
+    if args.command == "bench":
+        results = benchmarkAudit(args.backend, args.path, args.accounts, args.processes or BENCH_PROCESSES, args.range_size,
+                                 checkpoint=args.checkpoint, report=args.report)
+        for count, (seconds, rate, found) in results.items():
+            print(f"processes={count} seconds={seconds:.2f} accounts/s={rate:.0f} corruption_found={found}")
+        return results
+
+    def report(rows, seconds, rate, finished):
+        print(f"{'done' if finished else '...'} {rows} accounts in {seconds:.1f}s ({rate:.0f} accounts/s)", file=sys.stderr)
+
+    audit = Audit(args.backend, args.path, args.processes[0] if args.processes else AUDIT_PROCESSES, args.range_size,
+                  args.checkpoint, args.report)
+    if not audit.storage.isConnected():
+        Bank.printString("Connection to database was UNSUCCESSFUL", length=Bank.DEFAULT_PAGE_WIDTH)
+        return False
+    try:
+        totals = audit.run(report)
+    except (OSError, ValueError) as e:
+        logging.error(e)
+        print(f"audit failed: {e}", file=sys.stderr)
+        return False
+    finally:
+        audit.close()
+    print(" ".join(f"{name}={value}" for name, value in totals.items() if name != "findings"),
+          " ".join(f"{kind}={count}" for kind, count in totals["findings"].items()), f"report={args.report}")
+    return totals
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+import collections
+import threading
+import time
+
+# Defaults
+CACHE_SIZE = 10000   # accounts kept in the cache
+CACHE_TTL  = 30      # seconds an entry stays valid (None - no expiry)
+
+
+# BalanceCache - class
+### In-process LRU/TTL cache of account rows (name, balance, open_date) keyed by account number
+### Readers call token() before querying the database and fill() afterwards; writers call invalidate()
+### after commit. A fill is dropped if the account was invalidated after the token was taken, so a
+### reader that raced a writer can never put a balance older than a committed write back in the cache.
+##    __init__
+##    get           ## Cached row or None (counts hits, misses and expirations)
+##    token         ## Stamp to take before reading the database for a fill
+##    fill          ## Store a row read from the database, unless invalidated since the token
+##    invalidate    ## Drop an account after a committed write
+##    clear         ## Drop every account
+##    getStats      ## Hit/miss/eviction counters
+class BalanceCache():
+
+    def __init__(self, size=CACHE_SIZE, ttl=CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()       # acc_no -> (expires, row), most recently used last
+        self.invalidated = collections.OrderedDict()   # acc_no -> stamp of its last invalidation
+        self.stamp = 0                                 # bumped on every invalidation
+        self.floor = 0                                 # fills with a token below this are dropped (pruned stamps)
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0, "invalidations": 0, "dropped_fills": 0}
+
+    def get(self, acc_no):
+        with self.lock:
+            entry = self.entries.get(acc_no)
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            if entry[0] is not None and entry[0] < time.monotonic():
+                del self.entries[acc_no]
+                self.stats["expirations"] += 1
+                self.stats["misses"] += 1
+                return None
+            self.entries.move_to_end(acc_no)
+            self.stats["hits"] += 1
+            return entry[1]
+
+    def token(self):
+        with self.lock:
+            return self.stamp
+
+    def fill(self, acc_no, row, token):
+        with self.lock:
+            if token < self.floor or self.invalidated.get(acc_no, 0) > token:
+                self.stats["dropped_fills"] += 1
+                return False
+            self.entries[acc_no] = (time.monotonic() + self.ttl if self.ttl is not None else None, row)
+            self.entries.move_to_end(acc_no)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.stats["evictions"] += 1
+            return True
+
+    def invalidate(self, acc_no):
+        with self.lock:
+            self.stamp += 1
+            self.entries.pop(acc_no, None)
+            self.invalidated[acc_no] = self.stamp
+            self.invalidated.move_to_end(acc_no)
+            self.stats["invalidations"] += 1
+            # Keep the invalidation log bounded; anything older than what is pruned is rejected via floor
+            while len(self.invalidated) > self.size:
+                self.floor = max(self.floor, self.invalidated.popitem(last=False)[1])
+
+    def clear(self):
+        with self.lock:
+            self.stamp += 1
+            self.floor = self.stamp
+            self.entries.clear()
+            self.invalidated.clear()
+
+    def getStats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats.update(size=len(self.entries), capacity=self.size,
+                         hit_ratio=stats["hits"] / (stats["hits"] + stats["misses"]) if stats["hits"] + stats["misses"] else 0.0)
+        return stats
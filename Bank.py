@@ -1,20 +1,61 @@
 import MySQLConnector
+import SQLiteConnector
+import MemoryStorage
+import BalanceCache
+import IdempotencyCache
+import FxRates
+import LazyImport
+import Storage
+import Metrics
+import collections
+import itertools
+import threading
+import decimal
+import random
 import time
 import configparser
 import logging
-import tabulate
+import hashlib
+import json
+import os
+
+# Only the interactive account table needs tabulate
+tabulate = LazyImport.lazyImport("tabulate")
 
 # Defaults
 DEFAULT_PAGE_WIDTH = 60
 DEFAULT_ACCOUNT_NAME = "John Doe"
 DEFAULT_BALANCE = 0
+DEFAULT_CURRENCY = FxRates.DEFAULT_CURRENCY
+
+# Batch transactions
+BATCH_CHUNK_SIZE = 1000     # operations applied per database transaction by applyBatch
+
+# Ledger
+LEDGER_PAGE_SIZE = 500      # rows fetched per round trip by Bank.history
+
+# Transfers
+TRANSFER_LOCKED      = "locked"        # lock both rows in one ordered SELECT ... FOR UPDATE, then one UPDATE
+TRANSFER_CONDITIONAL = "conditional"   # single conditional UPDATE (balance >= amount), no SELECT ... FOR UPDATE
+TRANSFER_MODE        = TRANSFER_LOCKED
+
+# What a failed transfer's switch (its second item) reports
+TRANSFER_ERRORS = {0: "Source Account error",   # source missing, amount not positive or source equals target
+                   1: "Target Account error",   # target missing
+                   2: "Transfer declined"}      # insufficient funds, no FX rate or a database error
+
+# Deadlock / lock wait timeout retries
+RETRYABLE_ERRNOS = (1205, 1213)   # ER_LOCK_WAIT_TIMEOUT, ER_LOCK_DEADLOCK
+DEADLOCK_RETRIES = 3
+DEADLOCK_BACKOFF = 0.02           # seconds, doubled on every retry
 
 # Debugger
 DEBUG = 0
 VERBOSE_MAIN_FUNCTIONS = 0
 
-# Logging
-logging.basicConfig(filename='bank.log', format='%(asctime)s - Process ID: %(process)d ---- %(levelname)s ---- %(message)s', datefmt='%d-%b-%y %H:%M:%S')
+# Logging: configured once by loadConfig, for Bank and the storage modules
+LOG_FILE   = 'bank.log'
+LOG_FORMAT = '%(asctime)s - Process ID: %(process)d ---- %(levelname)s ---- %(message)s'
 
 # Status of request
 STATUS_START = 1
@@ -29,14 +70,90 @@ STATE_LOGGED_OUT = 0
 
 # Credentials File
 CRED_FILE = "config.ini"
-config = configparser.ConfigParser()
-config.read(CRED_FILE)
 
-# Credentials
-MYSQL_HOST     = config["MYSQL"]["host"]
-MYSQL_USERNAME = config["MYSQL"]["username"]
-MYSQL_PASSWORD = config["MYSQL"]["password"]
-MYSQL_DATABASE = config["MYSQL"]["database"]
+# Metrics: counters and latency histograms of Bank operations
+METRICS = Metrics.METRICS
+
+# Settings read from CRED_FILE by loadConfig - on first use, not at import
+CONFIG_NAMES = ("MYSQL_HOST", "MYSQL_USERNAME", "MYSQL_PASSWORD", "MYSQL_DATABASE", "POOL_SIZE", "POOL_TIMEOUT",
+                "POOL_MAX_IDLE", "STORAGE_BACKEND", "SQLITE_PATH", "CACHE_SIZE", "CACHE_TTL", "KEY_CACHE_SIZE",
+                "GROUP_COMMIT_MAX_OPS", "GROUP_COMMIT_WINDOW", "SNAPSHOT_INTERVAL", "SNAPSHOT_LAG", "SCHEDULER_WORKERS",
+                "ADMISSION_MAX_IN_FLIGHT", "ADMISSION_ACCOUNT_IN_FLIGHT", "ADMISSION_QUEUE_SIZE", "ADMISSION_QUEUE_TIMEOUT",
+                "ADMISSION_RATE", "ADMISSION_BURST", "REPLICA_HOSTS", "REPLICA_COPIES", "REPLICA_COPY_INTERVAL",
+                "REPLICA_MAX_LAG", "REPLICA_LAG_INTERVAL", "REPLICA_READ_YOUR_WRITES", "FX_TTL", "STRIPES_TTL")
+configLock = threading.Lock()
+config = None
+
+# loadConfig
+## Read CRED_FILE once, set the CONFIG_NAMES module globals and configure logging; later calls return the parsed config
+## Run by Bank(), openStorage and main, and by a module attribute lookup of any CONFIG_NAMES (Bank.SNAPSHOT_LAG)
+def loadConfig():
+    global config
+    if config is not None: return config
+    with configLock:
+        if config is not None: return config
+        logging.basicConfig(filename=LOG_FILE, format=LOG_FORMAT, datefmt='%d-%b-%y %H:%M:%S')
+        parser = configparser.ConfigParser()
+        parser.read(CRED_FILE)
+        settings = {
+            # Credentials
+            "MYSQL_HOST":     parser.get("MYSQL", "host", fallback=None),
+            "MYSQL_USERNAME": parser.get("MYSQL", "username", fallback=None),
+            "MYSQL_PASSWORD": parser.get("MYSQL", "password", fallback=None),
+            "MYSQL_DATABASE": parser.get("MYSQL", "database", fallback=None),
+            # Connection pool (optional keys)
+            "POOL_SIZE":      parser.getint("MYSQL", "pool_size", fallback=MySQLConnector.POOL_SIZE),
+            "POOL_TIMEOUT":   parser.getfloat("MYSQL", "pool_timeout", fallback=MySQLConnector.POOL_CHECKOUT_TIMEOUT),
+            "POOL_MAX_IDLE":  parser.getfloat("MYSQL", "pool_max_idle", fallback=MySQLConnector.POOL_MAX_IDLE),
+            # Storage backend (optional section): mysql, sqlite or memory
+            "STORAGE_BACKEND": parser.get("STORAGE", "backend", fallback="mysql"),
+            "SQLITE_PATH":     parser.get("STORAGE", "path", fallback=SQLiteConnector.SQLITE_PATH),
+            # Balance cache (optional section, disabled unless size > 0)
+            "CACHE_SIZE": parser.getint("CACHE", "size", fallback=0),
+            "CACHE_TTL":  parser.getfloat("CACHE", "ttl", fallback=BalanceCache.CACHE_TTL),
+            # Idempotency keys (optional section): results of recent keys kept in memory
+            "KEY_CACHE_SIZE": parser.getint("IDEMPOTENCY", "cache_size", fallback=IdempotencyCache.KEY_CACHE_SIZE),
+            # Group commit of deposits/withdrawals (optional section, disabled unless max_ops > 0)
+            "GROUP_COMMIT_MAX_OPS": parser.getint("GROUP_COMMIT", "max_ops", fallback=0),
+            "GROUP_COMMIT_WINDOW":  parser.getfloat("GROUP_COMMIT", "window", fallback=0.0),
+            # Balance snapshots (optional section): taken every interval seconds by the server (0 - off), as of lag seconds ago
+            "SNAPSHOT_INTERVAL": parser.getfloat("SNAPSHOTS", "interval", fallback=0),
+            "SNAPSHOT_LAG":      parser.getfloat("SNAPSHOTS", "lag", fallback=60),
+            # Scheduled payments (optional section): scheduler worker threads run by the server (0 - off)
+            "SCHEDULER_WORKERS": parser.getint("SCHEDULER", "workers", fallback=0),
+            # Admission control of the server (optional section): concurrency limits and per-client rate limits (0 - off)
+            "ADMISSION_MAX_IN_FLIGHT":     parser.getint("ADMISSION", "max_in_flight", fallback=0),
+            "ADMISSION_ACCOUNT_IN_FLIGHT": parser.getint("ADMISSION", "account_in_flight", fallback=0),
+            "ADMISSION_QUEUE_SIZE":        parser.getint("ADMISSION", "queue_size", fallback=64),
+            "ADMISSION_QUEUE_TIMEOUT":     parser.getfloat("ADMISSION", "queue_timeout", fallback=0.1),
+            "ADMISSION_RATE":              parser.getfloat("ADMISSION", "rate", fallback=0),
+            "ADMISSION_BURST":             parser.getfloat("ADMISSION", "burst", fallback=0),
+            # Read replicas (optional section): MySQL replica endpoints (host or host:port, comma separated),
+            # or in-memory copies of an SQLite file as a stand-in; reads go to the primary above max_lag seconds
+            "REPLICA_HOSTS":            [host for host in parser.get("REPLICAS", "hosts", fallback="").split(",") if host.strip()],
+            "REPLICA_COPIES":           parser.getint("REPLICAS", "copies", fallback=0),
+            "REPLICA_COPY_INTERVAL":    parser.getfloat("REPLICAS", "copy_interval", fallback=SQLiteConnector.COPY_INTERVAL),
+            "REPLICA_MAX_LAG":          parser.getfloat("REPLICAS", "max_lag", fallback=Storage.REPLICA_MAX_LAG),
+            "REPLICA_LAG_INTERVAL":     parser.getfloat("REPLICAS", "lag_interval", fallback=Storage.REPLICA_LAG_INTERVAL),
+            "REPLICA_READ_YOUR_WRITES": parser.getboolean("REPLICAS", "read_your_writes", fallback=True),
+            # FX rates (optional section): seconds the cached fx_rates table is used before it is read again
+            "FX_TTL": parser.getfloat("FX", "ttl", fallback=FxRates.FX_TTL),
+            # Striped accounts (optional section): seconds the striped account list is used before it is read again
+            "STRIPES_TTL": parser.getfloat("STRIPES", "ttl", fallback=5.0),
+        }
+        globals().update(settings)
+        # Metrics (optional section)
+        METRICS.enabled = parser.getboolean("METRICS", "enabled", fallback=True)
+        config = parser
+    return config
+
+# __getattr__
+## Module attributes named in CONFIG_NAMES that are looked up before loadConfig ran
+def __getattr__(name):
+    if name in CONFIG_NAMES:
+        loadConfig()
+        return globals()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 ########## Useful functions for displaying and retrieving input #############
@@ -76,42 +193,104 @@ def getInput(inputType=int, prefix="", sep=": ", v=True):
     return output
 
 
-########### Main queries to be sent to the MySQL server for execution ############
+########### Storage backends and transaction helpers ############
 
 
-# selectRowByAccNbr
-## Retreives account information based on account number
-def selectRowByAccNbr(dbObj, acc_no, lock=False):
-    query = "SELECT * FROM accounts WHERE account_no = %s"
-    query += " FOR UPDATE;" if lock else ";"
-    dbObj.getCursor().execute(query, (int(acc_no),))
+# openStorage
+## Open the storage backend Bank talks to
+##     mysql  - pooled connections to the server in config.ini
+##     sqlite - local SQLite database at path (in-memory by default)
+##     memory - in-process MemoryStorage engine
+def openStorage(backend=None, path=None):
+    loadConfig()
+    backend = STORAGE_BACKEND if backend is None else backend
+    path = SQLITE_PATH if path is None else path
+    if backend == "memory": return MemoryStorage.MemoryStorage()
+    if backend == "sqlite": primary = Storage.SQLiteStorage(SQLiteConnector.sqliteDB(path))
+    elif backend != "mysql": raise ValueError(f"Unknown storage backend: {backend}")
+    else: primary = Storage.MySQLStorage(MySQLConnector.mysqlPool(MYSQL_HOST, MYSQL_USERNAME, MYSQL_PASSWORD, MYSQL_DATABASE,
+                                                                  size=POOL_SIZE, timeout=POOL_TIMEOUT, maxIdle=POOL_MAX_IDLE))
+    replicas = openReplicas(backend, path)
+    if not replicas: return primary
+    return Storage.ReplicatedStorage(primary, replicas, REPLICA_MAX_LAG, REPLICA_LAG_INTERVAL, REPLICA_READ_YOUR_WRITES)
 
-# updateBalanceByAccNbr
-## Updates balance based on account number
-def updateBalanceByAccNbr(dbObj, acc_no, balance): dbObj.getCursor().execute("UPDATE accounts SET balance=%s WHERE account_no=%s;", (int(balance), int(acc_no)))
-
-# addAccount
-## Adds a new account/entry into the accounts table with a name and starting balance as input
-def addAccount(dbObj, name, balance): dbObj.getCursor().execute("INSERT INTO accounts (name, balance) VALUES (%s, %s);", (name, int(balance)))
-
-# getBalance
-## Retreives balance based on account number
-def getBalance(dbObj, acc_no): dbObj.getCursor().execute("SELECT balance FROM accounts WHERE account_no = %s;", (int(acc_no),))
+# openReplicas
+## Read replicas from the [REPLICAS] section: a storage per MySQL replica endpoint, or per in-memory copy of an
+## SQLite file (copies, refreshed every copy_interval seconds); none for the memory backend and in-memory SQLite
+def openReplicas(backend, path):
+    if backend == "mysql":
+        return [Storage.MySQLStorage(pool) for pool in MySQLConnector.replicaPools(REPLICA_HOSTS, MYSQL_USERNAME, MYSQL_PASSWORD, MYSQL_DATABASE,
+                                                                                   size=POOL_SIZE, timeout=POOL_TIMEOUT, maxIdle=POOL_MAX_IDLE)]
+    if backend == "sqlite" and path != ":memory:":
+        return [Storage.SQLiteStorage(SQLiteConnector.sqliteCopy(path, REPLICA_COPY_INTERVAL)) for _ in range(REPLICA_COPIES)]
+    return []
 
 # startTransaction
 ## Begins database transation
 ## saveTransaction must be run at the end of the transaction
-def startTransaction(dbObj): dbObj.getCursor().execute("START TRANSACTION;", ())
+def startTransaction(dbObj): dbObj.startTransaction()
  
 # saveTransaction
 ## Commits/saves transaction to database
 ## startTransaction NOT required to be run before this function
-def saveTransaction(dbObj): dbObj.save()
+def saveTransaction(dbObj):
+    if not METRICS.enabled: return dbObj.save()
+    start = time.perf_counter()
+    dbObj.save()
+    METRICS.observe("bank_commit_seconds", time.perf_counter() - start)
 
 # rollbackTransaction
 ## Clears the current transaction
 ## startTransaction IS required to be run before this function
-def rollbackTransaction(dbObj): dbObj.rollback()
+def rollbackTransaction(dbObj):
+    dbObj.rollback()
+    METRICS.inc("bank_rollbacks_total")
+
+# newKey
+## Idempotency key identifying one Bank operation in the transactions ledger
+def newKey(): return os.urandom(16).hex()
+
+# ledgerEntry
+## Ledger entry for one account touched by an operation; amount is the signed change of the balance
+def ledgerEntry(key, acc_no, kind, balance_before, balance_after):
+    return (key, int(acc_no), kind, int(balance_after) - int(balance_before), int(balance_before), int(balance_after))
+
+# requestOf
+## What an idempotency key is committed with besides the result: the operation and a digest of its arguments,
+## so a key reused for another operation or other arguments is rejected instead of replaying the first result
+def requestOf(operation, *args):
+    return f"{operation}:{hashlib.blake2b(json.dumps(args, default=str).encode(), digest_size=16).hexdigest()}"
+
+# encodeResult
+## Results of keyed operations are stored as JSON text in the idempotency_keys table, with the request they answer
+def encodeResult(request, result): return json.dumps({"request": request, "result": result}, default=str)
+
+# decodeResult
+## Turn a stored result back into (request, what the operation returned) - JSON arrays become tuples
+## Results stored before requests were recorded are bare results: their request is None and is not checked
+def decodeResult(text):
+    def toTuples(value): return tuple(toTuples(item) for item in value) if isinstance(value, list) else value
+    stored = json.loads(text)
+    if isinstance(stored, dict) and "request" in stored: return stored["request"], toTuples(stored["result"])
+    return None, toTuples(stored)
+
+# storeResult
+## Store the result of a keyed operation in its own transaction; a key committed before makes the commit fail
+def storeResult(dbObj, key, request, result):
+    if key is not None: dbObj.addResultByKey(key, encodeResult(request, result))
+
+# isRetryable
+## True if the database error is a deadlock or lock wait timeout, so the whole transaction can be run again
+def isRetryable(e): return getattr(e, "errno", None) in RETRYABLE_ERRNOS
+
+# countLockError
+## Count deadlocks and lock wait timeouts (by errno) in the metrics
+def countLockError(e):
+    if isRetryable(e): METRICS.inc("bank_lock_errors_total", (("errno", str(e.errno)),))
+
+# retryBackoff
+## Sleep before retry number 'attempt' with exponential backoff and jitter
+def retryBackoff(attempt): time.sleep(DEADLOCK_BACKOFF * (2 ** attempt) * random.uniform(0.5, 1.5))
 
 
 
@@ -120,90 +299,258 @@ def rollbackTransaction(dbObj): dbObj.rollback()
 # Bank - class
 ### Provides necessary functions for a Bank to run
 ### Provides middle man servcies to the database and User Interface
+### Every operation borrows its own storage session (dbObj.borrow()) for the life of its transaction
+### Balances and amounts are integers in minor units of the account's currency (cents of a USD account);
+### a transfer between currencies debits the amount from the source and credits it converted at the cached FX rate
 ##    __init__                        
 ##    getAccountInfo     ## Static method - Retrieves account information
+##    invalidate         ## Drop accounts from the balance cache after a committed write
+##    replay             ## Result of an operation already committed under an idempotency key (KeyReused for another request)
+##    countRetry         ## Count a deadlock / lock wait timeout retry of an operation
+##    remember           ## Keep the result of a committed keyed operation in the idempotency cache
 ##    createAccount      ## Creates an entry in database for the client where their banking information is stored
+##    createAccounts     ## Create many accounts in one transaction with multi-row INSERTs
 ##    checkBalance       ## Retrieve current balance
+##    getAccount         ## Retrieve name, balance and opening date
 ##    changeBalanceMain  ## Perform arithmetic operations on balance
 ##    changeBalance      ## Change balance of account based on action (desposit and withdraw)
 ##    deposit            ## Desposit money to account based on account number
 ##    withdraw           ## Withdraw money from account based on account number
 ##    transfer           ## Transfer money from source to target account
+##    getAccountsInfo    ## Static method - Retrieves (and locks, in account number order) several accounts at once
+##    transferLocked     ## Transfer path - one ordered SELECT ... FOR UPDATE, one UPDATE
+##    transferConditional ## Transfer path - one conditional UPDATE, no locking SELECT
+##    transferStriped    ## Transfer path when either account is striped
+##    creditAmount       ## Amount a transfer credits to its target, converted between currencies
+##    setFxRates         ## Store FX rates and reload the rate cache
+##    refreshFxRates     ## Reload the rate cache now
+##    stripeAccount      ## Split an account's credits across stripes (or merge them back)
+##    stripeCount        ## Number of stripes of an account (0 - not striped)
+##    refreshStripes     ## Reload which accounts are striped
+##    creditStriped      ## Credit one random stripe of a striped account
+##    debitStriped       ## Check a striped account can cover a debit, sweeping its stripes in if the row is short
+##    sweepStripes       ## Move every stripe of a striped account into its row
+##    applyBatch         ## Apply many deposits, withdrawals and transfers in chunked transactions
+##    history            ## Stream an account's ledger entries page by page
+##    takeSnapshot       ## Snapshot the balances of the accounts changed since the last snapshot
+##    balanceAsOf        ## Balance of an account at a point in time, from its nearest snapshot
+##    statement          ## Opening/closing balance, totals and entries of an account over a period
+##    getStats           ## Storage, cache, idempotency and group commit counters
+##    exportMetrics      ## Metrics in Prometheus text format, with the counters above as gauges
 class Bank():
     
     # __init__
-    ### Create instance variable to hold MySQL database connection details
-    def __init__(self, databaseObject):
+    ### Create instance variable to hold storage backend details
+    ### databaseObject is a Storage.AccountStorage (see openStorage)
+    ### transferMode is TRANSFER_LOCKED or TRANSFER_CONDITIONAL
+    ### cache is an optional BalanceCache.BalanceCache used by unlocked reads
+    ### keys is the IdempotencyCache in front of the idempotency_keys table (one is created if not given)
+    ### group is an optional GroupCommit.GroupCommit that deposits and withdrawals without a key go through
+    ### fx is the FxRates.FxRates cache of the fx_rates table (one is created if not given)
+    ### The striped accounts are read from storage on first use (stripeCount) and again every STRIPES_TTL seconds,
+    ### so accounts striped by another process are seen; the FX rates are read on the first transfer
+    def __init__(self, databaseObject, transferMode=TRANSFER_MODE, cache=None, keys=None, group=None, fx=None):
+        loadConfig()
         self.dbObj = databaseObject
+        self.transferMode = transferMode
+        self.cache = cache
+        self.keys = keys if keys is not None else IdempotencyCache.IdempotencyCache(KEY_CACHE_SIZE)
+        self.retries = collections.Counter()   # deadlock / lock wait timeout retries per operation (countRetry)
+        self.retriesLock = threading.Lock()
+        self.group = group
+        self.stripes = None                     # acc_no -> stripes of every striped account, loaded by stripeCount
+        self.stripesTtl = STRIPES_TTL           # seconds before loadStripes reads them again (None - until refreshStripes)
+        self.stripesDue = 0.0                   # time.monotonic() after which loadStripes reads them again
+        self.stripesLock = threading.Lock()
+        self.fx = fx if fx is not None else FxRates.FxRates(self.dbObj, FX_TTL)
+        if group is not None: group.start(self.applyChunk)
     
     ########### Execute an import MySQL query with error handlers ############
     
     @staticmethod
-    def getAccountInfo(dbObj, acc_no, balanceOnly=False, v=0, lock=False):
+    def getAccountInfo(dbObj, acc_no, balanceOnly=False, v=0, lock=False, cache=None, striped=False):
         # getAccountInfo - static method
+        ## if a cache is given and the read is not locking: return the cached row when there is one
         ## try: Obtain account information via database table
+        ##      an unlocked read of a striped account reports the row plus its stripes
         ## except: log database error and raise error
         ## else: check if any data was recieved
         ##    if no data recieved raise exception
         ##    else there is data
+        ##         fill the cache (unlocked reads on the primary only - a replica may return a balance older than an invalidation)
         ##         return the appropriate data
-        try:
-            selectRowByAccNbr(dbObj, acc_no, lock)
-        except Exception as e:
-            printString("Database Error", length=DEFAULT_PAGE_WIDTH)
-            logging.error(e)
-            raise Exception()
-        else:
-            row = dbObj.getCursor().fetchone()
-            if row is None:
-                logging.error(f"The account, with id = {acc_no}, does not exist")
-                raise ValueError("Account does not exist", acc_no)
-            
-            # row[1] = name
-            # row[2] = balance
-            # row[3] = open date
-            if v:
-                print(f"Name:           {row[1]}\n"
-                    + f"Balance:        {row[2]}\n"
-                    + f"Opening Date:   {row[3]}\n")
-                
-            logging.debug(f"Fetching account {acc_no} was successful")
-            
-            if balanceOnly: return row[2]
-            return row[1:]
+        useCache = cache is not None and not lock
+        row = cache.get(int(acc_no)) if useCache else None
+        
+        if row is None:
+            token = cache.token() if useCache else None
+            if lock: METRICS.inc("bank_rows_locked_total")
+            try:
+                fetched = dbObj.selectRowByAccNbr(acc_no, lock)
+            except Exception as e:
+                printString("Database Error", length=DEFAULT_PAGE_WIDTH)
+                logging.error(e)
+                raise Exception()
+            else:
+                if fetched is None:
+                    logging.error(f"The account, with id = {acc_no}, does not exist")
+                    raise ValueError("Account does not exist", acc_no)
+                row = tuple(fetched[1:5])
+                if striped and not lock: row = (row[0], dbObj.selectStripedBalance(acc_no), *row[2:])
+                if useCache and not dbObj.replica: cache.fill(int(acc_no), row, token)
+                logging.debug("Fetching account %s was successful", acc_no)
+        
+        # row[0] = name
+        # row[1] = balance
+        # row[2] = open date
+        # row[3] = currency
+        if v:
+            print(f"Name:           {row[0]}\n"
+                + f"Balance:        {FxRates.fromMinor(row[1], row[3])} {row[3]}\n"
+                + f"Opening Date:   {row[2]}\n")
+        
+        if balanceOnly: return row[1]
+        return row
+    
+    def invalidate(self, *acc_nos):
+        # invalidate
+        ## Drop accounts from the balance cache - call after the write has been committed
+        ## Pin the caller's read-your-writes token (if any) to the primary
+        self.dbObj.pinWrites()
+        if self.cache is None: return
+        for acc_no in acc_nos: self.cache.invalidate(int(acc_no))
+    
+    def replay(self, key, request, dbObj=None, force=False):
+        # replay
+        ## Return (True, result) if an operation was already committed under key, else (False, None)
+        ## A key the bloom filter has never seen is new - no round trip; a recent key is answered by the LRU
+        ## Anything else is looked up in the idempotency_keys table (with dbObj, or a session borrowed for it)
+        ## force skips the bloom filter - after a failed commit the key may have been stored by another process
+        ## Raise IdempotencyCache.KeyReused if the key was committed for another request (requestOf)
+        if key is None: return False, None
+        if not force and not self.keys.mightContain(key): return False, None
+        found, entry = self.keys.get(key)
+        if not found:
+            if dbObj is None:
+                with self.dbObj.borrow() as dbObj: stored = dbObj.selectResultByKey(key)
+            else: stored = dbObj.selectResultByKey(key)
+            if stored is None: return False, None
+            entry = decodeResult(stored)
+            self.keys.remember(key, entry)
         
-    def createAccount(self, name=DEFAULT_ACCOUNT_NAME, balance=DEFAULT_BALANCE, v=VERBOSE_MAIN_FUNCTIONS):
+        committed, result = entry
+        if committed is not None and committed != request:
+            logging.warning("Idempotency key %s reused for another request", key)
+            raise IdempotencyCache.KeyReused(key)
+        logging.debug("Replaying idempotency key %s", key)
+        return True, result
+    
+    def countRetry(self, operation):
+        # countRetry
+        ## Count a deadlock / lock wait timeout retry of operation - operations retry from many threads at once
+        with self.retriesLock: self.retries[operation] += 1
+    
+    def remember(self, key, request, result):
+        # remember
+        ## Call after the transaction that stored key has been committed
+        if key is not None: self.keys.remember(key, (request, result))
+        
+    @METRICS.operation("createAccount")
+    def createAccount(self, name=DEFAULT_ACCOUNT_NAME, balance=DEFAULT_BALANCE, v=VERBOSE_MAIN_FUNCTIONS, key=None, currency=DEFAULT_CURRENCY):
         # createAccount
+        ## balance is in minor units of currency (an int - ValueError otherwise, before any write)
+        ## if key was already committed return its account number (raise KeyReused if it was for another request)
         ## start SQL transction
-        ## add the account
+        ## add the account (and store key with the result)
         ## commit the changes to the database
+        ## return the new account number
         ## if there is an error
         ##     rollback transaction and log error
+        ##     return the original account number if the key was committed meanwhile
         printStatus(STATUS_LOAD, DEBUG)
         
         if v:
             print("Create Account")
             print(f"acc_name: {name}")
             print(f"balance: {balance}")
+            print(f"currency: {currency}")
         
         try:
-            startTransaction(self.dbObj)
-            addAccount(self.dbObj, name, balance)
-            saveTransaction(self.dbObj)
+            currency = FxRates.checkCurrency(currency)
+            FxRates.checkMinor(balance)
+            request = requestOf("createAccount", name, balance, currency)
+            replayed, acc_no = self.replay(key, request)
+            if replayed: return acc_no
             
-            printStatus(STATUS_COMP, DEBUG)
-            logging.debug(f"Account creation for '{name}' was successful")
-            return True
+            with self.dbObj.borrow() as dbObj:
+                try:
+                    startTransaction(dbObj)
+                    acc_no = dbObj.addAccount(name, balance, currency)
+                    dbObj.addLedgerEntries([ledgerEntry(newKey(), acc_no, "open", 0, balance)])
+                    storeResult(dbObj, key, request, acc_no)
+                    saveTransaction(dbObj)
+                    self.invalidate(acc_no)
+                    self.remember(key, request, acc_no)
+                    
+                    printStatus(STATUS_COMP, DEBUG)
+                    logging.debug("Account creation for '%s' was successful", name)
+                    return acc_no
+                except Exception as e:
+                    rollbackTransaction(dbObj)
+                    logging.error(e)
+                    replayed, acc_no = self.replay(key, request, dbObj, force=True)
+                    if replayed: return acc_no
+        except IdempotencyCache.KeyReused:
+            raise
+        except Exception as e:
+            logging.error(e)
+        
+        printStatus(STATUS_ERROR, DEBUG)
+        return False
+    
+    @METRICS.operation("createAccounts")
+    def createAccounts(self, rows, v=VERBOSE_MAIN_FUNCTIONS, currency=DEFAULT_CURRENCY):
+        # createAccounts
+        ## rows are (name, balance) or (account_no, name, balance) tuples - account numbers on every row or none -
+        ## in currency, or (account_no, name, balance, currency) tuples
+        ## start SQL transction
+        ## add the accounts with multi-row INSERTs and record their opening balances in the ledger
+        ## commit the changes to the database
+        ## return the new account numbers
+        ## if there is an error
+        ##     rollback transaction, log error and return False
+        printStatus(STATUS_LOAD, DEBUG)
+        
+        if v: print(f"Create {len(rows)} Accounts")
+        
+        try:
+            rows = [(None, *row, currency) if len(row) == 2 else (*row, currency) if len(row) == 3 else tuple(row) for row in rows]
+            rows = [(acc_no, name, FxRates.checkMinor(balance), FxRates.checkCurrency(code)) for acc_no, name, balance, code in rows]
+            with self.dbObj.borrow() as dbObj:
+                try:
+                    startTransaction(dbObj)
+                    acc_nos = dbObj.addAccounts(rows)
+                    dbObj.addLedgerEntries([ledgerEntry(newKey(), acc_no, "open", 0, balance) for acc_no, (_, name, balance, _) in zip(acc_nos, rows)])
+                    saveTransaction(dbObj)
+                    self.invalidate(*acc_nos)
+                    
+                    printStatus(STATUS_COMP, DEBUG)
+                    logging.debug("Creation of %d accounts was successful", len(acc_nos))
+                    return acc_nos
+                except Exception as e:
+                    rollbackTransaction(dbObj)
+                    logging.error(e)
         except Exception as e:
-            rollbackTransaction(self.dbObj)
             logging.error(e)
         
         printStatus(STATUS_ERROR, DEBUG)
         return False
     
+    @METRICS.operation("checkBalance")
     def checkBalance(self, acc_no, v=VERBOSE_MAIN_FUNCTIONS):
         # checkBalance
-        ## Run getAccountInfo to retrieve account information from database
+        ## Run getAccountInfo to retrieve account information from database (a read replica if there are any,
+        ## read again from the primary if the replica fails)
         ## if there is an error
         ##      log error
         printStatus(STATUS_LOAD, DEBUG)
@@ -213,10 +560,11 @@ class Bank():
             print(f"acc_no: {acc_no}")
             
         try:
-            balance = __class__.getAccountInfo(self.dbObj, acc_no, balanceOnly=True)
+            striped = self.stripeCount(acc_no) > 0
+            balance = self.dbObj.read(lambda dbObj: __class__.getAccountInfo(dbObj, acc_no, balanceOnly=True, cache=self.cache, striped=striped))
             printStatus(STATUS_COMP, DEBUG)
             
-            logging.debug(f"Checking balance for (Account Id: {acc_no}) was successful")
+            logging.debug("Checking balance for (Account Id: %s) was successful", acc_no)
             return balance
         except Exception as e:
             logging.error(e)
@@ -224,29 +572,47 @@ class Bank():
         printStatus(STATUS_ERROR, DEBUG)
         return False
 
-    def changeBalanceMain(self, acc_no, balance, amount, action, v=VERBOSE_MAIN_FUNCTIONS):
+    def getAccount(self, acc_no):
+        # getAccount
+        ## Run getAccountInfo (through the balance cache, on a read replica if there are any) and return (name, balance, open_date, currency)
+        ## return False if the account does not exist or on error
+        try:
+            striped = self.stripeCount(acc_no) > 0
+            return self.dbObj.read(lambda dbObj: __class__.getAccountInfo(dbObj, acc_no, cache=self.cache, striped=striped))
+        except Exception as e:
+            logging.error(e)
+        return False
+
+    def changeBalanceMain(self, dbObj, acc_no, balance, amount, action, v=VERBOSE_MAIN_FUNCTIONS):
         # changeBalanceMain
-        ## Lock row based on account number
         ## Perform operation based on action
         ## Update balance for the associated account
-        selectRowByAccNbr(self.dbObj, acc_no)
-        
+        ## The caller must already hold the row lock (getAccountInfo with lock=True)
+        ## dbObj is the connection borrowed by the calling operation
         if action == 'deposit': balance += amount
         elif action == 'withdraw': balance -= amount
         else: return balance
         
-        updateBalanceByAccNbr(self.dbObj, acc_no, balance)
+        dbObj.updateBalanceByAccNbr(acc_no, balance)
         return balance
     
-    def changeBalance(self, acc_no, amount, action, v=VERBOSE_MAIN_FUNCTIONS):
+    def changeBalance(self, acc_no, amount, action, v=VERBOSE_MAIN_FUNCTIONS, key=None):
         # changeBalance
-        ## Check if amount is a valid input
+        ## Check if amount is a valid input: a positive int in minor units (not a float or bool, which the
+        ## storage would round or keep as is) - ValueError before any write
+        ## with group commit and no key: wait for the group transaction holding the operation to commit
+        ##     (not for striped accounts - their credits do not queue on the row lock in the first place,
+        ##     nor once the group commit is closed - the operation then commits on its own)
+        ## if key was already committed return its balance (raise KeyReused if it was for another request)
         ## Retrieve account information
         ## start SQL transction
         ## Perform arithmetic operations on balance
+        ##     a striped account is credited on one random stripe, and debited from its row (creditStriped/debitStriped)
+        ## Record the change in the transactions ledger (and store key with the result)
         ## Commit/save transaction to database
         ## if there is an error
         ##     rollback transactions
+        ##     return the original balance if the key was committed meanwhile
         printStatus(STATUS_LOAD, DEBUG)
         
         if v: 
@@ -255,44 +621,90 @@ class Bank():
             print(f"amount: {amount}")
         
         try:
+            FxRates.checkMinor(amount)
             assert(amount > 0)
+            striped = self.stripeCount(acc_no) > 0
+            queued = self.group.submit((action, acc_no, amount)) if self.group is not None and key is None and not striped else None
+            if queued is not None:
+                ok, balance = queued.result()
+                if ok:
+                    # The group thread committed it, so its invalidate could not pin this thread's token
+                    self.dbObj.pinWrites()
+                    return balance
+                raise ValueError(balance, acc_no)
             
-            startTransaction(self.dbObj)
-            balance = __class__.getAccountInfo(self.dbObj, acc_no, balanceOnly=True, lock=True)
-            balance = self.changeBalanceMain(acc_no, balance, amount, action)
-            saveTransaction(self.dbObj)
+            request = requestOf(action, int(acc_no), amount)
+            replayed, balance = self.replay(key, request)
+            if replayed: return balance
             
-            printStatus(STATUS_COMP, DEBUG)
-            logging.debug(f"{action} (Account Id: {acc_no}) was successful")
-            
-            return balance
+            with self.dbObj.borrow() as dbObj:
+                try:
+                    startTransaction(dbObj)
+                    if striped and action == 'deposit':
+                        before, balance = self.creditStriped(dbObj, acc_no, amount)
+                    elif striped:
+                        row = __class__.getAccountInfo(dbObj, acc_no, balanceOnly=True, lock=True)
+                        before, row = self.debitStriped(dbObj, acc_no, row, amount)
+                        dbObj.updateBalanceByAccNbr(acc_no, row - amount)
+                        balance = before - amount
+                    else:
+                        before = __class__.getAccountInfo(dbObj, acc_no, balanceOnly=True, lock=True)
+                        balance = self.changeBalanceMain(dbObj, acc_no, before, amount, action)
+                    if balance != before: dbObj.addLedgerEntries([ledgerEntry(newKey(), acc_no, action, before, balance)])
+                    storeResult(dbObj, key, request, balance)
+                    saveTransaction(dbObj)
+                    self.invalidate(acc_no)
+                    self.remember(key, request, balance)
+                    
+                    printStatus(STATUS_COMP, DEBUG)
+                    logging.debug("%s (Account Id: %s) was successful", action, acc_no)
+                    
+                    return balance
+                except Exception as e:
+                    rollbackTransaction(dbObj)
+                    countLockError(e)
+                    logging.error(e)
+                    replayed, balance = self.replay(key, request, dbObj, force=True)
+                    if replayed: return balance
+        except IdempotencyCache.KeyReused:
+            raise
         except Exception as e:
-            rollbackTransaction(self.dbObj)
             logging.error(e)
         
         # Deposit failure
         printStatus(STATUS_ERROR, DEBUG)
         return False
     
-    def deposit(self, acc_no, deposit_amount, v=VERBOSE_MAIN_FUNCTIONS):
+    @METRICS.operation("deposit")
+    def deposit(self, acc_no, deposit_amount, v=VERBOSE_MAIN_FUNCTIONS, key=None):
         # Deposit
         ## Run changeBalance on account
-        return self.changeBalance(acc_no, deposit_amount, 'deposit')
+        return self.changeBalance(acc_no, deposit_amount, 'deposit', key=key)
 
-    def withdraw(self, acc_no, withdraw_amount, v=VERBOSE_MAIN_FUNCTIONS):
+    @METRICS.operation("withdraw")
+    def withdraw(self, acc_no, withdraw_amount, v=VERBOSE_MAIN_FUNCTIONS, key=None):
         # Withdraw
         ## Run changeBalance on account
-        return self.changeBalance(acc_no, withdraw_amount, action='withdraw')
+        return self.changeBalance(acc_no, withdraw_amount, action='withdraw', key=key)
 
-    def transfer(self, src_acc_no, trgt_acc_no, transfer_amount, v=VERBOSE_MAIN_FUNCTIONS):
+    @METRICS.operation("transfer")
+    def transfer(self, src_acc_no, trgt_acc_no, transfer_amount, v=VERBOSE_MAIN_FUNCTIONS, mode=None, key=None):
         # Transfer
-        ## Check if amount is a valid input
+        ## Check if amount is a valid input: a positive int in minor units - ValueError before any write
+        ## if key was already committed return its result (raise KeyReused if it was for another request)
+        ## Take the current FX rate table (before the session: loading it borrows one of its own)
         ## Begin SQL transction
-        ## Retrieve account information for source and target account
-        ## Perform arithmetic operations on balance
+        ## Move the money with the locked or conditional transfer path (mode defaults to self.transferMode),
+        ## or the striped path if either account is striped
+        ##     transfer_amount is in the source currency; the target is credited it converted to its own currency
+        ## Record both legs in the transactions ledger under one ledger key (and store key with the result)
         ## Commit/save transaction to database
         ## if there is an error
         ##     rollback transactions
+        ##     return the original result if the key was committed meanwhile
+        ##     run the transaction again (with backoff) if it was a deadlock or lock wait timeout
+        ## switch reports how far the transfer got (TRANSFER_ERRORS): 0 - source account error, 1 - target account error,
+        ##     2 - both accounts were fine but the transfer was declined (insufficient funds, no FX rate, database error)
         printStatus(STATUS_LOAD, DEBUG)
         
         if v:
@@ -301,33 +713,563 @@ class Bank():
             print(f"target_acc_no: {trgt_acc_no}")
             print(f"deposit_amount: {transfer_amount}")
         
+        mode = mode or self.transferMode
+        entryKey = newKey()
         switch = 0
         try:
+            FxRates.checkMinor(transfer_amount)
             assert(transfer_amount > 0)
+            if int(src_acc_no) == int(trgt_acc_no): raise ValueError("Source and target account are the same", src_acc_no)
+            request = requestOf("transfer", int(src_acc_no), int(trgt_acc_no), transfer_amount)
+            replayed, result = self.replay(key, request)
+            if replayed: return result
+            fx = self.fx.table()
             
-            startTransaction(self.dbObj)
-            src_name, src_balance, src_open_date = __class__.getAccountInfo(self.dbObj, src_acc_no, lock=True)
-            switch += 1
-            trgt_name, trgt_balance, trgt_open_date = __class__.getAccountInfo(self.dbObj, trgt_acc_no, lock=True)
-            switch += 1
-            
-            src_balance  = self.changeBalanceMain(src_acc_no, src_balance, transfer_amount, 'withdraw')
-            trgt_balance = self.changeBalanceMain(trgt_acc_no, trgt_balance, transfer_amount, 'deposit')
-            saveTransaction(self.dbObj)
-
-            printStatus(STATUS_COMP, DEBUG)
-            logging.debug(f"transfer from (Account Id: {src_acc_no}) to (Account Id: {trgt_acc_no}) was successful")
-            
-            return (src_name, trgt_name, src_balance, trgt_balance)
+            for attempt in range(DEADLOCK_RETRIES + 1):
+                with self.dbObj.borrow() as dbObj:
+                    try:
+                        startTransaction(dbObj)
+                        if self.stripeCount(src_acc_no) or self.stripeCount(trgt_acc_no):
+                            result = self.transferStriped(dbObj, src_acc_no, trgt_acc_no, transfer_amount, fx)
+                        elif mode == TRANSFER_CONDITIONAL: result = self.transferConditional(dbObj, src_acc_no, trgt_acc_no, transfer_amount, fx)
+                        else: result = self.transferLocked(dbObj, src_acc_no, trgt_acc_no, transfer_amount, fx)
+                        result, credit = result[:4], result[4]
+                        src_balance, trgt_balance = result[2:]
+                        dbObj.addLedgerEntries([ledgerEntry(entryKey, src_acc_no, "transfer_out", src_balance + transfer_amount, src_balance),
+                                                ledgerEntry(entryKey, trgt_acc_no, "transfer_in", trgt_balance - credit, trgt_balance)])
+                        storeResult(dbObj, key, request, result)
+                        saveTransaction(dbObj)
+                        self.invalidate(src_acc_no, trgt_acc_no)
+                        self.remember(key, request, result)
+                        
+                        printStatus(STATUS_COMP, DEBUG)
+                        logging.debug("transfer from (Account Id: %s) to (Account Id: %s) was successful", src_acc_no, trgt_acc_no)
+                        
+                        return result
+                    except Exception as e:
+                        rollbackTransaction(dbObj)
+                        countLockError(e)
+                        replayed, replayedResult = self.replay(key, request, dbObj, force=True)
+                        if replayed: return replayedResult
+                        if not isRetryable(e) or attempt == DEADLOCK_RETRIES: raise
+                        self.countRetry("transfer")
+                        logging.warning("transfer from (Account Id: %s) to (Account Id: %s) retrying after: %s", src_acc_no, trgt_acc_no, e)
+                retryBackoff(attempt)
+        except IdempotencyCache.KeyReused:
+            raise
+        except ValueError as e:
+            # Account does not exist / insufficient funds / amount converts to 0 - e.args[1] is the offending account
+            if len(e.args) > 1 and int(e.args[1]) != int(src_acc_no): switch = 1
+            elif len(e.args) > 1 and (e.args[0] == "Insufficient funds" or str(e.args[0]).startswith("Amount converts to 0")): switch = 2
+            logging.error(e)
         except Exception as e:
-            rollbackTransaction(self.dbObj)
+            if not isinstance(e, AssertionError): switch = 2
             logging.error(e)
         
         # Transfer failure
         printStatus(STATUS_ERROR, DEBUG)
         
         return (False, switch)
+    
+    @staticmethod
+    def getAccountsInfo(dbObj, acc_nos, lock=False):
+        # getAccountsInfo - static method
+        ## Retrieve name, balance and currency for several accounts with one statement
+        ## Rows are locked in account number order, so two transactions never wait on each other in a cycle
+        ## Return {account number: (name, balance, currency)} - missing accounts are left out
+        if lock: METRICS.inc("bank_rows_locked_total", value=len(acc_nos))
+        return {acc_no: (name, balance, currency) for acc_no, name, balance, currency in dbObj.selectRowsByAccNbrs(acc_nos, lock)}
+    
+    # Transfer paths return (src_name, trgt_name, src_balance, trgt_balance, amount credited to the target)
+    
+    def transferLocked(self, dbObj, src_acc_no, trgt_acc_no, amount, fx=None):
+        # transferLocked
+        ## Lock source and target rows with one ordered SELECT ... FOR UPDATE
+        ## Check the source can cover the amount
+        ## Convert the amount to the target's currency (creditAmount, with the FX table fx)
+        ## Write both balances back with one UPDATE
+        src_acc_no, trgt_acc_no = int(src_acc_no), int(trgt_acc_no)
+        rows = __class__.getAccountsInfo(dbObj, (src_acc_no, trgt_acc_no), lock=True)
+        for acc_no in (src_acc_no, trgt_acc_no):
+            if acc_no not in rows: raise ValueError("Account does not exist", acc_no)
+        
+        (src_name, src_balance, src_currency), (trgt_name, trgt_balance, trgt_currency) = rows[src_acc_no], rows[trgt_acc_no]
+        if src_balance < amount: raise ValueError("Insufficient funds", src_acc_no)
+        credit = self.creditAmount(src_acc_no, amount, src_currency, trgt_currency, fx)
+        
+        src_balance, trgt_balance = src_balance - amount, trgt_balance + credit
+        dbObj.updateBalancesByAccNbrs({src_acc_no: src_balance, trgt_acc_no: trgt_balance})
+        return (src_name, trgt_name, src_balance, trgt_balance, credit)
+    
+    def transferConditional(self, dbObj, src_acc_no, trgt_acc_no, amount, fx=None):
+        # transferConditional
+        ## Apply the transfer with one conditional UPDATE (no SELECT ... FOR UPDATE beforehand)
+        ## Read back names, new balances and currencies of the rows this transaction already holds
+        ## if fewer than two rows changed
+        ##     find out which account was missing or short of funds (failure path only)
+        ## Between currencies the UPDATE credited the unconverted amount: set the target to the converted
+        ## credit with one more UPDATE of the row this transaction holds
+        src_acc_no, trgt_acc_no = int(src_acc_no), int(trgt_acc_no)
+        METRICS.inc("bank_rows_locked_total", value=2)
+        changed = dbObj.transferByAccNbrs(src_acc_no, trgt_acc_no, amount)
+        rows = __class__.getAccountsInfo(dbObj, (src_acc_no, trgt_acc_no))
+        
+        if changed != 2:
+            for acc_no in (src_acc_no, trgt_acc_no):
+                if acc_no not in rows: raise ValueError("Account does not exist", acc_no)
+            raise ValueError("Insufficient funds", src_acc_no)
+        
+        (src_name, src_balance, src_currency), (trgt_name, trgt_balance, trgt_currency) = rows[src_acc_no], rows[trgt_acc_no]
+        credit = amount
+        if src_currency != trgt_currency:
+            credit = self.creditAmount(src_acc_no, amount, src_currency, trgt_currency, fx)
+            trgt_balance += credit - amount
+            dbObj.updateBalanceByAccNbr(trgt_acc_no, trgt_balance)
+        return (src_name, trgt_name, src_balance, trgt_balance, credit)
+    
+    def transferStriped(self, dbObj, src_acc_no, trgt_acc_no, amount, fx=None):
+        # transferStriped
+        ## Lock the source row, and the target row unless the target is striped, in account number order
+        ## Debit the source row (a striped source sweeps its stripes in first if the row is short)
+        ## Credit the target row, or one random stripe of a striped target without locking its row,
+        ## with the amount converted to the target's currency
+        ## Balances returned for striped accounts are row plus stripes
+        src_acc_no, trgt_acc_no = int(src_acc_no), int(trgt_acc_no)
+        trgtStriped = self.stripeCount(trgt_acc_no) > 0
+        rows = __class__.getAccountsInfo(dbObj, (src_acc_no,) if trgtStriped else (src_acc_no, trgt_acc_no), lock=True)
+        if trgtStriped: rows.update(__class__.getAccountsInfo(dbObj, (trgt_acc_no,)))
+        for acc_no in (src_acc_no, trgt_acc_no):
+            if acc_no not in rows: raise ValueError("Account does not exist", acc_no)
+        
+        (src_name, src_row, src_currency), (trgt_name, trgt_balance, trgt_currency) = rows[src_acc_no], rows[trgt_acc_no]
+        if self.stripeCount(src_acc_no): src_balance, src_row = self.debitStriped(dbObj, src_acc_no, src_row, amount)
+        elif src_row < amount: raise ValueError("Insufficient funds", src_acc_no)
+        else: src_balance = src_row
+        credit = self.creditAmount(src_acc_no, amount, src_currency, trgt_currency, fx)
+        
+        if trgtStriped:
+            dbObj.updateBalanceByAccNbr(src_acc_no, src_row - amount)
+            trgt_balance = self.creditStriped(dbObj, trgt_acc_no, credit)[1]
+        else:
+            trgt_balance += credit
+            dbObj.updateBalancesByAccNbrs({src_acc_no: src_row - amount, trgt_acc_no: trgt_balance})
+        return (src_name, trgt_name, src_balance - amount, trgt_balance, credit)
+    
+    def creditAmount(self, src_acc_no, amount, src_currency, trgt_currency, fx=None):
+        # creditAmount
+        ## amount (minor units of src_currency) as credited to an account in trgt_currency: itself within one currency,
+        ## converted with the FX table fx (the cache's current table if not given) between two
+        ## Raise LookupError if there is no rate for the pair, ValueError if the amount converts to nothing
+        if src_currency == trgt_currency: return amount
+        credit = self.fx.convert(amount, src_currency, trgt_currency, fx)
+        if credit <= 0: raise ValueError(f"Amount converts to 0 {trgt_currency}", src_acc_no)
+        METRICS.inc("bank_fx_conversions_total")
+        return credit
+    
+    ########### FX rates ############
+    
+    def setFxRates(self, rates):
+        # setFxRates
+        ## rates are (base, quote, rate) rows: rate units of quote per unit of base, as a Decimal or decimal text
+        ## start SQL transaction, insert or replace the rows in fx_rates, commit
+        ## Reload the rate cache of this Bank; other processes reload theirs within FX_TTL seconds (or refreshFxRates)
+        ## Return the version of the reloaded table, False on error
+        try:
+            rows = [(FxRates.checkCurrency(base), FxRates.checkCurrency(quote), decimal.Decimal(str(rate))) for base, quote, rate in rates]
+            for base, quote, rate in rows:
+                if base == quote or not (rate.is_finite() and rate > 0): raise ValueError(f"Invalid FX rate {base}/{quote}: {rate}")
+            with self.dbObj.borrow() as dbObj:
+                try:
+                    startTransaction(dbObj)
+                    if rows: dbObj.replaceFxRates(rows)
+                    saveTransaction(dbObj)
+                except Exception:
+                    rollbackTransaction(dbObj)
+                    raise
+            logging.info("Stored %d FX rates", len(rows))
+            return self.refreshFxRates()
+        except Exception as e:
+            logging.error(e)
+        return False
+    
+    def refreshFxRates(self):
+        # refreshFxRates
+        ## Reload the rate cache now - run after another process changed the rates; return the table's version
+        return self.fx.refresh().version
+    
+    ########### Striped accounts ############
+    
+    def stripeAccount(self, acc_no, stripes):
+        # stripeAccount
+        ## Give an account stripes credit stripes (0 - back to its single row)
+        ## Credits to a striped account go to one random stripe row, so concurrent credits to a hot account
+        ## no longer queue on its row lock; debits come out of the row, which sweeps the stripes in when it runs short
+        ## start SQL transaction, lock the row, sweep the current stripes into it and replace them, commit
+        ## Return stripes, False on error
+        try:
+            assert(stripes >= 0)
+            with self.dbObj.borrow() as dbObj:
+                try:
+                    startTransaction(dbObj)
+                    row = __class__.getAccountInfo(dbObj, acc_no, balanceOnly=True, lock=True)
+                    self.sweepStripes(dbObj, acc_no, row)
+                    dbObj.deleteStripes(acc_no)
+                    if stripes: dbObj.addStripes(acc_no, stripes)
+                    saveTransaction(dbObj)
+                except Exception:
+                    rollbackTransaction(dbObj)
+                    raise
+            counts = dict(self.loadStripes())
+            if stripes: counts[int(acc_no)] = stripes
+            else: counts.pop(int(acc_no), None)
+            self.stripes = counts
+            self.invalidate(acc_no)
+            logging.debug("Account %s now has %d stripes", acc_no, stripes)
+            return stripes
+        except Exception as e:
+            logging.error(e)
+        return False
+    
+    def loadStripes(self):
+        # loadStripes
+        ## Striped accounts, read on first use and reloaded by the first caller after stripesTtl seconds, like FxRates:
+        ## the other threads keep using the previous map meanwhile
+        stripes = self.stripes
+        if stripes is not None and (self.stripesTtl is None or time.monotonic() < self.stripesDue): return stripes
+        if self.stripesLock.acquire(blocking=stripes is None):
+            try:
+                if self.stripes is stripes: self.refreshStripes()
+            finally:
+                self.stripesLock.release()
+        return self.stripes
+    
+    def refreshStripes(self):
+        # refreshStripes
+        ## Read which accounts are striped now - run after another process striped an account, or by loadStripes
+        ## Without the account_stripes table (MySQL schema from before striping) no account is striped
+        self.stripesDue = time.monotonic() + (self.stripesTtl or 0.0)
+        try:
+            with self.dbObj.borrow() as dbObj: self.stripes = dbObj.selectStripeCounts()
+        except Exception as e:
+            logging.warning(f"Striped accounts could not be read: {e}")
+            self.stripes = {}
+        return self.stripes
+    
+    def stripeCount(self, acc_no):
+        return self.loadStripes().get(int(acc_no), 0)
+    
+    def creditStriped(self, dbObj, acc_no, amount):
+        # creditStriped
+        ## Add amount to one random stripe - only that stripe row is locked
+        ## If the stripes are gone (the account was unstriped by another process) credit the locked row instead
+        ## Return (balance before, balance after) as this transaction sees them: row plus stripes
+        if not dbObj.creditStripe(acc_no, random.randint(1, self.stripeCount(acc_no)), amount):
+            row = __class__.getAccountInfo(dbObj, acc_no, balanceOnly=True, lock=True)
+            dbObj.updateBalanceByAccNbr(acc_no, row + amount)
+        after = dbObj.selectStripedBalance(acc_no)
+        return after - amount, after
+    
+    def debitStriped(self, dbObj, acc_no, row, amount):
+        # debitStriped
+        ## row is the locked row balance of a striped account
+        ## When the row alone cannot cover amount, sweep the stripes into it
+        ## Raise ValueError("Insufficient funds") if row and stripes together cannot cover amount
+        ## Return (balance before, row balance to debit) - the caller writes the row
+        ## While the row is locked only credits can change the stripes, so row plus stripes read now is never
+        ## more than the account holds - the debit cannot take the account below 0
+        if row < amount: row = self.sweepStripes(dbObj, acc_no, row)
+        if row < amount: raise ValueError("Insufficient funds", acc_no)
+        return row + dbObj.sumStripes(acc_no), row
+    
+    def sweepStripes(self, dbObj, acc_no, row):
+        # sweepStripes
+        ## Lock the stripes of an account whose row is locked, add them to the row and set them to 0
+        ## Return the new row balance
+        swept = sum(balance for stripe, balance in dbObj.selectStripes(acc_no, lock=True))
+        if not swept: return row
+        dbObj.clearStripes(acc_no)
+        dbObj.updateBalanceByAccNbr(acc_no, row + swept)
+        METRICS.inc("bank_stripe_sweeps_total")
+        return row + swept
 
+    @METRICS.operation("applyBatch")
+    def applyBatch(self, ops, chunkSize=BATCH_CHUNK_SIZE, v=VERBOSE_MAIN_FUNCTIONS, key=None):
+        # applyBatch
+        ## ops is an iterable of operations:
+        ##     ('deposit', acc_no, amount), ('withdraw', acc_no, amount), ('transfer', src_acc_no, trgt_acc_no, amount)
+        ## Read ops chunkSize at a time and apply each chunk in its own transaction
+        ## Return one (True, result) or (False, reason) entry per operation, in order
+        ##     result is the new balance, or (src_balance, trgt_balance) for a transfer
+        ## With a key, chunk n is stored under "key:n" - a retried batch (same ops and chunkSize)
+        ## replays the chunks that were committed and applies only the rest; a key used for other ops raises KeyReused
+        printStatus(STATUS_LOAD, DEBUG)
+        
+        results = []
+        ops = iter(ops)
+        for n in itertools.count():
+            chunk = list(itertools.islice(ops, chunkSize))
+            if not chunk: break
+            results.extend(self.applyChunk(chunk, key=f"{key}:{n}" if key is not None else None))
+        
+        if v: print(f"batch: {sum(ok for ok, _ in results)} of {len(results)} operations applied")
+        printStatus(STATUS_COMP, DEBUG)
+        logging.debug("batch of %d operations finished", len(results))
+        return results
+    
+    @staticmethod
+    def parseOperation(op):
+        # parseOperation - static method
+        ## Validate a batch operation and return (action, account numbers, amount)
+        ## Raise ValueError describing why the operation is invalid (amount must be a positive int in minor units)
+        action = op[0] if op else None
+        if action in ('deposit', 'withdraw') and len(op) == 3: accounts, amount = (int(op[1]),), op[2]
+        elif action == 'transfer' and len(op) == 4:
+            accounts, amount = (int(op[1]), int(op[2])), op[3]
+            if accounts[0] == accounts[1]: raise ValueError("Source and target account are the same")
+        else: raise ValueError(f"Unknown operation: {op!r}")
+        
+        if not FxRates.checkMinor(amount) > 0: raise ValueError(f"Amount must be positive: {amount!r}")
+        return action, accounts, amount
+    
+    def applyChunk(self, ops, key=None):
+        # applyChunk
+        ## if key was already committed return its results (raise KeyReused if it was for other operations)
+        ## Validate every operation and collect the accounts they touch
+        ## start SQL transaction
+        ## Take the current FX rate table (before the session: loading it borrows one of its own)
+        ## Lock all touched accounts with one SELECT ... IN (...) FOR UPDATE
+        ##     striped accounts the chunk debits are swept into their rows; the stripes of the others are added to
+        ##     their balances, and credits to them go to the locked row
+        ## Convert the amounts of every transfer between two currencies in one pass over the chunk (FxRates.convertMany)
+        ## Apply the operations in order against the locked balances in memory
+        ##     an operation on a missing account, one that would overdraw or a transfer without an FX rate fails on its own
+        ## Write the changed balances back with one CASE update
+        ## Append the ledger entries of every applied operation with multi-row INSERTs
+        ## Store key with the results and commit
+        ## if there is a database error
+        ##     rollback transaction
+        ##     return the original results if the key was committed meanwhile
+        ##     run the chunk again (with backoff) if it was a deadlock or lock wait timeout
+        ##     otherwise fail every operation in the chunk
+        request = requestOf("applyBatch", ops) if key is not None else None
+        replayed, results = self.replay(key, request)
+        if replayed: return list(results)
+        
+        results = [None] * len(ops)
+        parsed = [None] * len(ops)
+        keys = [newKey() for _ in ops]
+        touched, debited = set(), set()
+        for i, op in enumerate(ops):
+            try:
+                parsed[i] = __class__.parseOperation(op)
+                touched.update(parsed[i][1])
+                if parsed[i][0] != 'deposit': debited.add(parsed[i][1][0])
+            except (ValueError, TypeError, IndexError) as e:
+                results[i] = (False, str(e))
+        if not touched: return results
+        
+        try:
+            fx = self.fx.table()
+            for attempt in range(DEADLOCK_RETRIES + 1):
+                with self.dbObj.borrow() as dbObj:
+                    try:
+                        startTransaction(dbObj)
+                        rows = __class__.getAccountsInfo(dbObj, sorted(touched), lock=True)
+                        balances = {acc_no: balance for acc_no, (name, balance, currency) in rows.items()}
+                        currencies = {acc_no: currency for acc_no, (name, balance, currency) in rows.items()}
+                        stripes = {}
+                        for acc_no in sorted(acc_no for acc_no in balances if self.stripeCount(acc_no)):
+                            if acc_no in debited: balances[acc_no] = self.sweepStripes(dbObj, acc_no, balances[acc_no])
+                            else: stripes[acc_no] = dbObj.sumStripes(acc_no)
+                        for acc_no, total in stripes.items(): balances[acc_no] += total
+                        original = dict(balances)
+                        entries = []
+                        
+                        # Amounts credited by transfers between two currencies, in minor units of the target
+                        crossing = [i for i, op in enumerate(parsed) if op is not None and op[0] == 'transfer'
+                                    and all(acc_no in currencies for acc_no in op[1]) and currencies[op[1][0]] != currencies[op[1][1]]]
+                        converted = self.fx.convertMany([(parsed[i][2], currencies[parsed[i][1][0]], currencies[parsed[i][1][1]]) for i in crossing], fx)
+                        credits = dict(zip(crossing, converted))
+                        if crossing: METRICS.inc("bank_fx_conversions_total", value=len(crossing))
+                        
+                        for i, op in enumerate(parsed):
+                            if op is None: continue
+                            action, accounts, amount = op
+                            credit = credits.get(i, amount)
+                            
+                            missing = [acc_no for acc_no in accounts if acc_no not in balances]
+                            if missing:
+                                results[i] = (False, f"Account {missing[0]} does not exist")
+                            elif credit is None:
+                                results[i] = (False, f"No FX rate for {currencies[accounts[0]]}/{currencies[accounts[1]]}")
+                            elif credit <= 0:
+                                results[i] = (False, f"Amount converts to 0 {currencies[accounts[1]]}")
+                            elif action != 'deposit' and balances[accounts[0]] < amount:
+                                results[i] = (False, f"Insufficient funds in account {accounts[0]}")
+                            elif action == 'deposit':
+                                balances[accounts[0]] += amount
+                                entries.append(ledgerEntry(keys[i], accounts[0], action, balances[accounts[0]] - amount, balances[accounts[0]]))
+                                results[i] = (True, balances[accounts[0]])
+                            elif action == 'withdraw':
+                                balances[accounts[0]] -= amount
+                                entries.append(ledgerEntry(keys[i], accounts[0], action, balances[accounts[0]] + amount, balances[accounts[0]]))
+                                results[i] = (True, balances[accounts[0]])
+                            else:
+                                balances[accounts[0]] -= amount
+                                balances[accounts[1]] += credit
+                                entries.append(ledgerEntry(keys[i], accounts[0], "transfer_out", balances[accounts[0]] + amount, balances[accounts[0]]))
+                                entries.append(ledgerEntry(keys[i], accounts[1], "transfer_in", balances[accounts[1]] - credit, balances[accounts[1]]))
+                                results[i] = (True, (balances[accounts[0]], balances[accounts[1]]))
+                        
+                        changed = {acc_no: balance - stripes.get(acc_no, 0) for acc_no, balance in balances.items() if balance != original[acc_no]}
+                        if changed: dbObj.updateBalancesByAccNbrs(changed)
+                        if entries: dbObj.addLedgerEntries(entries)
+                        storeResult(dbObj, key, request, results)
+                        saveTransaction(dbObj)
+                        self.invalidate(*changed)
+                        self.remember(key, request, tuple(results))
+                        
+                        logging.debug("batch chunk of %d operations locked %d accounts and updated %d", len(ops), len(touched), len(changed))
+                        return results
+                    except Exception as e:
+                        rollbackTransaction(dbObj)
+                        countLockError(e)
+                        replayed, replayedResults = self.replay(key, request, dbObj, force=True)
+                        if replayed: return list(replayedResults)
+                        if not isRetryable(e) or attempt == DEADLOCK_RETRIES: raise
+                        self.countRetry("applyBatch")
+                        logging.warning("batch chunk retrying after: %s", e)
+                retryBackoff(attempt)
+        except IdempotencyCache.KeyReused:
+            raise
+        except Exception as e:
+            logging.error(e)
+            reason = f"Batch chunk failed: {e}"
+        
+        return [(False, reason) if result is None or result[0] else result for result in results]
+    
+    def history(self, acc_no, pageSize=LEDGER_PAGE_SIZE, after=None, until=None):
+        # history - generator
+        ## Yield the ledger rows of an account, oldest first:
+        ##     (id, ts, idempotency_key, kind, amount, balance_before, balance_after)
+        ## Pages are read with keyset pagination on (ts, id), each with its own short-lived session,
+        ## so a long statement never holds a connection while the caller consumes it
+        ## after: (ts, id) of the last row already seen, to resume a previous scan
+        ## until: stop after the rows at this timestamp
+        while True:
+            with self.dbObj.borrow() as dbObj:
+                page = dbObj.selectLedgerPage(acc_no, after, pageSize, until)
+            yield from page
+            if len(page) < pageSize: return
+            after = (page[-1][1], page[-1][0])
+    
+    def takeSnapshot(self, lag=None, pageSize=LEDGER_PAGE_SIZE):
+        # takeSnapshot
+        ## The cutoff is lag seconds before the database's clock - longer than any transaction runs, so no
+        ## ledger entry stamped before it can still be uncommitted
+        ## Scan the ledger entries between the last snapshot and the cutoff on the (ts, id) index and add up
+        ## the amounts of every account seen - the work is proportional to the changes, not the accounts
+        ## Each changed account's snapshot is its previous snapshot plus those amounts: balance_after is not used,
+        ## since credits to a striped account log it from a view of the other stripes that may be stale
+        ## Insert one snapshot per changed account, stamped with the cutoff, and commit
+        ## Return the number of snapshots written, False on error
+        lag = SNAPSHOT_LAG if lag is None else lag
+        try:
+            with self.dbObj.borrow() as dbObj:
+                try:
+                    startTransaction(dbObj)
+                    cutoff = dbObj.now(-lag)
+                    watermark = dbObj.selectSnapshotWatermark()
+                    if watermark is not None and watermark >= cutoff:
+                        rollbackTransaction(dbObj)
+                        return 0
+                    
+                    latest = {}     # acc_no -> (last ledger id, sum of amounts since the last snapshot)
+                    after = (watermark, Storage.LEDGER_LAST_ID) if watermark is not None else None
+                    while True:
+                        page = dbObj.selectLedgerChanges(after, cutoff, pageSize)
+                        for row_id, ts, acc_no, amount in page: latest[acc_no] = (row_id, latest.get(acc_no, (0, 0))[1] + int(amount))
+                        if len(page) < pageSize: break
+                        after = (page[-1][1], page[-1][0])
+                    
+                    rows = []
+                    for acc_no, (row_id, total) in latest.items():
+                        previous = dbObj.selectSnapshotAsOf(acc_no, watermark) if watermark is not None else None
+                        rows.append((acc_no, cutoff, row_id, (previous[2] if previous else 0) + total))
+                    if rows: dbObj.addSnapshots(rows)
+                    saveTransaction(dbObj)
+                    logging.info("Snapshot as of %s: %d accounts changed since %s", cutoff, len(latest), watermark)
+                    return len(latest)
+                except Exception as e:
+                    rollbackTransaction(dbObj)
+                    logging.error(e)
+        except Exception as e:
+            logging.error(e)
+        return False
+    
+    def balanceAsOf(self, acc_no, ts):
+        # balanceAsOf
+        ## Start from the account's latest snapshot at or before ts and add the amounts of the ledger entries
+        ## between it and ts (one range on the (account_no, ts) index); without a snapshot, every entry up to ts
+        ## balance_after is not used: credits to a striped account log it from a possibly stale view of the other stripes
+        ## With neither, the account had no entry by ts: the balance before its first later entry, or its
+        ## current balance if it never changed
+        ## Return False if the account does not exist or on error
+        try:
+            with self.dbObj.borrow() as dbObj:
+                snapshot = dbObj.selectSnapshotAsOf(acc_no, ts)
+                entries, total = dbObj.selectLedgerSum(acc_no, snapshot[0] if snapshot else None, ts)
+                if snapshot is not None: return snapshot[2] + total
+                if entries: return total
+                later = dbObj.selectLedgerPage(acc_no, (ts, Storage.LEDGER_LAST_ID), 1)
+                if later: return later[0][5]
+                balance = dbObj.selectStripedBalance(acc_no) if self.stripeCount(acc_no) else dbObj.getBalance(acc_no)
+                if balance is not None: return balance
+                logging.error(f"The account, with id = {acc_no}, does not exist")
+        except Exception as e:
+            logging.error(e)
+        return False
+    
+    def statement(self, acc_no, start, end, pageSize=LEDGER_PAGE_SIZE):
+        # statement
+        ## Opening balance from balanceAsOf(start), then the entries with start < ts <= end, read page by page
+        ## from the (account_no, ts) index - the cost depends on the activity in the period, not the account's age
+        ## Balances of the entries are the running total from the opening balance, like balanceAsOf
+        ## Return {"account_no", "start", "end", "opening", "closing", "credits", "debits", "entries"}
+        ## (entries are ledger rows as yielded by history), False if the account does not exist or on error
+        opening = self.balanceAsOf(acc_no, start)
+        if opening is False: return False
+        try:
+            entries, balance = [], opening
+            for row_id, ts, key, kind, amount, before, after in self.history(acc_no, pageSize, after=(start, Storage.LEDGER_LAST_ID), until=end):
+                entries.append((row_id, ts, key, kind, amount, balance, balance + amount))
+                balance += amount
+        except Exception as e:
+            logging.error(e)
+            return False
+        return {"account_no": int(acc_no), "start": start, "end": end, "opening": opening, "closing": balance,
+                "credits": sum(entry[4] for entry in entries if entry[4] > 0),
+                "debits": -sum(entry[4] for entry in entries if entry[4] < 0),
+                "entries": entries}
+    
+    def getStats(self):
+        # getStats
+        ## {"pool": storage counters, "cache": balance cache counters (if any), "idempotency": key cache counters,
+        ##  "group_commit": group commit counters (if any), "fx": FX rate cache version and counters}
+        stats = {"pool": self.dbObj.getStats()}
+        if self.cache is not None: stats["cache"] = self.cache.getStats()
+        stats["idempotency"] = self.keys.getStats()
+        if self.group is not None: stats["group_commit"] = self.group.getStats()
+        stats["fx"] = self.fx.getStats()
+        return stats
+    
+    def exportMetrics(self):
+        # exportMetrics
+        ## Prometheus text of the metrics registry with getStats as gauges
+        stats = self.getStats()
+        return METRICS.prometheus(Metrics.gauges(storage=stats["pool"], cache=stats.get("cache"), idempotency=stats["idempotency"],
+                                                 group_commit=stats.get("group_commit"), fx=stats["fx"]))
+    
     
 ########## Connect to the Bank via a Session rather than directly (like an ATM) #############
 
@@ -337,6 +1279,8 @@ class Bank():
 ##    clearSessionVariables     ## Reset/Create session variables
 ##    getAccountInfo            ## Obtain Account Information for the associated account
 ##    getAccountNumber          ## Same functionality as getInput, but provides a pre-defined prefix and a unquie func name for readability
+##    getAmount                 ## Read a decimal amount in the account's currency as minor units
+##    formatBalance             ## Minor units as a decimal amount with its currency
 ##    printAccountInfo          ## Utilize tabulate module to create a table with the appropriate data
 ##    displayOptions            ## ## Display available functions the Bank has to offer to the customer
 ##    selectOptions             ## Run appropriate functions based on user input
@@ -347,18 +1291,19 @@ class Bank():
 ##    transfer                  ## Transfer from a source account to a target account
 class BankSession(Bank):
     
-    def __init__(self, databaseObject):
+    def __init__(self, databaseObject, cache=None):
         # __init__
-        ## inherit and add database connection object to the Bank superclass
+        ## inherit and add database connection object (and optional balance cache) to the Bank superclass
         ## Create session variables
         
-        super().__init__(databaseObject)
+        super().__init__(databaseObject, cache=cache)
         self.clearSessionVariables()
     
     def clearSessionVariables(self):
         # clearSessionVariables
         self.id = self.state = STATE_LOGGED_OUT
         self.name = self.open_date = ''
+        self.currency = DEFAULT_CURRENCY
     
     def getAccountInfo(self):
         # getAccountInfo
@@ -373,7 +1318,8 @@ class BankSession(Bank):
         while self.state != STATE_LOGGED_IN:
             self.id = self.getAccountNumber()
             try:
-                self.name, balance, self.open_date = Bank.getAccountInfo(self.dbObj, self.id)
+                with self.dbObj.borrow() as dbObj:
+                    self.name, balance, self.open_date, self.currency = Bank.getAccountInfo(dbObj, self.id, cache=self.cache)
                 self.state = STATE_LOGGED_IN
             except ValueError:
                 print("Account does not exist. Please try again.\n")
@@ -385,6 +1331,17 @@ class BankSession(Bank):
         # getAccountNumber
         return getInput(inputType=int, prefix=string, sep=": ")
 
+    def getAmount(self, string="Amount", currency=None):
+        # getAmount
+        ## Same as getInput, for a decimal amount ("12.34") in currency (the account's by default); return it in minor units
+        currency = currency or self.currency
+        return getInput(inputType=lambda text: FxRates.toMinor(text, currency), prefix=f"{string} ({currency})", sep=": ")
+
+    def formatBalance(self, balance, currency=None):
+        # formatBalance
+        currency = currency or self.currency
+        return f"{FxRates.fromMinor(balance, currency)} {currency}"
+
     def printAccountInfo(self, IDs=[], names=[], balances=[], open_dates=[]):
         # printAccountInfo
         print(f'\n{tabulate.tabulate({"ID": IDs, "Name": names, "Balance": balances, "Open Date": open_dates}, headers="keys")}')
@@ -411,8 +1368,9 @@ class BankSession(Bank):
         if code == 1:
             self.clearSessionVariables()
             acc_name = getInput(str, "Enter an Account Name")
-            balance = getInput(prefix="Enter initial balance")
-            self.createAccount(acc_name, balance)
+            currency = getInput(lambda text: FxRates.checkCurrency(text or DEFAULT_CURRENCY), f"Enter a currency (blank for {DEFAULT_CURRENCY})")
+            balance = self.getAmount("Enter initial balance", currency)
+            self.createAccount(acc_name, balance, currency=currency)
             
         elif 1 < code < 6:
             # Get account information if not logged in
@@ -423,18 +1381,18 @@ class BankSession(Bank):
             
             # Deposit
             elif code == 3:
-                deposit_amount = getInput(prefix="Deposit Amount")
+                deposit_amount = self.getAmount("Deposit Amount")
                 self.deposit(deposit_amount)
                 
             # Withdraw
             elif code == 4:
-                withdraw_amount = getInput(prefix="Withdraw Amount")
+                withdraw_amount = self.getAmount("Withdraw Amount")
                 self.withdraw(withdraw_amount)
             
             # Transfer
             elif code == 5:
                 trgt_acc_no = self.getAccountNumber("Target Account Number")
-                transfer_amount = getInput(prefix="Transfer Amount")
+                transfer_amount = self.getAmount("Transfer Amount")
                 self.transfer(trgt_acc_no, transfer_amount)
         # Log out       
         elif code == 9: self.clearSessionVariables()
@@ -447,12 +1405,12 @@ class BankSession(Bank):
         # Invalid code - print error message
         else: printString("Invalid code - Please try again", length=DEFAULT_PAGE_WIDTH)
         
-    def createAccount(self, name=DEFAULT_ACCOUNT_NAME, balance=DEFAULT_BALANCE, v=VERBOSE_MAIN_FUNCTIONS):
+    def createAccount(self, name=DEFAULT_ACCOUNT_NAME, balance=DEFAULT_BALANCE, v=VERBOSE_MAIN_FUNCTIONS, currency=DEFAULT_CURRENCY):
         # createAccount
         ## Run superclass version of createAccount
         ## Display appropriate result
         
-        if super().createAccount(name, balance, v): printString("Account successfully created", length=DEFAULT_PAGE_WIDTH)
+        if super().createAccount(name, balance, v, currency=currency): printString("Account successfully created", length=DEFAULT_PAGE_WIDTH)
         else: printString("Account creation unsuccessful", length=DEFAULT_PAGE_WIDTH)
         
     def checkBalance(self, v=VERBOSE_MAIN_FUNCTIONS):
@@ -461,7 +1419,7 @@ class BankSession(Bank):
         ## Display appropriate result
         
         balance = super().checkBalance(self.id, v)
-        if balance is not False: self.printAccountInfo([self.id], [self.name], [balance], [self.open_date])
+        if balance is not False: self.printAccountInfo([self.id], [self.name], [self.formatBalance(balance)], [self.open_date])
         else: printString("Check Balance unsuccessful", length=DEFAULT_PAGE_WIDTH)
     
     def deposit(self, deposit_amount, v=VERBOSE_MAIN_FUNCTIONS):
@@ -470,7 +1428,7 @@ class BankSession(Bank):
         ## Display appropriate result
         
         balance = super().deposit(self.id, deposit_amount, v)
-        if balance is not False: self.printAccountInfo([self.id], [self.name], [balance], [self.open_date])
+        if balance is not False: self.printAccountInfo([self.id], [self.name], [self.formatBalance(balance)], [self.open_date])
         else: printString("Deposit unsuccessful", length=DEFAULT_PAGE_WIDTH)
     
     def withdraw(self, withdraw_amount, v=VERBOSE_MAIN_FUNCTIONS):
@@ -479,19 +1437,21 @@ class BankSession(Bank):
         ## Display appropriate result
         
         balance = super().withdraw(self.id, withdraw_amount, v)
-        if balance is not False: self.printAccountInfo([self.id], [self.name], [balance], [self.open_date])
+        if balance is not False: self.printAccountInfo([self.id], [self.name], [self.formatBalance(balance)], [self.open_date])
         else: printString("Withdraw unsuccessful", length=DEFAULT_PAGE_WIDTH)
         
     def transfer(self, trgt_acc_no, transfer_amount, v=VERBOSE_MAIN_FUNCTIONS):
         # transfer
         ## Run superclass version of transfer
-        ## Display appropriate result
+        ## Display appropriate result (the target balance in the target's currency)
         
         balance = super().transfer(self.id, trgt_acc_no, transfer_amount, v)
-        if balance[0] is not False: self.printAccountInfo([self.id, trgt_acc_no], balance[:2], balance[2:], [self.open_date, 'N/A'])
+        if balance[0] is not False:
+            target = self.getAccount(trgt_acc_no)
+            balances = [self.formatBalance(balance[2]), self.formatBalance(balance[3], target[3]) if target else balance[3]]
+            self.printAccountInfo([self.id, trgt_acc_no], balance[:2], balances, [self.open_date, 'N/A'])
         else:
-            if balance[1] == 0: printString("Source Account error", length=DEFAULT_PAGE_WIDTH)
-            elif balance[1] == 1: printString("Target Account error", length=DEFAULT_PAGE_WIDTH)
+            if balance[1] in TRANSFER_ERRORS: printString(TRANSFER_ERRORS[balance[1]], length=DEFAULT_PAGE_WIDTH)
             printString("Transfer unsuccessful", length=DEFAULT_PAGE_WIDTH)
 
 
@@ -501,25 +1461,29 @@ class BankSession(Bank):
 def main():
     # main
     ### Generate the required objects for running the application
-    ## Connect to a MySQL database and generate an object to store all connection data
+    ## Read config.ini, then open the storage backend (a MySQL connection pool by default) shared by all Bank operations
     ## Generate the Bank Session object and check if there is a connection
     ## if no connection
     ##     do nothing
+    ## Check the query plans of the hot statements (warnings go to the log)
     ## loop until client likes to exit application
     ##     Display main bank functions
     ##     Get input of which function to run
     ##     Run the function
     
-    dbObject = MySQLConnector.mysqlDB(MYSQL_HOST, MYSQL_USERNAME, MYSQL_PASSWORD, MYSQL_DATABASE)
+    loadConfig()
+    dbObject = openStorage()
     
-    bankSession = BankSession(dbObject)
-    if bankSession.dbObj.getConnection() is False:
+    cache = BalanceCache.BalanceCache(CACHE_SIZE, CACHE_TTL) if CACHE_SIZE > 0 else None
+    bankSession = BankSession(dbObject, cache)
+    if not bankSession.dbObj.isConnected():
         printString("Connection to MySQL DB was UNSUCCESSFUL", length=DEFAULT_PAGE_WIDTH)
         return False
+    dbObject.checkPlans()
     
     CODE = -1
     # Connection to database was successful
-    while CODE and bankSession.dbObj.getConnection() is not False:
+    while CODE and bankSession.dbObj.isConnected():
         # Display the options
         # Get input based on how you want to interact with the BankSession application
         # Run a function (Create Account, Check Balance, Deposit, Withdraw, Transfer) or exit
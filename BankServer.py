@@ -0,0 +1,410 @@
+import Bank
+import Admission
+import IdempotencyCache
+import BalanceCache
+import ShardedBank
+import GroupCommit
+import Scheduler
+import MySQLConnector
+import concurrent.futures
+import urllib.parse
+import functools
+import inspect
+import http.server
+import threading
+import datetime
+import argparse
+import logging
+import json
+import math
+import time
+import re
+
+# Server defaults
+SERVER_HOST = "127.0.0.1"
+SERVER_PORT = 8080
+KEEPALIVE_TIMEOUT = 5     # seconds an idle keep-alive connection stays open
+MAX_CONNECTIONS = 256     # connection threads (idle keep-alive connections hold one); more accepted connections queue for a free thread
+MAX_BODY_SIZE = 1 << 20   # bytes
+
+
+########## Request handling ##########
+
+# RequestError - class
+### A request answered with status (and the message as its error) without running the endpoint
+class RequestError(Exception):
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+# decodeBody
+## JSON object of a request body ({} without one); raise RequestError for anything else
+def decodeBody(body):
+    if not body: return {}
+    try:
+        body = json.loads(body)
+    except ValueError:
+        raise RequestError(400, "Body is not valid JSON")
+    if not isinstance(body, dict): raise RequestError(400, "Body must be a JSON object")
+    return body
+
+# queryArguments
+## {name: value} of the params found in a query string; other parameters are ignored
+def queryArguments(query, params):
+    return {name: value for name, value in urllib.parse.parse_qsl(query) if name in params}
+
+# integerArg
+## int of the request argument name - a JSON integer or a string of digits; raise RequestError (400) for anything else
+## (a float or a boolean is not silently cut down to an int)
+def integerArg(name, value):
+    if isinstance(value, int) and not isinstance(value, bool): return value
+    if isinstance(value, str) and re.fullmatch(r"[0-9]+", value): return int(value)
+    raise RequestError(400, f"{name} must be an integer")
+
+# timestampArg
+## datetime of the ISO timestamp request argument name; raise RequestError (400) if it is not one
+def timestampArg(name, value):
+    try:
+        return datetime.datetime.fromisoformat(value)
+    except (ValueError, TypeError):
+        raise RequestError(400, f"{name} must be an ISO timestamp")
+
+# endpointSignature
+## inspect.Signature of a BankRequestHandler endpoint, computed once per endpoint
+@functools.lru_cache(maxsize=None)
+def endpointSignature(name):
+    return inspect.signature(getattr(BankRequestHandler, name))
+
+
+# BankRequestHandler - class
+### Maps JSON endpoints onto the Bank operations
+###     POST /accounts                   {"name": str, "balance": int, "currency": optional str}
+###     GET  /accounts/<acc_no>
+###     GET  /accounts/<acc_no>/balance  ?as_of=<ISO timestamp> for the balance at that time
+###     GET  /accounts/<acc_no>/statement?start=<ISO timestamp>&end=<ISO timestamp>
+###     POST /accounts/<acc_no>/deposit  {"amount": int}
+###     POST /accounts/<acc_no>/withdraw {"amount": int}
+###     POST /transfers                  {"source": int, "target": int, "amount": int, "mode": optional str}
+###     POST /batch                      {"ops": [["deposit", acc_no, amount], ...], "chunk_size": optional int}
+###     POST /schedules                  {"source": int, "target": int, "amount": int, "first_run": ISO timestamp,
+###                                       "period": "once"|"daily"|"weekly"|"monthly", "count": optional int}
+###     GET  /schedules/<id>
+###     POST /schedules/<id>/cancel
+###     GET  /stats
+###     GET  /metrics                    Prometheus text format
+### Timestamps are in the database's clock (UTC for SQLite)
+### Balances and amounts are integers in minor units of the account's currency; a transfer amount is in the source
+### account's currency
+### POST requests may carry an Idempotency-Key header: a retried request with the same key gets the
+### original reply instead of being applied twice; the key sent with a different request gets 422
+### Bank operations go through admission control ([ADMISSION] in config.ini); clients are told apart by their
+### X-Client-Id header (their address without one). A shed request gets 429 (rate limited) or 503 (overloaded)
+### with a Retry-After header
+### Connections are kept alive (HTTP/1.1) and every request is logged with its latency
+class BankRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    timeout = KEEPALIVE_TIMEOUT
+
+    # (method, path pattern, endpoint, query parameters passed to the endpoint - the query string of other routes is ignored)
+    ROUTES = [
+        ("POST", re.compile(r"^/accounts$"), "createAccount", ()),
+        ("GET",  re.compile(r"^/accounts/(\d+)$"), "getAccount", ()),
+        ("GET",  re.compile(r"^/accounts/(\d+)/balance$"), "checkBalance", ("as_of",)),
+        ("GET",  re.compile(r"^/accounts/(\d+)/statement$"), "statement", ("start", "end")),
+        ("POST", re.compile(r"^/accounts/(\d+)/deposit$"), "deposit", ()),
+        ("POST", re.compile(r"^/accounts/(\d+)/withdraw$"), "withdraw", ()),
+        ("POST", re.compile(r"^/transfers$"), "transfer", ()),
+        ("POST", re.compile(r"^/batch$"), "applyBatch", ()),
+        ("POST", re.compile(r"^/schedules$"), "schedulePayment", ()),
+        ("GET",  re.compile(r"^/schedules/(\d+)$"), "getPayment", ()),
+        ("POST", re.compile(r"^/schedules/(\d+)/cancel$"), "cancelPayment", ()),
+        ("GET",  re.compile(r"^/stats$"), "stats", ()),
+        ("GET",  re.compile(r"^/metrics$"), "metrics", ()),
+    ]
+
+    def do_GET(self):
+        self.dispatch("GET")
+
+    def do_POST(self):
+        self.dispatch("POST")
+
+    def dispatch(self, method):
+        # dispatch
+        ## Read the body first whatever the route, so an unknown route or a failed request leaves the keep-alive
+        ## connection at the start of the next request
+        ## Find the route for method and path
+        ## Decode the JSON body (and the query parameters the route declares), run the endpoint (call) in one of the server's request slots and send its JSON reply
+        ##     with read-your-writes for the client: its reads after a write it made are not served by a lagging replica
+        ## Log method, path, status and latency
+        start = time.perf_counter()
+        path, _, query = self.path.partition("?")
+        headers = {}
+        try:
+            body = self.readBody()
+            for route_method, pattern, name, params in self.ROUTES:
+                match = pattern.match(path)
+                if match and route_method == method:
+                    arguments = decodeBody(body)
+                    if params: arguments.update(queryArguments(query, params))
+                    with self.server.slots, self.server.storage.readYourWrites(self.clientId()):
+                        status, payload = self.call(name, match.groups(), arguments)
+                    break
+            else:
+                status, payload = 404, {"error": "Not found"}
+        except RequestError as e:
+            status, payload = e.status, {"error": str(e)}
+        except IdempotencyCache.KeyReused as e:
+            status, payload = 422, {"error": str(e)}
+        except Admission.Rejected as e:
+            status = 429 if e.reason == Admission.SHED_RATE_LIMITED else 503
+            payload, headers = {"error": str(e), "reason": e.reason}, {"Retry-After": str(max(1, math.ceil(e.retryAfter)))}
+        except Exception as e:
+            logging.error("%s %s failed: %r", method, path, e)
+            status, payload = 500, {"error": "Internal error"}
+
+        if isinstance(payload, str): self.sendText(status, payload)
+        else: self.sendJSON(status, payload, headers)
+        logging.info("%s %s %d %.2fms", method, path, status, (time.perf_counter() - start) * 1000)
+
+    def call(self, name, groups, arguments):
+        # call
+        ## Bind the path groups and request arguments to the parameters of endpoint name and run it
+        ## A missing or unknown argument is the client's error (400); anything the endpoint raises past its own
+        ## argument checks (integerArg, timestampArg) is an internal error (500)
+        try:
+            endpointSignature(name).bind(self, *groups, **arguments)
+        except TypeError as e:
+            raise RequestError(400, f"Bad request: {e}")
+        return getattr(self, name)(*groups, **arguments)
+
+    def readBody(self):
+        # readBody
+        ## Read all Content-Length bytes of the body
+        ## A body that cannot be read to its end (chunked, too large, bad or short Content-Length) closes the
+        ## connection after the reply instead
+        if "Transfer-Encoding" in self.headers:
+            self.close_connection = True
+            raise RequestError(411, "Content-Length required")
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            self.close_connection = True
+            raise RequestError(400, "Bad Content-Length")
+        if length > MAX_BODY_SIZE:
+            self.close_connection = True
+            raise RequestError(413, "Body too large")
+        body = self.rfile.read(length) if length else b""
+        if len(body) < length:
+            self.close_connection = True
+            raise RequestError(400, "Body shorter than Content-Length")
+        return body
+
+    def sendJSON(self, status, payload, headers=None):
+        self.sendBody(status, json.dumps(payload, default=str).encode(), "application/json", headers)
+
+    def sendText(self, status, text):
+        self.sendBody(status, text.encode(), "text/plain; version=0.0.4")
+
+    def sendBody(self, status, body, contentType, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", contentType)
+        self.send_header("Content-Length", str(len(body)))
+        if self.close_connection: self.send_header("Connection", "close")
+        for name, value in (headers or {}).items(): self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def idempotencyKey(self):
+        return self.headers.get("Idempotency-Key") or None
+
+    def clientId(self):
+        return self.headers.get("X-Client-Id") or self.client_address[0]
+
+    def log_message(self, format, *args):
+        # Requests are already logged with their latency by dispatch
+        logging.debug(format % args)
+
+    ########## Endpoints - return (HTTP status, JSON payload) ##########
+
+    def createAccount(self, name=Bank.DEFAULT_ACCOUNT_NAME, balance=Bank.DEFAULT_BALANCE, currency=Bank.DEFAULT_CURRENCY):
+        acc_no = self.server.bank.createAccount(str(name), integerArg("balance", balance), key=self.idempotencyKey(), currency=str(currency), client=self.clientId())
+        if acc_no is False: return 400, {"error": "Account creation unsuccessful"}
+        return 201, {"account_no": acc_no}
+
+    def getAccount(self, acc_no):
+        account = self.server.bank.getAccount(int(acc_no), client=self.clientId())
+        if account is False: return 404, {"error": "Account does not exist"}
+        name, balance, open_date, currency = account
+        return 200, {"account_no": int(acc_no), "name": name, "balance": balance, "currency": currency, "open_date": open_date}
+
+    def checkBalance(self, acc_no, as_of=None):
+        if as_of is None: balance = self.server.bank.checkBalance(int(acc_no), client=self.clientId())
+        else: balance = self.server.bank.balanceAsOf(int(acc_no), timestampArg("as_of", as_of), client=self.clientId())
+        if balance is False: return 404, {"error": "Check Balance unsuccessful"}
+        return 200, {"account_no": int(acc_no), "balance": balance}
+
+    def statement(self, acc_no, start, end):
+        statement = self.server.bank.statement(int(acc_no), timestampArg("start", start), timestampArg("end", end), client=self.clientId())
+        if statement is False: return 404, {"error": "Statement unsuccessful"}
+        columns = ("id", "ts", "idempotency_key", "kind", "amount", "balance_before", "balance_after")
+        return 200, dict(statement, entries=[dict(zip(columns, entry)) for entry in statement["entries"]])
+
+    def deposit(self, acc_no, amount):
+        balance = self.server.bank.deposit(int(acc_no), integerArg("amount", amount), key=self.idempotencyKey(), client=self.clientId())
+        if balance is False: return 400, {"error": "Deposit unsuccessful"}
+        return 200, {"account_no": int(acc_no), "balance": balance}
+
+    def withdraw(self, acc_no, amount):
+        balance = self.server.bank.withdraw(int(acc_no), integerArg("amount", amount), key=self.idempotencyKey(), client=self.clientId())
+        if balance is False: return 400, {"error": "Withdraw unsuccessful"}
+        return 200, {"account_no": int(acc_no), "balance": balance}
+
+    def transfer(self, source, target, amount, mode=None):
+        if mode not in (None, Bank.TRANSFER_LOCKED, Bank.TRANSFER_CONDITIONAL): raise RequestError(400, f"Unknown transfer mode: {mode!r}")
+        result = self.server.bank.transfer(integerArg("source", source), integerArg("target", target), integerArg("amount", amount),
+                                           mode=mode, key=self.idempotencyKey(), client=self.clientId())
+        if result[0] is False:
+            return 400, {"error": Bank.TRANSFER_ERRORS.get(result[1], "Transfer unsuccessful"), "switch": result[1]}
+        src_name, trgt_name, src_balance, trgt_balance = result
+        return 200, {"source": {"account_no": int(source), "name": src_name, "balance": src_balance},
+                     "target": {"account_no": int(target), "name": trgt_name, "balance": trgt_balance}}
+
+    def applyBatch(self, ops, chunk_size=Bank.BATCH_CHUNK_SIZE):
+        if not isinstance(ops, list) or not all(isinstance(op, list) for op in ops): raise RequestError(400, "ops must be a list of operations")
+        if integerArg("chunk_size", chunk_size) < 1: raise RequestError(400, "chunk_size must be positive")
+        results = self.server.bank.applyBatch([tuple(op) for op in ops], int(chunk_size), key=self.idempotencyKey(),
+                                             client=self.clientId())
+        return 200, {"results": [{"ok": ok, "result" if ok else "error": value} for ok, value in results]}
+
+    def schedulePayment(self, source, target, amount, first_run, period="monthly", count=None):
+        payment = (integerArg("source", source), integerArg("target", target), integerArg("amount", amount), timestampArg("first_run", first_run),
+                   period, integerArg("count", count) if count is not None else None)
+        try:
+            payment_id = self.server.scheduler.schedule(*payment)
+        except ValueError as e:
+            # Scheduler.scheduleMany validates the payment before it touches storage
+            raise RequestError(400, str(e))
+        if payment_id is False: return 400, {"error": "Scheduling unsuccessful"}
+        return 201, {"id": payment_id}
+
+    def getPayment(self, payment_id):
+        payment = self.server.scheduler.getPayment(int(payment_id))
+        if payment is False: return 404, {"error": "Scheduled payment does not exist"}
+        return 200, payment
+
+    def cancelPayment(self, payment_id):
+        if not self.server.scheduler.cancel(int(payment_id)): return 404, {"error": "No active scheduled payment"}
+        return 200, {"id": int(payment_id), "status": "cancelled"}
+
+    def stats(self):
+        return 200, {"workers": self.server.workers, "scheduler": self.server.scheduler.getStats(), **self.server.bank.getStats()}
+
+    def metrics(self):
+        return 200, self.server.bank.exportMetrics()
+
+
+########## Server ##########
+
+# BankServer - class
+### HTTP server that hands each accepted connection to a pool of max(connections, workers) threads; a connection
+### accepted while every thread is busy waits in the pool's queue (it is not refused) until a thread is free
+### Requests take one of workers slots while they run - sized to the database connection pool, so no more requests
+### run than there are database connections - and not while the connection waits idle for the next request
+### bank is a Bank, or a ShardedBank whose size is the total of its workers' connection pools
+### scheduler keeps the scheduled payments (in storage, bank.dbObj by default); they are paid past admission control
+### Requests run inside storage.readYourWrites(client id), so with read replicas a client reads its own writes
+### (in this process only - not through the sharded worker processes)
+### admission holds the AdmissionControl keyword arguments (Admission.settings() from config.ini by default)
+class BankServer(http.server.HTTPServer):
+
+    def __init__(self, address, bank, workers=None, storage=None, admission=None, connections=MAX_CONNECTIONS):
+        self.bank = Admission.AdmissionControl(bank, **(admission if admission is not None else Admission.settings()))
+        self.scheduler = Scheduler.Scheduler(bank, storage)
+        self.storage = self.scheduler.dbObj
+        self.workers = workers or (bank.size if isinstance(bank, ShardedBank.ShardedBank) else getattr(bank.dbObj, "size", 1))
+        self.slots = threading.BoundedSemaphore(self.workers)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(connections, self.workers), thread_name_prefix="BankServer")
+        super().__init__(address, BankRequestHandler)
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self.processRequestWorker, request, client_address)
+
+    def processRequestWorker(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=True)
+        self.scheduler.close()
+
+
+# runSnapshots
+## Take a balance snapshot every interval seconds until stop is set
+def runSnapshots(bank, interval, stop):
+    while not stop.wait(interval): bank.takeSnapshot()
+
+
+def main():
+    # main
+    ## Parse the server options
+    ## Open the storage backend (MySQL from config.ini unless --backend says otherwise)
+    ## Check the query plans of the hot statements
+    ## With --processes, fork that many sharded worker processes to run the Bank operations
+    ## Take balance snapshots in the background if [SNAPSHOTS] interval is set
+    ## Run [SCHEDULER] workers scheduler threads paying the scheduled payments as they fall due
+    ## Serve the Bank JSON API until interrupted
+    parser = argparse.ArgumentParser(description="Serve the Bank operations as a JSON API")
+    parser.add_argument("--host", default=SERVER_HOST)
+    parser.add_argument("--port", type=int, default=SERVER_PORT)
+    parser.add_argument("--workers", type=int, default=None, help="requests run at once, defaults to the connection pool size")
+    parser.add_argument("--connections", type=int, default=MAX_CONNECTIONS, help="connection threads; more connections queue for a free one")
+    parser.add_argument("--backend", choices=("mysql", "sqlite", "memory"), default=Bank.STORAGE_BACKEND)
+    parser.add_argument("--path", default=Bank.SQLITE_PATH, help="SQLite database file for --backend sqlite")
+    parser.add_argument("--processes", type=int, default=0, help="worker processes, routed by account number (0 - run in this process)")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.INFO)
+
+    dbObject = Bank.openStorage(args.backend, args.path)
+    if not dbObject.isConnected():
+        Bank.printString("Connection to database was UNSUCCESSFUL", length=Bank.DEFAULT_PAGE_WIDTH)
+        return False
+    # Warn (in the log) about hot statements whose plan does not use the primary key
+    dbObject.checkPlans()
+
+    if args.processes:
+        bank = ShardedBank.ShardedBank(args.processes, args.backend, args.path)
+    else:
+        cache = BalanceCache.BalanceCache(Bank.CACHE_SIZE, Bank.CACHE_TTL) if Bank.CACHE_SIZE > 0 else None
+        group = GroupCommit.GroupCommit(Bank.GROUP_COMMIT_WINDOW, Bank.GROUP_COMMIT_MAX_OPS) if Bank.GROUP_COMMIT_MAX_OPS > 0 else None
+        bank = Bank.Bank(dbObject, cache=cache, group=group)
+    server = BankServer((args.host, args.port), bank, args.workers, dbObject, connections=args.connections)
+    stopBackground = threading.Event()
+    if Bank.SNAPSHOT_INTERVAL > 0:
+        threading.Thread(target=runSnapshots, args=(bank, Bank.SNAPSHOT_INTERVAL, stopBackground), name="Snapshots", daemon=True).start()
+    schedulerWorkers = [threading.Thread(target=server.scheduler.run, args=(stopBackground,), name=f"SchedulerWorker{n}")
+                        for n in range(Bank.SCHEDULER_WORKERS)]
+    for worker in schedulerWorkers: worker.start()
+    logging.info(f"Bank server listening on {args.host}:{args.port} with {server.workers} workers")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stopBackground.set()
+        for worker in schedulerWorkers: worker.join()
+        server.server_close()
+        if args.processes: bank.close()
+        elif bank.group is not None: bank.group.close()
+        dbObject.disconnectDB(MySQLConnector.SAVE_ON_DISCONNECT)
+    return True
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,429 @@
+import Bank
+import MySQLConnector
+import SQLiteConnector
+import Storage
+import concurrent.futures
+import contextlib
+import multiprocessing
+import subprocess
+import itertools
+import argparse
+import platform
+import logging
+import sys
+import random
+import json
+import time
+
+# Workload mixes - share of each operation
+WORKLOADS = {
+    "read-heavy":     {"checkBalance": 0.90, "deposit": 0.04, "withdraw": 0.03, "transfer": 0.03},
+    "mixed":          {"checkBalance": 0.50, "deposit": 0.20, "withdraw": 0.15, "transfer": 0.15},
+    "transfer-heavy": {"checkBalance": 0.10, "deposit": 0.05, "withdraw": 0.05, "transfer": 0.80},
+    "deposit-heavy":  {"checkBalance": 0.10, "deposit": 0.85, "withdraw": 0.05},
+}
+
+# Defaults
+BENCH_WORKLOAD = "mixed"
+BENCH_ACCOUNTS = 1000
+BENCH_THREADS  = 8
+BENCH_PROCESSES = 1
+BENCH_OPS      = 2000       # operations per thread (ignored when a duration is given)
+BENCH_SKEW     = 0.0        # Zipf exponent for picking accounts, 0 - uniform
+BENCH_BALANCE  = 1000000    # opening balance of seeded accounts
+BENCH_AMOUNT   = 100        # largest amount moved by one operation
+BENCH_OUTPUT   = "bench_results.jsonl"
+PERCENTILES    = (0.50, 0.95, 0.99)
+
+# Startup measurement: a fresh interpreter imports Bank, then opens the storage and runs one query
+STARTUP_SCRIPT = """
+import time, json, sys
+start = time.perf_counter()
+import Bank
+imported = time.perf_counter()
+storage = Bank.openStorage(sys.argv[1], sys.argv[2])
+Bank.Bank(storage).checkBalance(1)
+print(json.dumps({"import_ms": (imported - start) * 1000, "first_query_ms": (time.perf_counter() - start) * 1000}))
+"""
+
+
+########## Workload generation ##########
+
+# accountPicker
+## Return a function picking one of the account numbers in accounts (a sequence)
+## skew > 0 picks with a Zipf distribution, so a few hot accounts (the first ones) receive most of the traffic
+def accountPicker(accounts, skew, rng):
+    if skew <= 0: return lambda: accounts[rng.randrange(len(accounts))]
+    cum_weights = list(itertools.accumulate(1 / rank ** skew for rank in range(1, len(accounts) + 1)))
+    return lambda: rng.choices(accounts, cum_weights=cum_weights)[0]
+
+# operationPicker
+## Return a function that draws (operation, args) from the workload mix
+def operationPicker(workload, pickAccount, rng):
+    names, weights = zip(*WORKLOADS[workload].items())
+    cum_weights = list(itertools.accumulate(weights))
+
+    def pick():
+        action = rng.choices(names, cum_weights=cum_weights)[0]
+        if action == "checkBalance": return action, (pickAccount(),)
+        amount = rng.randint(1, BENCH_AMOUNT)
+        if action != "transfer": return action, (pickAccount(), amount)
+        src = pickAccount()
+        trgt = pickAccount()
+        while trgt == src: trgt = pickAccount()
+        return action, (src, trgt, amount)
+    return pick
+
+# succeeded
+## Bank methods report failure as False (transfer as (False, switch))
+def succeeded(result):
+    if isinstance(result, tuple): return result[0] is not False
+    return result is not False
+
+
+########## Running ##########
+
+# runThread
+## Run one client thread on the account numbers accounts; return {operation: ([latencies], aborts)}
+def runThread(bank, options, accounts, seed):
+    rng = random.Random(seed)
+    pick = operationPicker(options["workload"], accountPicker(accounts, options["skew"], rng), rng)
+    samples = {action: ([], [0]) for action in WORKLOADS[options["workload"]]}
+    deadline = time.perf_counter() + options["seconds"] if options["seconds"] else None
+
+    for n in itertools.count():
+        if deadline is None and n >= options["ops"]: break
+        if deadline is not None and time.perf_counter() >= deadline: break
+        action, args = pick()
+        start = time.perf_counter()
+        result = getattr(bank, action)(*args)
+        latencies, aborts = samples[action]
+        latencies.append(time.perf_counter() - start)
+        if not succeeded(result): aborts[0] += 1
+    return {action: (latencies, aborts[0]) for action, (latencies, aborts) in samples.items()}
+
+# seedAccounts
+## Create count accounts with the benchmark opening balance and return their account numbers
+def seedAccounts(bank, count):
+    acc_nos = bank.createAccounts([(f"bench{n}", BENCH_BALANCE) for n in range(count)])
+    if acc_nos is False: raise RuntimeError(f"Creating {count} benchmark accounts failed")
+    return acc_nos
+
+# existingAccounts
+## Account numbers of accounts that are already there: options["accounts"] of them from options["first"] on
+def existingAccounts(options):
+    return range(options["first"], options["first"] + options["accounts"])
+
+# isPrivateBackend
+## True when every process gets its own copy of the data (memory engine, in-memory SQLite)
+def isPrivateBackend(options):
+    return options["backend"] == "memory" or (options["backend"] == "sqlite" and options["path"] == ":memory:")
+
+# runProcess
+## Open the backend, seed it if it is private to this process and run the client threads
+## The threads use the account numbers seeded here, else accounts (seeded by runBenchmark), else existingAccounts
+## Return ({operation: ([latencies], aborts)}, retries, storage stats, seconds spent running clients)
+def runProcess(options, process, accounts=None):
+    storage = Bank.openStorage(options["backend"], options["path"])
+    bank = Bank.Bank(storage)
+    if isPrivateBackend(options): accounts = seedAccounts(bank, options["accounts"])
+    elif accounts is None: accounts = existingAccounts(options)
+
+    merged = {}
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=options["threads"]) as executor:
+        seeds = [options["seed"] + process * options["threads"] + thread for thread in range(options["threads"])]
+        for samples in executor.map(lambda seed: runThread(bank, options, accounts, seed), seeds):
+            for action, (latencies, aborts) in samples.items():
+                entry = merged.setdefault(action, ([], [0]))
+                entry[0].extend(latencies)
+                entry[1][0] += aborts
+    elapsed = time.perf_counter() - start
+    stats = storage.getStats()
+    storage.disconnectDB(MySQLConnector.SAVE_ON_DISCONNECT)
+    return {action: (latencies, aborts[0]) for action, (latencies, aborts) in merged.items()}, dict(bank.retries), stats, elapsed
+
+
+########## Reporting ##########
+
+# percentile
+## q-th percentile of a sorted list
+def percentile(ordered, q):
+    if not ordered: return 0.0
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+# summarize
+## Turn raw samples into per-operation throughput, latency percentiles (ms) and abort/retry rates
+def summarize(samples, retries, elapsed):
+    operations = {}
+    for action, (latencies, aborts) in sorted(samples.items()):
+        ordered = sorted(latencies)
+        count = len(ordered)
+        operations[action] = {
+            "count": count,
+            "throughput": count / elapsed if elapsed else 0.0,
+            "mean_ms": sum(ordered) / count * 1000 if count else 0.0,
+            **{f"p{int(q * 100)}_ms": percentile(ordered, q) * 1000 for q in PERCENTILES},
+            "aborts": aborts,
+            "abort_rate": aborts / count if count else 0.0,
+            "retries": retries.get(action, 0),
+            "retry_rate": retries.get(action, 0) / count if count else 0.0,
+        }
+    total = sum(entry["count"] for entry in operations.values())
+    return operations, {"ops": total, "seconds": elapsed, "throughput": total / elapsed if elapsed else 0.0,
+                        "aborts": sum(entry["aborts"] for entry in operations.values()),
+                        "retries": sum(retries.values())}
+
+# gitRevision
+## Commit the benchmark ran against, so results can be compared across changes
+def gitRevision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+# runBenchmark
+## Seed shared backends, run the clients in options["processes"] processes and summarize
+## Return the result record that is written to the output file
+def runBenchmark(options):
+    accounts = None
+    if not isPrivateBackend(options) and options["seed_accounts"]:
+        storage = Bank.openStorage(options["backend"], options["path"])
+        accounts = seedAccounts(Bank.Bank(storage), options["accounts"])
+        storage.disconnectDB(MySQLConnector.SAVE_ON_DISCONNECT)
+
+    if options["processes"] == 1:
+        results = [runProcess(options, 0, accounts)]
+    else:
+        with multiprocessing.Pool(options["processes"]) as pool:
+            results = pool.starmap(runProcess, [(options, process, accounts) for process in range(options["processes"])])
+    # Processes run side by side; the slowest one bounds the run
+    elapsed = max(result[3] for result in results)
+
+    samples, retries, storage = {}, {}, []
+    for process_samples, process_retries, stats, _ in results:
+        for action, (latencies, aborts) in process_samples.items():
+            entry = samples.setdefault(action, [[], 0])
+            entry[0].extend(latencies)
+            entry[1] += aborts
+        for action, count in process_retries.items(): retries[action] = retries.get(action, 0) + count
+        storage.append(stats)
+
+    operations, totals = summarize(samples, retries, elapsed)
+    return {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "revision": gitRevision(),
+            "python": platform.python_version(), "options": options,
+            "operations": operations, "totals": totals, "storage": storage}
+
+# measureStartup
+## Median import time of Bank and time to the first query over repeats fresh interpreters
+## Return {"import_ms": ..., "first_query_ms": ..., "process_ms": ...}; process_ms includes interpreter startup
+def measureStartup(backend, path, repeats):
+    samples = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT, backend, path], capture_output=True, text=True, check=True).stdout
+        sample = json.loads(output.strip().splitlines()[-1])
+        sample["process_ms"] = (time.perf_counter() - start) * 1000
+        samples.append(sample)
+    return {name: sorted(sample[name] for sample in samples)[len(samples) // 2] for name in samples[0]}
+
+# benchmarkStripes
+## Credit throughput on one hot account for each stripe count (0 - a plain account)
+## threads clients deposit into the account for seconds; every 20th operation is a withdrawal, so sweeps run too
+## Return {stripes: {"throughput": ops/s, "p99_ms": ..., "balance_ok": total equals the money moved}}
+def benchmarkStripes(backend, path, stripeCounts, threads=BENCH_THREADS, seconds=5.0):
+    results = {}
+    for stripes in stripeCounts:
+        storage = Bank.openStorage(backend, path)
+        bank = Bank.Bank(storage)
+        acc_no = bank.createAccount("hot", 0)
+        bank.stripeAccount(acc_no, stripes)
+        moved = [0] * threads
+
+        def client(thread):
+            latencies, rng, deadline = [], random.Random(thread), time.perf_counter() + seconds
+            for i in itertools.count():
+                if time.perf_counter() >= deadline: break
+                amount = rng.randint(1, BENCH_AMOUNT)
+                start = time.perf_counter()
+                if i % 20 == 19:
+                    if bank.withdraw(acc_no, amount) is not False: moved[thread] -= amount
+                elif bank.deposit(acc_no, amount) is not False: moved[thread] += amount
+                latencies.append(time.perf_counter() - start)
+            return latencies
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+            latencies = sorted(itertools.chain.from_iterable(executor.map(client, range(threads))))
+        results[stripes] = {"throughput": len(latencies) / seconds, "p99_ms": percentile(latencies, 0.99) * 1000,
+                            "balance_ok": bank.checkBalance(acc_no) == sum(moved)}
+        storage.disconnectDB(MySQLConnector.SAVE_ON_DISCONNECT)
+    return results
+
+# openReplicated
+## Storage with read replicas: [REPLICAS] from config.ini, or for an SQLite file copies in-memory stand-ins
+def openReplicated(backend, path, copies):
+    storage = Bank.openStorage(backend, path)
+    if backend != "sqlite" or not copies: return storage
+    replicas = [Storage.SQLiteStorage(SQLiteConnector.sqliteCopy(path, Bank.REPLICA_COPY_INTERVAL)) for _ in range(copies)]
+    return Storage.ReplicatedStorage(getattr(storage, "primary", storage), replicas, Bank.REPLICA_MAX_LAG, Bank.REPLICA_LAG_INTERVAL)
+
+# benchmarkReplicas
+## Half the threads are writers - each deposits into its own account every 5th operation and otherwise checks its
+## balance; the other half only check the balances of the writers' accounts. Run with read-your-writes for the
+## writers (each inside readYourWrites of its own token) and without, for seconds each
+## Return {"ryw"/"no_ryw": {"throughput": ops/s, "stale_reads": writer reads older than its own last deposit,
+##                          "replica_reads", "primary_reads", "pinned_reads"}}
+def benchmarkReplicas(backend, path, copies, threads=BENCH_THREADS, seconds=5.0):
+    storage = openReplicated(backend, path, copies)
+    bank = Bank.Bank(storage)
+    writers = max(1, threads // 2)
+    accounts = bank.createAccounts([(f"replica{i}", 0) for i in range(writers)])
+    deposited = [0] * writers
+    # After the read-your-writes pin every replica that serves reads has the new accounts
+    time.sleep(getattr(storage, "pin", 0))
+    results = {}
+    for mode in ("no_ryw", "ryw"):
+        before = dict(storage.getStats())
+        counts = [[0, 0] for _ in range(threads)]        # operations, stale reads
+
+        def client(thread):
+            rng, deadline = random.Random(thread), time.perf_counter() + seconds
+            if thread >= writers:
+                while time.perf_counter() < deadline:
+                    bank.checkBalance(rng.choice(accounts))
+                    counts[thread][0] += 1
+                return
+            acc_no, expected = accounts[thread], deposited[thread]
+            with storage.readYourWrites(thread) if mode == "ryw" else contextlib.nullcontext():
+                for i in itertools.count():
+                    if time.perf_counter() >= deadline: break
+                    if i % 5 == 0:
+                        if bank.deposit(acc_no, 1) is not False: expected += 1
+                    elif bank.checkBalance(acc_no) != expected: counts[thread][1] += 1
+                    counts[thread][0] += 1
+            deposited[thread] = expected
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor: list(executor.map(client, range(threads)))
+        after = storage.getStats()
+        results[mode] = {"throughput": sum(ops for ops, stale in counts) / seconds, "stale_reads": sum(stale for ops, stale in counts)}
+        results[mode].update({name: after.get(name, 0) - before.get(name, 0) for name in ("replica_reads", "primary_reads", "pinned_reads")})
+    storage.disconnectDB(MySQLConnector.SAVE_ON_DISCONNECT)
+    return results
+
+# benchmarkFx
+## Transfer latency within one currency (USD to USD) and between two (USD to EUR): threads clients, each moving money
+## from its own USD account to its own target, for seconds each; then applyBatch of batchSize transfers of each kind
+## (best of repeats runs)
+## Return {"same"/"cross": {"throughput": ops/s, "p50_ms", "p99_ms"}, "batch_same"/"batch_cross": {"throughput", "ms"}}
+def benchmarkFx(backend, path, threads=BENCH_THREADS, seconds=5.0, batchSize=Bank.BATCH_CHUNK_SIZE, repeats=5):
+    storage = Bank.openStorage(backend, path)
+    bank = Bank.Bank(storage)
+    bank.setFxRates([("USD", "EUR", "0.9234"), ("EUR", "GBP", "0.8571")])
+    sources = bank.createAccounts([(f"fxsrc{i}", BENCH_BALANCE * 1000) for i in range(threads)])
+    targets = {"same": bank.createAccounts([(f"fxusd{i}", 0) for i in range(threads)]),
+               "cross": bank.createAccounts([(f"fxeur{i}", 0) for i in range(threads)], currency="EUR")}
+    results = {}
+    for kind, accounts in targets.items():
+        def client(thread):
+            latencies, rng, deadline = [], random.Random(thread), time.perf_counter() + seconds
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                bank.transfer(sources[thread], accounts[thread], rng.randint(1, BENCH_AMOUNT))
+                latencies.append(time.perf_counter() - start)
+            return latencies
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+            latencies = sorted(itertools.chain.from_iterable(executor.map(client, range(threads))))
+        results[kind] = {"throughput": len(latencies) / seconds, "p50_ms": percentile(latencies, 0.50) * 1000,
+                         "p99_ms": percentile(latencies, 0.99) * 1000}
+    for kind, accounts in targets.items():
+        ops = [("transfer", sources[i % threads], accounts[i % threads], 1 + i % BENCH_AMOUNT) for i in range(batchSize)]
+        best = None
+        for _ in range(repeats):
+            start = time.perf_counter()
+            bank.applyBatch(ops, batchSize)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results[f"batch_{kind}"] = {"throughput": batchSize / best, "ms": best * 1000}
+    storage.disconnectDB(MySQLConnector.SAVE_ON_DISCONNECT)
+    return results
+
+# printReport
+## Human readable table of one result record
+def printReport(record):
+    options, totals = record["options"], record["totals"]
+    print(f"\n{options['workload']} on {options['backend']}: {options['accounts']} accounts, skew {options['skew']}, "
+          f"{options['processes']} process(es) x {options['threads']} thread(s)")
+    print(f"{'operation':<14}{'count':>9}{'ops/s':>11}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'abort %':>9}{'retry %':>9}")
+    for action, entry in record["operations"].items():
+        print(f"{action:<14}{entry['count']:>9}{entry['throughput']:>11.1f}{entry['p50_ms']:>9.3f}{entry['p95_ms']:>9.3f}"
+              f"{entry['p99_ms']:>9.3f}{entry['abort_rate'] * 100:>9.2f}{entry['retry_rate'] * 100:>9.2f}")
+    print(f"{'total':<14}{totals['ops']:>9}{totals['throughput']:>11.1f}   in {totals['seconds']:.2f}s, "
+          f"{totals['aborts']} aborts, {totals['retries']} retries")
+
+
+def main():
+    # main
+    ## Parse the workload options
+    ## With --startup, only measure import and first query times of fresh interpreters
+    ## With --stripes, only measure credit throughput on one hot account for each stripe count
+    ## With --replicas, only measure stale reads and read routing with and without read-your-writes
+    ## With --fx, only compare the latency of transfers within one currency and between two
+    ## Run the benchmark, print the table and append the result record to the output file (one JSON object per line)
+    parser = argparse.ArgumentParser(description="Benchmark Bank operations")
+    parser.add_argument("--workload", choices=sorted(WORKLOADS), default=BENCH_WORKLOAD)
+    parser.add_argument("--backend", choices=("mysql", "sqlite", "memory"), default="memory")
+    parser.add_argument("--path", default=Bank.SQLITE_PATH, help="SQLite database file for --backend sqlite")
+    parser.add_argument("--accounts", type=int, default=BENCH_ACCOUNTS)
+    parser.add_argument("--first", type=int, default=1, help="first account number of existing accounts (shared backend without --seed-accounts)")
+    parser.add_argument("--seed-accounts", action="store_true", help="create the accounts on a shared backend first")
+    parser.add_argument("--threads", type=int, default=BENCH_THREADS)
+    parser.add_argument("--processes", type=int, default=BENCH_PROCESSES)
+    parser.add_argument("--ops", type=int, default=BENCH_OPS, help="operations per thread")
+    parser.add_argument("--seconds", type=float, default=0, help="run for a fixed time instead of --ops")
+    parser.add_argument("--skew", type=float, default=BENCH_SKEW, help="Zipf exponent for hot accounts (0 - uniform)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument("--output", default=BENCH_OUTPUT)
+    parser.add_argument("--startup", type=int, default=0, metavar="REPEATS", help="measure startup times over REPEATS interpreters instead")
+    parser.add_argument("--stripes", type=int, nargs="+", metavar="K", help="measure hot account credits with K stripes instead")
+    parser.add_argument("--replicas", type=int, default=None, metavar="COPIES",
+                        help="measure read routing instead ([REPLICAS] of config.ini, or COPIES stand-ins of an SQLite file)")
+    parser.add_argument("--fx", action="store_true", help="compare same-currency and cross-currency transfers instead")
+    options = vars(parser.parse_args())
+    output = options.pop("output")
+    repeats = options.pop("startup")
+    stripeCounts = options.pop("stripes")
+    copies = options.pop("replicas")
+    fx = options.pop("fx")
+
+    if repeats:
+        times = measureStartup(options["backend"], options["path"], repeats)
+        print(" ".join(f"{name}={value:.1f}" for name, value in times.items()))
+        return times
+
+    if stripeCounts:
+        results = benchmarkStripes(options["backend"], options["path"], stripeCounts, options["threads"], options["seconds"] or 5.0)
+        for stripes, result in results.items():
+            print(f"stripes={stripes} ops/s={result['throughput']:.1f} p99_ms={result['p99_ms']:.3f} balance_ok={result['balance_ok']}")
+        return results
+
+    if copies is not None:
+        results = benchmarkReplicas(options["backend"], options["path"], copies, options["threads"], options["seconds"] or 5.0)
+        for mode, result in results.items():
+            print(f"{mode}: " + " ".join(f"{name}={value:.1f}" if isinstance(value, float) else f"{name}={value}" for name, value in result.items()))
+        return results
+
+    if fx:
+        results = benchmarkFx(options["backend"], options["path"], options["threads"], options["seconds"] or 5.0)
+        for kind, result in results.items():
+            print(f"{kind}: " + " ".join(f"{name}={value:.3f}" for name, value in result.items()))
+        return results
+
+    record = runBenchmark(options)
+    printReport(record)
+    with open(output, "a") as f: f.write(json.dumps(record) + "\n")
+    logging.info(f"benchmark result appended to {output}")
+    return record
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+import Bank
+import FxRates
+import MySQLConnector
+import itertools
+import argparse
+import logging
+import json
+import time
+import csv
+import sys
+
+# Defaults
+IMPORT_CHUNK_ROWS = 5000    # accounts created per transaction
+EXPORT_FETCH_ROWS = 5000    # rows fetched per round trip, and rows per row group of a columns dump
+PROGRESS_INTERVAL = 2.0     # seconds between progress reports
+
+# File formats
+###     csv      - header line, then one account per line
+###     jsonl    - one JSON object per line
+###     columns  - one JSON object of column arrays per line (a row group of up to EXPORT_FETCH_ROWS accounts)
+FORMATS = ("csv", "jsonl", "columns")
+FIELDS  = ("account_no", "name", "balance", "open_date", "currency")
+
+
+########## Progress ##########
+
+# Progress - class
+### Counts rows and reports rows/sec every PROGRESS_INTERVAL seconds and once at the end
+### report is called with (rows, seconds, rows per second, finished)
+##    update    ## Add rows, report if the interval has passed
+##    finish    ## Final report; return (rows, seconds)
+class Progress():
+
+    def __init__(self, label, report=None, interval=PROGRESS_INTERVAL):
+        self.label = label
+        self.report = report
+        self.interval = interval
+        self.rows = 0
+        self.start = self.last = time.perf_counter()
+
+    def emit(self, finished):
+        elapsed = time.perf_counter() - self.start
+        rate = self.rows / elapsed if elapsed else 0.0
+        logging.info(f"{self.label}: {self.rows} rows in {elapsed:.1f}s ({rate:.0f} rows/s)")
+        if self.report is not None: self.report(self.rows, elapsed, rate, finished)
+
+    def update(self, rows):
+        self.rows += rows
+        now = time.perf_counter()
+        if now - self.last >= self.interval:
+            self.last = now
+            self.emit(False)
+
+    def finish(self):
+        self.emit(True)
+        return self.rows, time.perf_counter() - self.start
+
+
+########## Reading ##########
+
+# guessFormat
+## File format from the extension, csv unless it is .jsonl/.json
+def guessFormat(path):
+    return "jsonl" if path.endswith((".jsonl", ".json")) else "csv"
+
+# parseAccount
+## Validate one record and return (account_no or None, name, balance, currency); line is used in error messages
+## balance is in minor units of currency (Bank.DEFAULT_CURRENCY if the record has none)
+def parseAccount(record, line):
+    try:
+        acc_no = record.get("account_no")
+        acc_no = int(acc_no) if acc_no not in (None, "") else None
+        balance = int(record.get("balance") or 0)
+        name = str(record.get("name") or Bank.DEFAULT_ACCOUNT_NAME)
+        currency = FxRates.checkCurrency(record.get("currency") or Bank.DEFAULT_CURRENCY)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"line {line}: {e}")
+    if balance < 0: raise ValueError(f"line {line}: balance must not be negative")
+    return acc_no, name, balance, currency
+
+# readAccounts
+## Generator over the accounts of an open file, one record in memory at a time (one row group for columns)
+def readAccounts(f, fmt):
+    if fmt == "csv":
+        # line 1 is the header
+        for line, record in enumerate(csv.DictReader(f), start=2): yield parseAccount(record, line)
+    elif fmt == "jsonl":
+        for line, text in enumerate(f, start=1):
+            if text.strip(): yield parseAccount(json.loads(text), line)
+    elif fmt == "columns":
+        for line, text in enumerate(f, start=1):
+            if not text.strip(): continue
+            group = json.loads(text)
+            count = len(group["name"])
+            for i in range(count):
+                yield parseAccount({field: values[i] for field, values in group.items() if len(values) == count}, line)
+    else:
+        raise ValueError(f"Unknown format: {fmt}")
+
+
+########## Import / export ##########
+
+# importAccounts
+## Stream accounts from path into the bank, chunkSize accounts per transaction (Bank.createAccounts)
+## Memory stays bounded by one chunk whatever the size of the file
+## Return (rows, seconds); raise RuntimeError naming the first line of a chunk that could not be imported
+def importAccounts(bank, path, fmt=None, chunkSize=IMPORT_CHUNK_ROWS, report=None):
+    fmt = fmt or guessFormat(path)
+    progress = Progress(f"import {path}", report)
+    with open(path, newline="" if fmt == "csv" else None) as f:
+        accounts = readAccounts(f, fmt)
+        while True:
+            chunk = list(itertools.islice(accounts, chunkSize))
+            if not chunk: break
+            if bank.createAccounts(chunk) is False:
+                raise RuntimeError(f"Import stopped after {progress.rows} accounts: chunk starting at account {progress.rows + 1} failed")
+            progress.update(len(chunk))
+    return progress.finish()
+
+# exportAccounts
+## Stream every account to path through an unbuffered cursor, fetchSize rows per round trip
+## Return (rows, seconds)
+def exportAccounts(storage, path, fmt=None, fetchSize=EXPORT_FETCH_ROWS, report=None):
+    fmt = fmt or guessFormat(path)
+    if fmt not in FORMATS: raise ValueError(f"Unknown format: {fmt}")
+    progress = Progress(f"export {path}", report)
+    with storage.borrow() as dbObj, open(path, "w", newline="" if fmt == "csv" else None) as f:
+        rows = dbObj.streamAccounts(fetchSize)
+        if fmt == "csv":
+            writer = csv.writer(f)
+            writer.writerow(FIELDS)
+            for batch in iter(lambda: list(itertools.islice(rows, fetchSize)), []):
+                writer.writerows(batch)
+                progress.update(len(batch))
+        elif fmt == "jsonl":
+            for batch in iter(lambda: list(itertools.islice(rows, fetchSize)), []):
+                f.writelines(json.dumps(dict(zip(FIELDS, row)), default=str) + "\n" for row in batch)
+                progress.update(len(batch))
+        else:
+            for batch in iter(lambda: list(itertools.islice(rows, fetchSize)), []):
+                f.write(json.dumps(dict(zip(FIELDS, map(list, zip(*batch)))), default=str) + "\n")
+                progress.update(len(batch))
+    return progress.finish()
+
+
+def main():
+    # main
+    ## Parse the command: import or export, the file and its format
+    ## Open the storage backend and run the import/export, printing progress to stderr
+    parser = argparse.ArgumentParser(description="Bulk import/export of accounts")
+    parser.add_argument("command", choices=("import", "export"))
+    parser.add_argument("file")
+    parser.add_argument("--format", choices=FORMATS, help="default: from the file extension (.jsonl, otherwise csv)")
+    parser.add_argument("--chunk-size", type=int, default=IMPORT_CHUNK_ROWS, help="accounts per transaction on import")
+    parser.add_argument("--fetch-size", type=int, default=EXPORT_FETCH_ROWS, help="rows per round trip on export")
+    parser.add_argument("--backend", choices=("mysql", "sqlite", "memory"), default=Bank.STORAGE_BACKEND)
+    parser.add_argument("--path", default=Bank.SQLITE_PATH, help="SQLite database file for --backend sqlite")
+    args = parser.parse_args()
+
+    storage = Bank.openStorage(args.backend, args.path)
+    if not storage.isConnected():
+        Bank.printString("Connection to database was UNSUCCESSFUL", length=Bank.DEFAULT_PAGE_WIDTH)
+        return False
+
+    def report(rows, seconds, rate, finished):
+        print(f"{'done' if finished else '...'} {rows} rows in {seconds:.1f}s ({rate:.0f} rows/s)", file=sys.stderr)
+
+    try:
+        if args.command == "import": importAccounts(Bank.Bank(storage), args.file, args.format, args.chunk_size, report)
+        else: exportAccounts(storage, args.file, args.format, args.fetch_size, report)
+    except (OSError, ValueError, RuntimeError) as e:
+        logging.error(e)
+        print(f"{args.command} failed: {e}", file=sys.stderr)
+        return False
+    finally:
+        storage.disconnectDB(MySQLConnector.SAVE_ON_DISCONNECT)
+    return True
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+import collections
+import threading
+import decimal
+import logging
+import time
+
+# Defaults
+DEFAULT_CURRENCY = "USD"
+FX_TTL           = 60.0     # seconds a loaded rate table is used before a conversion reloads it (None - until refresh)
+
+# Digits of the minor unit of currencies that do not have 2 (ISO 4217)
+MINOR_UNITS = {"BHD": 3, "CLP": 0, "IQD": 3, "ISK": 0, "JOD": 3, "JPY": 0, "KRW": 0, "KWD": 3, "LYD": 3, "OMR": 3,
+               "PYG": 0, "TND": 3, "UGX": 0, "VND": 0, "XAF": 0, "XOF": 0}
+
+# Arithmetic of conversions: amount times factor is exact, then rounded half to even to a whole minor unit
+FX_CONTEXT = decimal.Context(prec=50, rounding=decimal.ROUND_HALF_EVEN)
+
+
+########## Currencies and minor units ##########
+
+# checkCurrency
+## Upper case three letter currency code; raise ValueError for anything else
+def checkCurrency(code):
+    currency = str(code).strip().upper()
+    if len(currency) != 3 or not currency.isalpha() or not currency.isascii(): raise ValueError(f"Invalid currency code: {code!r}")
+    return currency
+
+# minorUnits
+## Digits after the decimal point of a currency (2 unless listed in MINOR_UNITS)
+def minorUnits(currency):
+    return MINOR_UNITS.get(currency, 2)
+
+# toMinor
+## Exact amount in minor units of a decimal amount ("12.34" USD -> 1234, "500" JPY -> 500)
+## Raise ValueError for text that is not a number or has more decimals than the currency has
+def toMinor(value, currency):
+    try:
+        amount = decimal.Decimal(str(value).strip())
+    except decimal.InvalidOperation:
+        raise ValueError(f"Invalid amount: {value!r}")
+    if not amount.is_finite(): raise ValueError(f"Invalid amount: {value!r}")
+    minor = amount.scaleb(minorUnits(currency), FX_CONTEXT)
+    if minor != minor.to_integral_value(): raise ValueError(f"{currency} has {minorUnits(currency)} decimals: {value!r}")
+    return int(minor)
+
+# checkMinor
+## amount if it is a whole number of minor units - an int, not a bool; raise ValueError for anything else (10.5, "10", True)
+def checkMinor(amount):
+    if isinstance(amount, bool) or not isinstance(amount, int): raise ValueError(f"Amount must be an integer in minor units: {amount!r}")
+    return amount
+
+# fromMinor
+## Decimal amount of an amount in minor units (1234 USD -> Decimal("12.34"))
+def fromMinor(amount, currency):
+    return decimal.Decimal(int(amount)).scaleb(-minorUnits(currency))
+
+
+########## Rate tables ##########
+
+# Immutable snapshot of the fx_rates table
+###     version - goes up every time a refresh reads different rates
+###     loaded  - time.time() of the read
+###     rates   - {(base, quote): Decimal units of quote per unit of base}
+###     factors - {(source, target): Decimal minor units of target per minor unit of source}, for every quoted pair
+###               and, where only the other direction is quoted, its inverse
+FxTable = collections.namedtuple("FxTable", ("version", "loaded", "rates", "factors"))
+
+# buildTable
+## FxTable of (base, quote, rate) rows; rows with an invalid code or a rate that is not positive are skipped
+def buildTable(rows, version):
+    rates = {}
+    for base, quote, rate in rows:
+        try:
+            base, quote, rate = checkCurrency(base), checkCurrency(quote), decimal.Decimal(str(rate))
+        except (ValueError, decimal.InvalidOperation):
+            logging.warning(f"Skipping FX rate {base}/{quote}: {rate!r}")
+            continue
+        if base != quote and rate.is_finite() and rate > 0: rates[(base, quote)] = rate
+        else: logging.warning(f"Skipping FX rate {base}/{quote}: {rate!r}")
+    factors = {(base, quote): rate.scaleb(minorUnits(quote) - minorUnits(base), FX_CONTEXT) for (base, quote), rate in rates.items()}
+    for (base, quote), rate in rates.items():
+        if (quote, base) not in factors: factors[(quote, base)] = FX_CONTEXT.divide(1, rate).scaleb(minorUnits(base) - minorUnits(quote), FX_CONTEXT)
+    return FxTable(version, time.time(), rates, factors)
+
+# convertMinor
+## amount (minor units) times factor, rounded half to even to a whole minor unit
+def convertMinor(amount, factor):
+    return int(FX_CONTEXT.to_integral_value(FX_CONTEXT.multiply(factor, int(amount))))
+
+
+# FxRates - class
+### In-process versioned cache of the fx_rates table, so a conversion is one dictionary lookup and one multiplication
+### instead of a round trip. The whole table is read with one query into a new FxTable, which is then published by
+### replacing one reference: an operation takes the current table once and converts everything with it, so it never
+### mixes rates of two refreshes. The table is loaded on first use and reloaded by the first caller after ttl seconds;
+### other threads keep using the previous table meanwhile. A failed read keeps the previous table (an empty one before
+### the first read) and is retried after ttl seconds.
+### Callers take the table before borrowing a session for their transaction: a reload borrows one of its own.
+##    __init__
+##    table        ## Current FxTable, loading it on first use and reloading it after ttl seconds
+##    refresh      ## Read the fx_rates table now and publish it
+##    convert      ## Amount in minor units of one currency converted to another
+##    convertMany  ## Convert (amount, source currency, target currency) items with one table in one pass
+##    getStats     ## Version, pairs, age and refresh counters
+class FxRates():
+
+    def __init__(self, storage, ttl=FX_TTL):
+        self.storage = storage
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.current = None         # published FxTable
+        self.due = 0.0              # time.monotonic() after which table() reloads
+        self.stats = {"refreshes": 0, "refresh_errors": 0, "version_changes": 0}
+
+    def table(self):
+        table = self.current
+        if table is not None and (self.ttl is None or time.monotonic() < self.due): return table
+        # One thread reloads; the others carry on with the table they have (or wait for the first one)
+        if self.lock.acquire(blocking=table is None):
+            try:
+                if self.current is table: self.load()
+            finally:
+                self.lock.release()
+        return self.current
+
+    def refresh(self):
+        with self.lock: return self.load()
+
+    def load(self):
+        # Runs under self.lock
+        current = self.current
+        self.due = time.monotonic() + (self.ttl or 0.0)
+        try:
+            with self.storage.borrow() as dbObj: rows = dbObj.selectFxRates()
+        except Exception as e:
+            self.stats["refresh_errors"] += 1
+            logging.warning(f"FX rates could not be read: {e}")
+            if current is None: self.current = FxTable(0, time.time(), {}, {})
+            return self.current
+        table = buildTable(rows, 1 if current is None else current.version)
+        if current is not None and table.rates != current.rates:
+            table = table._replace(version=current.version + 1)
+            self.stats["version_changes"] += 1
+        self.current = table
+        self.stats["refreshes"] += 1
+        logging.debug("FX rates version %d: %d pairs", table.version, len(table.rates))
+        return table
+
+    def convert(self, amount, source, target, table=None):
+        # Raise LookupError if neither direction of the pair is quoted
+        if source == target: return int(amount)
+        table = table or self.table()
+        factor = table.factors.get((source, target))
+        if factor is None: raise LookupError(f"No FX rate for {source}/{target}")
+        return convertMinor(amount, factor)
+
+    def convertMany(self, items, table=None):
+        # One factor lookup per distinct pair, then one pass over the amounts; None for a pair without a rate
+        items = list(items)
+        table = table or self.table()
+        factors = {(source, target): table.factors.get((source, target)) for amount, source, target in items if source != target}
+        return [int(amount) if source == target else None if factors[(source, target)] is None else convertMinor(amount, factors[(source, target)])
+                for amount, source, target in items]
+
+    def getStats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            table = self.current
+        stats.update(version=table.version if table else 0, pairs=len(table.rates) if table else 0,
+                     age=time.time() - table.loaded if table else 0.0)
+        return stats
@@ -0,0 +1,184 @@
+import Bank
+import Metrics
+import MySQLConnector
+import concurrent.futures
+import threading
+import argparse
+import logging
+import queue
+import time
+
+# Defaults
+GROUP_WINDOW   = 0.0     # seconds the first operation of a group waits for others (0 - group what queued during the last commit)
+GROUP_MAX_OPS  = 256     # operations applied per group transaction
+
+# Benchmark
+BENCH_WINDOWS  = (0.0, 0.001, 0.002, 0.005)
+BENCH_CLIENTS  = 64
+BENCH_ACCOUNTS = 1000
+BENCH_SECONDS  = 3.0
+
+
+# GroupCommit - class
+### Write-behind group commit for deposits and withdrawals
+### Callers hand their operation to one flusher thread and block on a Future. The flusher collects operations
+### for up to window seconds (or until maxOps are queued), applies them in one transaction with
+### Bank.applyChunk - one locking read, one UPDATE, one ledger INSERT, one commit - and only then completes the
+### Futures, so no caller is acknowledged before its change is durable. An operation that fails (missing
+### account, insufficient funds) fails on its own; a failed commit fails the whole group.
+### While one group commits the next one is already being collected.
+##    __init__
+##    start      ## Start the flusher thread, applying groups with apply(ops) -> [(ok, result)]
+##    submit     ## Queue one operation, return a Future of its (ok, result) - None once closed
+##    run        ## Flusher thread body
+##    flush      ## Apply one group and complete its Futures
+##    getStats   ## Group, operation and largest group counters
+##    close      ## Stop taking operations, apply what is queued and stop the flusher
+class GroupCommit():
+
+    def __init__(self, window=GROUP_WINDOW, maxOps=GROUP_MAX_OPS):
+        self.window = window
+        self.maxOps = maxOps
+        self.queue = queue.SimpleQueue()    # (op, Future), None stops the flusher
+        self.thread = None
+        self.closed = False
+        self.closeLock = threading.Lock()      # orders submit against the None that stops the flusher
+        self.statsLock = threading.Lock()
+        self.stats = {"groups": 0, "operations": 0, "largest": 0}
+
+    def start(self, apply):
+        self.apply = apply
+        self.thread = threading.Thread(target=self.run, name="GroupCommit", daemon=True)
+        self.thread.start()
+
+    def submit(self, op):
+        # After close the flusher is gone: return None and let the caller apply the operation itself
+        future = concurrent.futures.Future()
+        with self.closeLock:
+            if self.closed: return None
+            self.queue.put((op, future))
+        return future
+
+    def run(self):
+        # run
+        ## Block for the first operation of a group, then collect more until the window closes or maxOps
+        ## window 0 takes only what is already queued
+        ## Stop after flushing the group that saw None
+        stopping = False
+        while not stopping:
+            item = self.queue.get()
+            if item is None: break
+            group = [item]
+            deadline = time.perf_counter() + self.window
+            while len(group) < self.maxOps:
+                try:
+                    remaining = deadline - time.perf_counter()
+                    item = self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                group.append(item)
+            self.flush(group)
+
+    def flush(self, group):
+        try:
+            results = self.apply([op for op, _ in group])
+        except Exception as e:
+            logging.error(e)
+            results = [(False, f"Group commit failed: {e}")] * len(group)
+
+        with self.statsLock:
+            self.stats["groups"] += 1
+            self.stats["operations"] += len(group)
+            self.stats["largest"] = max(self.stats["largest"], len(group))
+        Metrics.METRICS.inc("bank_group_commits_total")
+        Metrics.METRICS.inc("bank_group_commit_operations_total", value=len(group))
+        for (_, future), result in zip(group, results): future.set_result(result)
+
+    def getStats(self):
+        with self.statsLock: return dict(self.stats, window=self.window, max_ops=self.maxOps)
+
+    def close(self):
+        with self.closeLock:
+            if self.closed: return
+            self.closed = True
+            if self.thread is not None: self.queue.put(None)
+        if self.thread is None: return
+        self.thread.join()
+        self.thread = None
+
+
+########## Benchmark ##########
+
+# runDeposits
+## clients threads depositing 1 into random accounts 1..accounts for seconds; return operations per second
+def runDeposits(bank, accounts, clients, seconds):
+    def client(seed):
+        acc_no, count = seed % accounts + 1, 0
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            bank.deposit(acc_no, 1)
+            acc_no = acc_no % accounts + 1
+            count += 1
+        return count
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=clients) as executor:
+        total = sum(executor.map(client, range(clients)))
+    return total / (time.perf_counter() - start)
+
+# commitCount
+## Commits timed by saveTransaction so far
+def commitCount():
+    histogram = Metrics.METRICS.raw()[1].get("bank_commit_seconds", {}).get((), [])
+    return sum(histogram[:-1])
+
+# benchmarkGroupCommit
+## Deposit throughput and commits/sec without group commit (window None) and with each window
+## Return a list of (window, ops/s, commits/s, operations per commit)
+def benchmarkGroupCommit(backend, path, windows=BENCH_WINDOWS, maxOps=GROUP_MAX_OPS, accounts=BENCH_ACCOUNTS,
+                         clients=BENCH_CLIENTS, seconds=BENCH_SECONDS):
+    storage = Bank.openStorage(backend, path)
+    Bank.Bank(storage).createAccounts([(f"bench{i}", 0) for i in range(accounts)])
+    results = []
+    try:
+        for window in (None,) + tuple(windows):
+            group = GroupCommit(window, maxOps) if window is not None else None
+            bank = Bank.Bank(storage, group=group)
+            commits, start = commitCount(), time.perf_counter()
+            try:
+                rate = runDeposits(bank, accounts, clients, seconds)
+            finally:
+                if group is not None: group.close()
+            commitRate = (commitCount() - commits) / (time.perf_counter() - start)
+            results.append((window, rate, commitRate, rate / commitRate if commitRate else 0.0))
+            logging.info(f"group commit window={window} {rate:.1f} ops/s {commitRate:.1f} commits/s")
+    finally:
+        storage.disconnectDB(MySQLConnector.SAVE_ON_DISCONNECT)
+    return results
+
+
+def main():
+    # main
+    ## Parse the benchmark options
+    ## Measure deposits with group commit off and with every window, and print the table
+    parser = argparse.ArgumentParser(description="Measure commits/sec against ops/sec with group commit")
+    parser.add_argument("--windows", type=float, nargs="+", default=list(BENCH_WINDOWS), help="seconds")
+    parser.add_argument("--max-ops", type=int, default=GROUP_MAX_OPS)
+    parser.add_argument("--accounts", type=int, default=BENCH_ACCOUNTS)
+    parser.add_argument("--clients", type=int, default=BENCH_CLIENTS)
+    parser.add_argument("--seconds", type=float, default=BENCH_SECONDS)
+    parser.add_argument("--backend", choices=("mysql", "sqlite", "memory"), default=Bank.STORAGE_BACKEND)
+    parser.add_argument("--path", default="bench.db", help="SQLite database file for --backend sqlite")
+    args = parser.parse_args()
+
+    results = benchmarkGroupCommit(args.backend, args.path, args.windows, args.max_ops, args.accounts, args.clients, args.seconds)
+    print(f"{'window':>8} {'ops/s':>12} {'commits/s':>12} {'ops/commit':>11}")
+    for window, rate, commitRate, perCommit in results:
+        print(f"{'off' if window is None else window:>8} {rate:>12.1f} {commitRate:>12.1f} {perCommit:>11.1f}")
+    return results
+
+if __name__ == "__main__":
+    main()
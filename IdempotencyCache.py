@@ -0,0 +1,89 @@
+import collections
+import threading
+import hashlib
+
+# Defaults
+KEY_CACHE_SIZE   = 10000     # recent results kept in the LRU
+KEY_BLOOM_BITS   = 1 << 23   # 1 MiB bitmap, ~1% false positives at 800k keys
+KEY_BLOOM_HASHES = 7
+
+
+# KeyReused - class
+### Raised for an idempotency key that was committed by a different operation or with different arguments:
+### the request is rejected rather than answered with the result of the other one
+class KeyReused(Exception):
+
+    def __init__(self, key):
+        super().__init__(f"Idempotency key {key!r} was already used for a different request")
+        self.key = key
+
+    def __reduce__(self):
+        return (__class__, (self.key,))
+
+
+# IdempotencyCache - class
+### In-process front of the idempotency_keys table
+### A bloom filter remembers every key this process has committed or looked up, so a fresh key (the common
+### case) is known to be new without asking the database; an LRU keeps the results of recent keys so a
+### client retry is answered without a round trip. A bloom hit that is not in the LRU (false positive or
+### evicted) is looked up in the table. Keys committed by other processes are not in the filter - the
+### unique index on the table still rejects them, and the caller looks the result up after the rollback.
+##    __init__
+##    mightContain  ## False if the key was never seen by this process
+##    get           ## (True, entry) for a recent key, (False, None) otherwise
+##    remember      ## Add a committed key and its entry (Bank keeps (request, result))
+##    clear         ## Forget every key
+##    getStats      ## Bloom/LRU counters
+class IdempotencyCache():
+
+    def __init__(self, size=KEY_CACHE_SIZE, bloomBits=KEY_BLOOM_BITS, hashes=KEY_BLOOM_HASHES):
+        self.size = size
+        self.bloomBits = bloomBits
+        self.hashes = hashes
+        self.lock = threading.Lock()
+        self.bloom = bytearray((bloomBits + 7) // 8)
+        self.entries = collections.OrderedDict()   # key -> result, most recently used last
+        self.stats = {"hits": 0, "misses": 0, "bloom_negatives": 0, "remembered": 0, "evictions": 0}
+
+    def positions(self, key):
+        # Double hashing: bit i is h1 + i*h2 over one 128-bit digest
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.bloomBits for i in range(self.hashes)]
+
+    def mightContain(self, key):
+        found = all(self.bloom[bit >> 3] & (1 << (bit & 7)) for bit in self.positions(key))
+        if not found:
+            with self.lock: self.stats["bloom_negatives"] += 1
+        return found
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                self.stats["misses"] += 1
+                return False, None
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return True, self.entries[key]
+
+    def remember(self, key, result):
+        positions = self.positions(key)
+        with self.lock:
+            for bit in positions: self.bloom[bit >> 3] |= 1 << (bit & 7)
+            self.entries[key] = result
+            self.entries.move_to_end(key)
+            self.stats["remembered"] += 1
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def clear(self):
+        with self.lock:
+            self.bloom = bytearray(len(self.bloom))
+            self.entries.clear()
+
+    def getStats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats.update(size=len(self.entries), capacity=self.size)
+        return stats
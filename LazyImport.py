@@ -0,0 +1,32 @@
+import importlib.util
+import sys
+
+
+# lazyImport
+## Module object for name that is only executed on first attribute access (importlib.util.LazyLoader), so
+## importing a module that needs a heavy dependency for one code path costs nothing until that path runs
+## A module that is not installed raises ModuleNotFoundError on first use instead of at import
+## (find_spec of a submodule imports its parent package, which raises when the parent is missing too)
+def lazyImport(name):
+    if name in sys.modules: return sys.modules[name]
+    try:
+        spec = importlib.util.find_spec(name)
+    except (ImportError, ValueError):
+        spec = None
+    if spec is None: return MissingModule(name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+# MissingModule - class
+### Stand-in for a module that is not installed; any attribute access raises ModuleNotFoundError
+class MissingModule():
+
+    def __init__(self, name):
+        self.name = name
+
+    def __getattr__(self, attribute):
+        raise ModuleNotFoundError(f"No module named '{self.name}'", name=self.name)
@@ -0,0 +1,507 @@
+import Storage
+import FxRates
+import contextlib
+import threading
+import itertools
+import datetime
+import bisect
+import heapq
+import logging
+import array
+import time
+
+# Defaults
+MEMORY_STRIPES      = 1024   # row locks are striped: account_no % stripes
+MEMORY_LOCK_TIMEOUT = 1.0    # seconds to wait for a stripe before reporting a lock wait timeout
+MEMORY_SESSIONS     = 64     # advertised as size, used to size worker pools in front of the engine
+
+# Same errnos as MySQL, so Bank handles them like the MySQL errors
+ER_LOCK_WAIT_TIMEOUT = 1205
+ER_DUP_ENTRY         = 1062
+
+
+# LockWaitTimeout - exception
+### Raised when a stripe lock could not be taken within the lock timeout
+class LockWaitTimeout(Exception):
+    errno = ER_LOCK_WAIT_TIMEOUT
+
+
+# DuplicateKey - exception
+### Raised when a transaction stores an idempotency key that is already committed
+class DuplicateKey(Exception):
+    errno = ER_DUP_ENTRY
+
+
+# MemorySession - class
+### AccountSession on a MemoryStorage
+### Writes are buffered until save(); stripe locks taken by locking reads and writes are held until
+### save()/rollback(), so other sessions never see a half applied transaction on a locked account
+class MemorySession(Storage.AccountSession):
+
+    def __init__(self, store):
+        self.store = store
+        self.held = set()       # stripe indexes held by this session
+        self.pending = {}       # acc_no -> new balance
+        self.pendingStripes = {} # acc_no -> new list of stripe balances (empty - no stripes), all stripes locked
+        self.pendingStripe = {}  # (acc_no, stripe) -> new balance of one locked stripe
+        self.created = []       # account numbers reserved by addAccount in this transaction
+        self.ledger = []        # ledger entries appended at save()
+        self.ledgerKeys = set() # (idempotency_key, acc_no) of those entries
+        self.results = {}       # idempotency key -> result stored at save()
+        self.snapshots = []     # (account_no, ts, ledger_id, balance) stored at save()
+        self.fxRates = {}       # (base, quote) -> rate stored at save()
+
+    def lockStripes(self, acc_nos):
+        self.lockIndexes({acc_no % self.store.stripes for acc_no in acc_nos})
+
+    def lockBalanceStripes(self, acc_no, stripes):
+        # Stripe rows of a striped account are locked like rows of their own, on the lock of (acc_no, stripe)
+        self.lockIndexes({hash((acc_no, stripe)) % self.store.stripes for stripe in stripes})
+
+    def lockIndexes(self, indexes):
+        # Take missing lock stripes in stripe order, so two sessions can never wait on each other in a cycle
+        store = self.store
+        for stripe in sorted(set(indexes) - self.held):
+            lock = store.locks[stripe]
+            if not lock.acquire(blocking=False):
+                store.count("lock_waits")
+                if not lock.acquire(timeout=store.lockTimeout):
+                    store.count("lock_timeouts")
+                    raise LockWaitTimeout("Lock wait timeout exceeded; try restarting transaction")
+            self.held.add(stripe)
+
+    def release(self):
+        for stripe in self.held: self.store.locks[stripe].release()
+        # Numbers reserved by a transaction that did not commit are free again
+        if self.created: self.store.unreserve(self.created)
+        self.held.clear()
+        self.pending.clear()
+        self.pendingStripes.clear()
+        self.pendingStripe.clear()
+        self.created.clear()
+        self.ledger.clear()
+        self.ledgerKeys.clear()
+        self.results.clear()
+        self.snapshots.clear()
+        self.fxRates.clear()
+
+    def exists(self, acc_no):
+        return 0 < acc_no <= len(self.store.exists) and (self.store.exists[acc_no - 1] or acc_no in self.created)
+
+    def balanceOf(self, acc_no):
+        return self.pending.get(acc_no, self.store.balances[acc_no - 1])
+
+    def stripesOf(self, acc_no):
+        stripes = self.pendingStripes.get(acc_no)
+        if stripes is not None: return stripes
+        stripes = self.store.accountStripes.get(acc_no, ())
+        return [self.pendingStripe.get((acc_no, stripe), balance) for stripe, balance in enumerate(stripes, 1)]
+
+    def startTransaction(self):
+        self.release()
+
+    def save(self):
+        store = self.store
+        if self.results: store.commitResults(self.results)
+        for acc_no, balance in self.pending.items(): store.balances[acc_no - 1] = balance
+        # Single stripes are written in place, since other sessions may be committing other stripes of the account,
+        # and before whole lists, which already hold any single stripe changed earlier in the transaction
+        for (acc_no, stripe), balance in self.pendingStripe.items(): store.accountStripes[acc_no][stripe - 1] = balance
+        for acc_no, stripes in self.pendingStripes.items():
+            if stripes: store.accountStripes[acc_no] = stripes
+            else: store.accountStripes.pop(acc_no, None)
+        for acc_no in self.created: store.exists[acc_no - 1] = 1
+        if self.ledger: store.appendLedger(self.ledger)
+        if self.snapshots: store.appendSnapshots(self.snapshots)
+        # A new dict, so a session reading the rates meanwhile iterates over one version of them
+        if self.fxRates:
+            with store.fxLock: store.fxRates = {**store.fxRates, **self.fxRates}
+        self.release()
+
+    def rollback(self):
+        self.release()
+
+    def selectRowByAccNbr(self, acc_no, lock=False):
+        acc_no = int(acc_no)
+        if lock: self.lockStripes((acc_no,))
+        if not self.exists(acc_no): return None
+        return (acc_no, self.store.names[acc_no - 1], self.balanceOf(acc_no),
+                datetime.datetime.fromtimestamp(self.store.openDates[acc_no - 1]), self.store.currencies[acc_no - 1])
+
+    def selectRowsByAccNbrs(self, acc_nos, lock=False):
+        acc_nos = sorted({int(acc_no) for acc_no in acc_nos})
+        if lock: self.lockStripes(acc_nos)
+        return [(acc_no, self.store.names[acc_no - 1], self.balanceOf(acc_no), self.store.currencies[acc_no - 1])
+                for acc_no in acc_nos if self.exists(acc_no)]
+
+    def updateBalanceByAccNbr(self, acc_no, balance):
+        self.updateBalancesByAccNbrs({acc_no: balance})
+
+    def updateBalancesByAccNbrs(self, balances):
+        balances = {int(acc_no): int(balance) for acc_no, balance in balances.items()}
+        self.lockStripes(balances)
+        for acc_no, balance in balances.items():
+            if balance < 0: raise ValueError("Check constraint 'accounts_chk_1' is violated.", acc_no)
+        # Like UPDATE ... WHERE account_no = ..., missing accounts are silently skipped
+        self.pending.update((acc_no, balance) for acc_no, balance in balances.items() if self.exists(acc_no))
+
+    def transferByAccNbrs(self, src_acc_no, trgt_acc_no, amount):
+        src_acc_no, trgt_acc_no, amount = int(src_acc_no), int(trgt_acc_no), int(amount)
+        self.lockStripes((src_acc_no, trgt_acc_no))
+        changed = int(self.exists(src_acc_no) and self.balanceOf(src_acc_no) >= amount) + int(self.exists(trgt_acc_no))
+        if changed == 2:
+            self.pending[src_acc_no] = self.balanceOf(src_acc_no) - amount
+            self.pending[trgt_acc_no] = self.balanceOf(trgt_acc_no) + amount
+        return changed
+
+    def addAccount(self, name, balance, currency=FxRates.DEFAULT_CURRENCY):
+        if int(balance) < 0: raise ValueError("Check constraint 'accounts_chk_1' is violated.")
+        acc_no = self.store.reserve(name, int(balance), currency)
+        self.created.append(acc_no)
+        return acc_no
+
+    def addAccounts(self, rows):
+        acc_nos = []
+        for acc_no, name, balance, currency in rows:
+            if int(balance) < 0: raise ValueError("Check constraint 'accounts_chk_1' is violated.")
+            if acc_no is None: acc_no = self.store.reserve(name, int(balance), currency)
+            else: acc_no = self.store.reserveAt(int(acc_no), name, int(balance), currency)
+            self.created.append(acc_no)
+            acc_nos.append(acc_no)
+        return acc_nos
+
+    def streamAccounts(self, batchSize=1000):
+        # batchSize rows are copied at a time under the alloc lock, so the arrays never grow under a read
+        store = self.store
+        start = 0
+        while True:
+            with store.allocLock:
+                end = min(start + max(1, batchSize), len(store.exists))
+                rows = [(acc_no, store.names[acc_no - 1], store.balances[acc_no - 1], store.openDates[acc_no - 1],
+                         store.currencies[acc_no - 1]) for acc_no in range(start + 1, end + 1) if store.exists[acc_no - 1]]
+            if start >= end: return
+            for acc_no, name, balance, opened, currency in rows:
+                yield (acc_no, name, balance, datetime.datetime.fromtimestamp(opened), currency)
+            start = end
+
+    def getBalance(self, acc_no):
+        acc_no = int(acc_no)
+        return self.balanceOf(acc_no) if self.exists(acc_no) else None
+
+    def addLedgerEntries(self, entries):
+        # Entries only change accounts this session has locked, so the duplicate check cannot race
+        store = self.store
+        for key, acc_no, kind, amount, before, after in entries:
+            acc_no = int(acc_no)
+            if (key, acc_no) in store.ledgerKeys or (key, acc_no) in self.ledgerKeys:
+                raise ValueError(f"Duplicate entry '{key}-{acc_no}' for key 'transactions_key'")
+            self.ledgerKeys.add((key, acc_no))
+            self.ledger.append((key, acc_no, kind, int(amount), int(before), int(after)))
+
+    def selectLedgerPage(self, acc_no, after=None, limit=100, until=None):
+        rows = self.store.ledger.get(int(acc_no), ())
+        start = 0 if after is None else bisect.bisect_left(rows, (after[0], after[1] + 1))
+        end = len(rows) if until is None else bisect.bisect_left(rows, (until, Storage.LEDGER_LAST_ID))
+        return [(row_id, ts, *entry) for ts, row_id, *entry in rows[start:min(start + limit, end)]]
+
+    def selectLedgerSum(self, acc_no, after, until):
+        rows = self.store.ledger.get(int(acc_no), ())
+        start = 0 if after is None else bisect.bisect_right(rows, (after, Storage.LEDGER_LAST_ID))
+        end = bisect.bisect_left(rows, (until, Storage.LEDGER_LAST_ID))
+        return max(0, end - start), sum(row[4] for row in rows[start:end])
+
+    def selectLedgerChanges(self, after, until, limit=1000):
+        log = self.store.ledgerLog
+        start = 0 if after is None else bisect.bisect_left(log, (after[0], after[1] + 1))
+        end = bisect.bisect_left(log, (until, Storage.LEDGER_LAST_ID))
+        return [(row_id, ts, acc_no, amount) for ts, row_id, acc_no, amount in log[start:min(start + limit, end)]]
+
+    def now(self, offset=0.0):
+        return datetime.datetime.now() + datetime.timedelta(seconds=offset)
+
+    def selectSnapshotWatermark(self):
+        return self.store.snapshotWatermark
+
+    def selectSnapshotAsOf(self, acc_no, ts):
+        snapshots = self.store.snapshots.get(int(acc_no), ())
+        end = bisect.bisect_right(snapshots, (ts, Storage.LEDGER_LAST_ID))
+        return snapshots[end - 1] if end else None
+
+    def addSnapshots(self, rows):
+        self.snapshots.extend((int(acc_no), ts, int(ledger_id), int(balance)) for acc_no, ts, ledger_id, balance in rows)
+
+    # Scheduled payments are written through to the store at once - the scheduler commits right after each call
+
+    def addScheduledPayments(self, rows):
+        return self.store.addSchedules(rows)
+
+    def selectScheduledPayment(self, payment_id):
+        payment = self.store.schedules.get(int(payment_id))
+        return tuple(payment) if payment is not None else None
+
+    def claimScheduledPayments(self, limit, lease):
+        return self.store.claimSchedules(limit, self.now(), self.now(lease))
+
+    def updateScheduledPayments(self, updates):
+        return self.store.updateSchedules(updates)
+
+    def cancelScheduledPayment(self, payment_id):
+        return self.store.cancelSchedule(int(payment_id))
+
+    def selectStripeCounts(self):
+        return {acc_no: len(stripes) for acc_no, stripes in list(self.store.accountStripes.items())}
+
+    def addStripes(self, acc_no, stripes):
+        acc_no = int(acc_no)
+        self.lockBalanceStripes(acc_no, range(1, stripes + 1))
+        current = self.stripesOf(acc_no)
+        self.pendingStripes[acc_no] = current + [0] * (stripes - len(current))
+
+    def deleteStripes(self, acc_no):
+        acc_no = int(acc_no)
+        self.lockBalanceStripes(acc_no, range(1, len(self.stripesOf(acc_no)) + 1))
+        self.pendingStripes[acc_no] = []
+
+    def selectStripes(self, acc_no, lock=False):
+        acc_no = int(acc_no)
+        if lock: self.lockBalanceStripes(acc_no, range(1, len(self.stripesOf(acc_no)) + 1))
+        return [(stripe, balance) for stripe, balance in enumerate(self.stripesOf(acc_no), 1)]
+
+    def creditStripe(self, acc_no, stripe, amount):
+        acc_no, stripe = int(acc_no), int(stripe)
+        self.lockBalanceStripes(acc_no, (stripe,))
+        stripes = self.stripesOf(acc_no)
+        if not self.exists(acc_no) or not 0 < stripe <= len(stripes): return 0
+        balance = stripes[stripe - 1] + int(amount)
+        if balance < 0: raise ValueError("Check constraint 'account_stripes_chk_1' is violated.", acc_no)
+        if acc_no in self.pendingStripes: self.pendingStripes[acc_no][stripe - 1] = balance
+        else: self.pendingStripe[(acc_no, stripe)] = balance
+        return 1
+
+    def clearStripes(self, acc_no):
+        acc_no = int(acc_no)
+        self.lockBalanceStripes(acc_no, range(1, len(self.stripesOf(acc_no)) + 1))
+        self.pendingStripes[acc_no] = [0] * len(self.stripesOf(acc_no))
+
+    def sumStripes(self, acc_no):
+        return sum(self.stripesOf(int(acc_no)))
+
+    def selectStripedBalance(self, acc_no):
+        acc_no = int(acc_no)
+        return self.balanceOf(acc_no) + sum(self.stripesOf(acc_no)) if self.exists(acc_no) else None
+
+    def selectAccountBounds(self):
+        store = self.store
+        numbers = [store.exists.find(1) + 1, store.exists.rfind(1) + 1] if 1 in store.exists else []
+        numbers += [acc_no for table in (store.ledger, store.accountStripes) if table for acc_no in (min(table), max(table))]
+        return (min(numbers), max(numbers)) if numbers else (None, None)
+
+    def selectBalanceRange(self, first, last):
+        # Only committed accounts: a number reserved by an open or rolled back transaction has no account row,
+        # so ledger entries or stripes on it are orphans. Copied under the alloc lock, like streamAccounts
+        store = self.store
+        with store.allocLock:
+            start, end = max(int(first), 1) - 1, min(int(last) - 1, len(store.exists))
+            exists, balances = store.exists[start:end], store.balances[start:end]
+        return [(acc_no, balance) for acc_no, committed, balance in zip(range(start + 1, end + 1), exists, balances) if committed]
+
+    def selectLedgerTotals(self, first, last):
+        totals = []
+        for acc_no in range(int(first), int(last)):
+            rows = self.store.ledger.get(acc_no)
+            if rows: totals.append((acc_no, len(rows), sum(row[4] for row in rows), min(row[6] for row in rows)))
+        return totals
+
+    def selectStripeTotals(self, first, last):
+        totals = []
+        for acc_no in range(int(first), int(last)):
+            stripes = self.store.accountStripes.get(acc_no)
+            if stripes: totals.append((acc_no, len(stripes), sum(stripes), min(stripes)))
+        return totals
+
+    def selectFxRates(self):
+        return [(base, quote, rate) for (base, quote), rate in self.store.fxRates.items()]
+
+    def replaceFxRates(self, rows):
+        self.fxRates.update(((base, quote), rate) for base, quote, rate in rows)
+
+    def selectResultByKey(self, key):
+        return self.store.results.get(key)
+
+    def addResultByKey(self, key, result):
+        if key in self.store.results or key in self.results:
+            raise DuplicateKey(f"Duplicate entry '{key}' for key 'PRIMARY'")
+        self.results[key] = result
+
+
+# MemoryStorage - class
+### In-process storage engine for simulations and tests
+### Balances live in a compact array of 64-bit integers indexed by account_no - 1, with striped row locks.
+### Transactions are atomic (buffered until save) and balance >= 0 is enforced on every write.
+##    reserve       ## Allocate the next account number (visible once the creating transaction commits)
+##    reserveAt     ## Allocate a given account number, growing the arrays up to it
+##    unreserve     ## Free the numbers of a transaction that did not commit
+##    appendLedger  ## Stamp committed ledger entries with id and timestamp and append them per account
+##    commitResults ## Store idempotency keys atomically, failing the commit if another session stored one first
+##    appendSnapshots ## Store committed balance snapshots per account, in ts order
+##    addSchedules, claimSchedules, updateSchedules, cancelSchedule  ## The scheduled_payments table and its due index
+##    borrow        ## Context manager yielding a MemorySession; an unfinished transaction is rolled back on return
+##    count         ## Add one to a lock wait counter
+##    getStats      ## Account count and lock wait counters
+class MemoryStorage(Storage.AccountStorage):
+
+    def __init__(self, stripes=MEMORY_STRIPES, lockTimeout=MEMORY_LOCK_TIMEOUT, size=MEMORY_SESSIONS):
+        self.stripes = stripes
+        self.lockTimeout = lockTimeout
+        self.size = size
+        self.locks = [threading.Lock() for _ in range(stripes)]
+        self.allocLock = threading.Lock()
+        self.balances = array.array("q")
+        self.openDates = array.array("d")
+        self.exists = bytearray()
+        self.names = []
+        self.currencies = []
+        self.ledger = {}                # acc_no -> [(ts, id, idempotency_key, kind, amount, before, after)] in (ts, id) order
+        self.ledgerLog = []             # (ts, id, acc_no, amount) of every account in (ts, id) order - the (ts, id) index
+        self.ledgerKeys = set()         # (idempotency_key, acc_no) - the unique key of the transactions table
+        self.ledgerLock = threading.Lock()
+        self.ledgerIds = itertools.count(1)
+        self.results = {}               # idempotency key -> result - the idempotency_keys table
+        self.resultsLock = threading.Lock()
+        self.snapshots = {}             # acc_no -> [(ts, ledger_id, balance)] in ts order - the account_snapshots table
+        self.snapshotWatermark = None   # latest snapshot ts
+        self.schedules = {}             # payment id -> [Storage.SCHEDULE_COLUMNS values] - the scheduled_payments table
+        self.scheduleDue = []           # heap of (time the payment can next be claimed, id); stale entries are skipped
+        self.scheduleLock = threading.Lock()
+        self.scheduleIds = itertools.count(1)
+        self.accountStripes = {}        # acc_no -> [balance of stripe 1, 2, ...] - the account_stripes table
+        self.fxRates = {}               # (base, quote) -> rate - the fx_rates table, replaced as a whole on every commit
+        self.fxLock = threading.Lock()
+        self.stats = {"lock_waits": 0, "lock_timeouts": 0}
+        self.statsLock = threading.Lock()
+        logging.debug(f"Memory storage ready with {stripes} lock stripes")
+
+    def reserve(self, name, balance, currency):
+        with self.allocLock:
+            self.balances.append(balance)
+            self.openDates.append(time.time())
+            self.names.append(name)
+            self.currencies.append(currency)
+            self.exists.append(0)
+            return len(self.exists)
+
+    def reserveAt(self, acc_no, name, balance, currency):
+        with self.allocLock:
+            if acc_no < 1: raise ValueError(f"Invalid account number {acc_no}")
+            if acc_no <= len(self.exists) and self.names[acc_no - 1] is not None:
+                raise DuplicateKey(f"Duplicate entry '{acc_no}' for key 'PRIMARY'")
+            # Numbers skipped over stay free (name None) until reserved themselves
+            while len(self.exists) < acc_no:
+                self.balances.append(0)
+                self.openDates.append(0.0)
+                self.names.append(None)
+                self.currencies.append(None)
+                self.exists.append(0)
+            self.balances[acc_no - 1] = balance
+            self.openDates[acc_no - 1] = time.time()
+            self.names[acc_no - 1] = name
+            self.currencies[acc_no - 1] = currency
+            return acc_no
+
+    def unreserve(self, acc_nos):
+        # Committed numbers are skipped: release() also runs after save()
+        with self.allocLock:
+            for acc_no in acc_nos:
+                if not self.exists[acc_no - 1]:
+                    self.balances[acc_no - 1] = 0
+                    self.names[acc_no - 1] = None
+                    self.currencies[acc_no - 1] = None
+
+    def appendLedger(self, entries):
+        with self.ledgerLock:
+            ts = datetime.datetime.now()
+            for key, acc_no, kind, amount, before, after in entries:
+                row_id = next(self.ledgerIds)
+                self.ledger.setdefault(acc_no, []).append((ts, row_id, key, kind, amount, before, after))
+                self.ledgerLog.append((ts, row_id, acc_no, amount))
+                self.ledgerKeys.add((key, acc_no))
+
+    def commitResults(self, results):
+        # Checked again under the lock: two sessions may both have added the key before either committed
+        with self.resultsLock:
+            for key in results:
+                if key in self.results: raise DuplicateKey(f"Duplicate entry '{key}' for key 'PRIMARY'")
+            self.results.update(results)
+
+    def appendSnapshots(self, rows):
+        # Snapshots of an account only ever move forward in time; an older or equal one is rejected as a whole
+        with self.ledgerLock:
+            for acc_no, ts, ledger_id, balance in rows:
+                snapshots = self.snapshots.get(acc_no)
+                if snapshots and snapshots[-1][0] >= ts: raise DuplicateKey(f"Duplicate entry '{acc_no}-{ts}' for key 'PRIMARY'")
+            for acc_no, ts, ledger_id, balance in rows:
+                self.snapshots.setdefault(acc_no, []).append((ts, ledger_id, balance))
+                if self.snapshotWatermark is None or ts > self.snapshotWatermark: self.snapshotWatermark = ts
+
+    @staticmethod
+    def claimableAt(payment):
+        # Due and not leased: the later of next_run and lease_until
+        next_run, lease_until = payment[6], payment[11]
+        return next_run if lease_until is None or lease_until < next_run else lease_until
+
+    def addSchedules(self, rows):
+        with self.scheduleLock:
+            payment_ids = []
+            for source, target, amount, period, first_run, remaining in rows:
+                payment_id = next(self.scheduleIds)
+                self.schedules[payment_id] = [payment_id, int(source), int(target), int(amount), period, first_run, first_run,
+                                              0, remaining, 0, "active", None, None]
+                heapq.heappush(self.scheduleDue, (first_run, payment_id))
+                payment_ids.append(payment_id)
+            return payment_ids
+
+    def claimSchedules(self, limit, now, leaseUntil):
+        with self.scheduleLock:
+            claimed = []
+            while self.scheduleDue and self.scheduleDue[0][0] <= now and len(claimed) < limit:
+                at, payment_id = heapq.heappop(self.scheduleDue)
+                payment = self.schedules[payment_id]
+                if payment[10] != "active" or self.claimableAt(payment) != at: continue
+                payment[11] = leaseUntil
+                heapq.heappush(self.scheduleDue, (leaseUntil, payment_id))   # claimable again if the lease runs out
+                claimed.append(tuple(payment))
+            return claimed
+
+    def updateSchedules(self, updates):
+        with self.scheduleLock:
+            applied = 0
+            for payment_id, claimedRuns, next_run, runs, remaining, attempts, status, lease_until, last_result in updates:
+                payment = self.schedules.get(int(payment_id))
+                if payment is None or payment[7] != claimedRuns: continue
+                payment[6:13] = [next_run, runs, remaining, attempts, status, lease_until, last_result]
+                if status == "active": heapq.heappush(self.scheduleDue, (self.claimableAt(payment), payment[0]))
+                applied += 1
+            return applied
+
+    def cancelSchedule(self, payment_id):
+        with self.scheduleLock:
+            payment = self.schedules.get(payment_id)
+            if payment is None or payment[10] != "active": return False
+            payment[10] = "cancelled"
+            return True
+
+    @contextlib.contextmanager
+    def borrow(self):
+        session = MemorySession(self)
+        try:
+            yield session
+        finally:
+            session.release()
+
+    def count(self, name):
+        with self.statsLock: self.stats[name] += 1
+
+    def getStats(self):
+        with self.statsLock: stats = dict(self.stats)
+        stats.update(accounts=len(self.exists), stripes=self.stripes)
+        return stats
@@ -0,0 +1,225 @@
+import functools
+import threading
+import argparse
+import logging
+import bisect
+import json
+import time
+
+# Latency histogram bucket bounds, seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Overhead benchmark
+BENCH_CALLS = 200000
+
+
+# succeeded
+## Bank methods report failure as False (transfer as (False, switch))
+def succeeded(result):
+    if isinstance(result, tuple): return result[0] is not False
+    return result is not False
+
+
+# escapeLabel
+## Label value as Prometheus text needs it: backslash, double quote and newline escaped
+def escapeLabel(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+# Metrics - class
+### Process-wide registry of counters and latency histograms, exported as Prometheus text or JSON
+### Series are keyed by name and a tuple of (label, value) pairs built once by the caller, so recording
+### is one dict lookup under a lock. When disabled every recording method returns straight away.
+##    __init__
+##    inc           ## Add to a counter
+##    observe       ## Add a sample to a histogram
+##    record        ## Count and time one finished operation
+##    operation     ## Decorator counting and timing a Bank operation, then calling the tracing hooks
+##    addHook       ## Register a tracing hook called with (operation, seconds, ok) after every operation (errors are logged)
+##    snapshot      ## Plain dict of every series
+##    prometheus    ## Prometheus text exposition, with optional extra gauges
+##    dump          ## Write the snapshot to a JSON file
+##    raw           ## Copy of every series, to send to another process
+##    merge         ## Add series from raw() of another registry (worker processes)
+##    reset         ## Drop every series
+class Metrics():
+
+    def __init__(self, enabled=True, buckets=LATENCY_BUCKETS):
+        self.enabled = enabled
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.counters = {}      # name -> {labels: value}
+        self.histograms = {}    # name -> {labels: [bucket counts..., +Inf count, sum]}
+        self.hooks = []
+
+    def inc(self, name, labels=(), value=1):
+        if not self.enabled: return
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[labels] = series.get(labels, 0) + value
+
+    def observe(self, name, value, labels=()):
+        if not self.enabled: return
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            entry = series.get(labels)
+            if entry is None: entry = series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            entry[index] += 1
+            entry[-1] += value
+
+    def record(self, resultLabels, labels, elapsed):
+        # bank_operations_total and bank_operation_seconds of one operation under a single lock
+        index = bisect.bisect_left(self.buckets, elapsed)
+        with self.lock:
+            counters = self.counters.setdefault("bank_operations_total", {})
+            counters[resultLabels] = counters.get(resultLabels, 0) + 1
+            series = self.histograms.setdefault("bank_operation_seconds", {})
+            entry = series.get(labels)
+            if entry is None: entry = series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            entry[index] += 1
+            entry[-1] += elapsed
+
+    def operation(self, name):
+        labels = (("operation", name),)
+        okLabels, errorLabels = labels + (("result", "ok"),), labels + (("result", "error"),)
+
+        def decorate(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled: return func(*args, **kwargs)
+                start = time.perf_counter()
+                result = func(*args, **kwargs)
+                elapsed = time.perf_counter() - start
+                ok = succeeded(result)
+                self.record(okLabels if ok else errorLabels, labels, elapsed)
+                for hook in self.hooks:
+                    # The operation has committed: a failing hook must not make it look failed to the caller
+                    try:
+                        hook(name, elapsed, ok)
+                    except Exception as e:
+                        logging.error(f"Metrics hook {hook!r} failed: {e!r}")
+                return result
+            return wrapper
+        return decorate
+
+    def addHook(self, hook):
+        self.hooks.append(hook)
+
+    def snapshot(self):
+        with self.lock:
+            counters = {name: [{"labels": dict(labels), "value": value} for labels, value in series.items()]
+                        for name, series in self.counters.items()}
+            histograms = {name: [{"labels": dict(labels), "buckets": dict(zip(map(str, self.buckets + (float("inf"),)), entry[:-1])),
+                                  "count": sum(entry[:-1]), "sum": entry[-1]} for labels, entry in series.items()]
+                          for name, series in self.histograms.items()}
+        return {"counters": counters, "histograms": histograms}
+
+    def prometheus(self, gauges=None):
+        # gauges: {name: value} of point-in-time values (pool occupancy, cache size, ...) appended as gauges
+        def formatLabels(labels, extra=()):
+            pairs = labels + extra
+            return "{" + ",".join(f'{key}="{escapeLabel(value)}"' for key, value in pairs) + "}" if pairs else ""
+
+        lines = []
+        with self.lock:
+            for name, series in sorted(self.counters.items()):
+                lines.append(f"# TYPE {name} counter")
+                lines.extend(f"{name}{formatLabels(labels)} {value}" for labels, value in series.items())
+            for name, series in sorted(self.histograms.items()):
+                lines.append(f"# TYPE {name} histogram")
+                for labels, entry in series.items():
+                    cumulative = 0
+                    for bound, count in zip(self.buckets + ("+Inf",), entry[:-1]):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{formatLabels(labels, (('le', bound),))} {cumulative}")
+                    lines.append(f"{name}_sum{formatLabels(labels)} {entry[-1]}")
+                    lines.append(f"{name}_count{formatLabels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n" + formatGauges(gauges)
+
+    def dump(self, path):
+        with open(path, "w") as f: json.dump(self.snapshot(), f, indent=1)
+
+    def raw(self):
+        with self.lock:
+            return ({name: dict(series) for name, series in self.counters.items()},
+                    {name: {labels: list(entry) for labels, entry in series.items()} for name, series in self.histograms.items()})
+
+    def merge(self, raw):
+        counters, histograms = raw
+        with self.lock:
+            for name, series in counters.items():
+                mine = self.counters.setdefault(name, {})
+                for labels, value in series.items(): mine[labels] = mine.get(labels, 0) + value
+            for name, series in histograms.items():
+                mine = self.histograms.setdefault(name, {})
+                for labels, entry in series.items():
+                    if labels in mine: mine[labels] = [a + b for a, b in zip(mine[labels], entry)]
+                    else: mine[labels] = list(entry)
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+
+# Registry used by Bank and the storage backends
+METRICS = Metrics()
+
+
+# formatGauges
+## Prometheus text of {name: value} point-in-time values, one gauge each
+def formatGauges(gauges):
+    return "".join(f"# TYPE {name} gauge\n{name} {value}\n" for name, value in sorted((gauges or {}).items()))
+
+# gauges
+## Numeric entries of stats dicts as Prometheus gauge names: {"bank_storage_checkouts": 12, ...}
+def gauges(**sources):
+    return {f"bank_{source}_{key}": value for source, stats in sources.items() if stats
+            for key, value in stats.items() if isinstance(value, (int, float)) and not isinstance(value, bool)}
+
+
+########## Overhead benchmark ##########
+
+# measure
+## Nanoseconds per call of func, averaged over calls
+def measure(func, calls):
+    start = time.perf_counter()
+    for _ in range(calls): func()
+    return (time.perf_counter() - start) / calls * 1e9
+
+# benchmarkOverhead
+## Cost of the operation decorator on an empty function and on Bank.checkBalance/deposit (memory backend),
+## with metrics enabled and disabled
+## Return {case: ns per call}
+def benchmarkOverhead(calls=BENCH_CALLS):
+    import Bank
+    registry = Metrics()
+    plain = lambda: None
+    wrapped = registry.operation("noop")(plain)
+    bank = Bank.Bank(Bank.openStorage("memory"))
+    acc_no = bank.createAccount("bench", 0)
+
+    results = {"noop undecorated": measure(plain, calls)}
+    for enabled in (False, True):
+        registry.enabled = METRICS.enabled = enabled
+        state = "enabled" if enabled else "disabled"
+        results[f"noop {state}"] = measure(wrapped, calls)
+        results[f"checkBalance {state}"] = measure(lambda: bank.checkBalance(acc_no), calls // 10)
+        results[f"deposit {state}"] = measure(lambda: bank.deposit(acc_no, 1), calls // 10)
+    return results
+
+
+def main():
+    # main
+    ## Run the overhead benchmark and print ns per call
+    parser = argparse.ArgumentParser(description="Measure the overhead of Bank metrics")
+    parser.add_argument("--calls", type=int, default=BENCH_CALLS)
+    args = parser.parse_args()
+
+    results = benchmarkOverhead(args.calls)
+    for case, ns in results.items(): print(f"{case:<24}{ns:>10.0f} ns/call")
+    return results
+
+if __name__ == "__main__":
+    main()
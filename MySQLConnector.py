@@ -1,11 +1,22 @@
-import mysql.connector as connector
+import LazyImport
+import collections
+import contextlib
+import threading
 import logging
+import time
+
+# mysql.connector is loaded on first use, so importing Bank for the sqlite/memory backends does not pay for it
+connector = LazyImport.lazyImport("mysql.connector")
 
 # Save when disconnected from database server
 SAVE_ON_DISCONNECT = True
 
-# Logging
-logging.basicConfig(filename='database.log', format='%(asctime)s - Process ID:%(process)d ---- %(levelname)s ---- %(message)s', datefmt='%d-%b-%y %H:%M:%S')
+# Connection pool
+POOL_SIZE             = 8     # maximum number of open connections
+POOL_CHECKOUT_TIMEOUT = 30    # seconds to wait for a free connection before giving up
+POOL_MAX_IDLE         = 300   # seconds a connection may sit idle before it is evicted
+POOL_PING_IDLE        = 1     # seconds idle after which a checkout pings the connection first
+REPLICA_PORT          = 3306  # port of a replica endpoint given as a bare host
 
 class mysqlDB():
     def __init__(self, MYSQL_HOST, MYSQL_USERNAME, MYSQL_PASSWORD, MYSQL_DATABASE):
@@ -13,37 +24,60 @@ class mysqlDB():
         self.username = MYSQL_USERNAME
         self._password = MYSQL_PASSWORD
         self.database = MYSQL_DATABASE
-        self.connection = 0
-        self.connectDB()
-        self.cursor = self.getNewCursor() if self.getConnection().is_connected() else False
+        self.connection = None      # opened by the first getConnection/getCursor, False if that failed
+        self.cursor = None
+        self.prepared = {}
         
     def save(self):
-        self.connection.commit()
+        self.getConnection().commit()
     
     def rollback(self):
-        self.connection.rollback()
+        self.getConnection().rollback()
         
     def getConnection(self):
+        if self.connection is None: self.connectDB()
         return self.connection
     
     def getCursor(self):
+        if self.cursor is None and self.getConnection() is not False:
+            self.cursor = self.getNewCursor() if self.connection.is_connected() else False
         return self.cursor
     
+    def getStreamCursor(self):
+        # Unbuffered: rows are fetched from the server as they are read - close it before the next query
+        return self.getConnection().cursor(buffered=False)
+    
+    def getPreparedCursor(self, name):
+        # One server-side prepared statement per name, prepared on first use and kept with the connection
+        cursor = self.prepared.get(name)
+        if cursor is None: cursor = self.prepared[name] = self.getConnection().cursor(prepared=True)
+        return cursor
+    
+    @contextlib.contextmanager
+    def borrow(self):
+        # A single connection is shared by every caller
+        yield self
+    
     def connectDB(self):
         try:
             connection = connector.connect(host = self.host, user = self.username, passwd = self._password, database = self.database)
             logging.debug(f'Connection to Database: {self.database} was successful')
         except:
             logging.error(f'Connection to Database: {self.database} was unsuccessful')
+            connection = False
         self.connection = connection
+        return connection
 
     def disconnectDB(self, save=1):
-        if self.getConnection() is not False:
+        # Nothing to close if the connection was never opened
+        if self.connection:
             # save
             if save: self.save()
 
             # disconnect
-            self.cursor.close()
+            for cursor in self.prepared.values(): cursor.close()
+            self.prepared.clear()
+            if self.cursor: self.cursor.close()
             self.connection.close()
             self.connection = False
             # logging.debug('Connection to database has been stopped')
@@ -54,4 +88,234 @@ class mysqlDB():
         except connector.Error:
             logging.debug(f'Connection to Database: {self.database} was unsuccessful')
             self.connection = self.connectDB()
-        return self.connection.cursor(buffered=True)
\ No newline at end of file
+        self.prepared.clear()
+        return self.connection.cursor(buffered=True)
+
+
+# pooledConnection - class
+### One connection owned by a mysqlPool
+### Exposes the same save/rollback/getConnection/getCursor interface as mysqlDB
+class pooledConnection():
+    def __init__(self, connection):
+        self.connection = connection
+        self.cursor = connection.cursor(buffered=True)
+        self.prepared = {}      # statement name -> prepared cursor
+        self.created = self.lastUsed = time.monotonic()
+        self.broken = False
+    
+    def save(self):
+        self.connection.commit()
+    
+    def rollback(self):
+        # A failed rollback means the link is gone; drop the connection at checkin
+        try:
+            self.connection.rollback()
+        except connector.Error as e:
+            logging.error(e)
+            self.broken = True
+    
+    def getConnection(self):
+        return self.connection
+    
+    def getCursor(self):
+        return self.cursor
+    
+    def getStreamCursor(self):
+        return self.getConnection().cursor(buffered=False)
+    
+    def getPreparedCursor(self, name):
+        cursor = self.prepared.get(name)
+        if cursor is None: cursor = self.prepared[name] = self.getConnection().cursor(prepared=True)
+        return cursor
+    
+    def close(self):
+        try:
+            for cursor in self.prepared.values(): cursor.close()
+            if self.cursor: self.cursor.close()
+            self.connection.close()
+        except connector.Error:
+            pass
+
+
+# mysqlPool - class
+### Bounded pool of MySQL connections shared by every Bank operation in the process
+##    checkout      ## Borrow a connection, waiting up to timeout seconds for one to be returned
+##    checkin       ## Return a borrowed connection to the pool
+##    borrow        ## Context manager around checkout/checkin
+##    evictIdle     ## Close connections idle for longer than maxIdle
+##    getStats      ## Wait-time and occupancy counters
+##    disconnectDB  ## Close every connection and refuse further checkouts
+class mysqlPool():
+    def __init__(self, MYSQL_HOST, MYSQL_USERNAME, MYSQL_PASSWORD, MYSQL_DATABASE, size=POOL_SIZE,
+                 timeout=POOL_CHECKOUT_TIMEOUT, maxIdle=POOL_MAX_IDLE, pingIdle=POOL_PING_IDLE, port=None):
+        self.host = MYSQL_HOST
+        self.port = port                    # None - the connector's default
+        self.username = MYSQL_USERNAME
+        self._password = MYSQL_PASSWORD
+        self.database = MYSQL_DATABASE
+        self.size = size
+        self.timeout = timeout
+        self.maxIdle = maxIdle
+        self.pingIdle = pingIdle
+        
+        self.lock = threading.Condition()
+        self.idle = collections.deque()     # most recently returned connection on the right
+        self.opened = 0                     # idle + checked out + being opened
+        self.inUse = 0
+        self.closed = False
+        self.stats = {"checkouts": 0, "waits": 0, "wait_time": 0.0, "max_wait": 0.0, "timeouts": 0,
+                      "created": 0, "evicted": 0, "failed_health_checks": 0, "max_in_use": 0}
+        
+        self.checked = False                # first connection opened by isConnected or the first checkout
+    
+    def isConnected(self):
+        # Open the first connection on the first call so bad credentials are reported at startup
+        # without making every pool construction (and import of its caller) wait on the server
+        if not self.checked and not self.closed:
+            try:
+                self.checkin(self.checkout())
+            except connector.Error:
+                logging.error(f'Connection to Database: {self.database} was unsuccessful')
+                self.closed = True
+        return not self.closed
+    
+    def newConnection(self):
+        options = {"port": self.port} if self.port is not None else {}
+        connection = connector.connect(host = self.host, user = self.username, passwd = self._password, database = self.database, **options)
+        logging.debug(f'Connection to Database: {self.database} was successful')
+        with self.lock:
+            self.stats["created"] += 1
+            self.checked = True
+        return pooledConnection(connection)
+    
+    def isHealthy(self, conn):
+        # Connections returned moments ago were just used successfully; skip the round trip
+        if time.monotonic() - conn.lastUsed < self.pingIdle: return True
+        try:
+            conn.getConnection().ping(reconnect=False)
+            return True
+        except connector.Error:
+            with self.lock: self.stats["failed_health_checks"] += 1
+            return False
+    
+    def takeExpired(self):
+        # Remove idle connections past maxIdle (oldest are on the left); caller must hold the lock
+        expired = []
+        now = time.monotonic()
+        while self.idle and now - self.idle[0].lastUsed > self.maxIdle:
+            expired.append(self.idle.popleft())
+            self.opened -= 1
+        self.stats["evicted"] += len(expired)
+        return expired
+    
+    def evictIdle(self):
+        with self.lock:
+            expired = self.takeExpired()
+            if expired: self.lock.notify_all()
+        for conn in expired: conn.close()
+        return len(expired)
+    
+    def checkout(self, timeout=None):
+        # checkout
+        ## Take the most recently used idle connection, or open a new one while below size
+        ## otherwise wait for a checkin until the timeout runs out
+        ## Health check the connection outside the lock and replace it if it is dead
+        timeout = self.timeout if timeout is None else timeout
+        start = time.monotonic()
+        waited = False
+        
+        with self.lock:
+            expired = self.takeExpired()
+            while True:
+                if self.closed:
+                    raise connector.errors.PoolError("Connection pool is closed")
+                if self.idle:
+                    conn = self.idle.pop()
+                    break
+                if self.opened < self.size:
+                    self.opened += 1
+                    conn = None
+                    break
+                remaining = start + timeout - time.monotonic()
+                if remaining <= 0:
+                    self.stats["timeouts"] += 1
+                    raise connector.errors.PoolError(f"No connection available after {timeout} seconds")
+                waited = True
+                self.lock.wait(remaining)
+            
+            wait = time.monotonic() - start
+            self.stats["checkouts"] += 1
+            self.stats["wait_time"] += wait
+            self.stats["max_wait"] = max(self.stats["max_wait"], wait)
+            if waited: self.stats["waits"] += 1
+            self.inUse += 1
+            self.stats["max_in_use"] = max(self.stats["max_in_use"], self.inUse)
+        
+        for old in expired: old.close()
+        
+        try:
+            if conn is not None and not self.isHealthy(conn):
+                conn.close()
+                conn = None
+            if conn is None: conn = self.newConnection()
+        except Exception:
+            with self.lock:
+                self.opened -= 1
+                self.inUse -= 1
+                self.lock.notify()
+            raise
+        return conn
+    
+    def checkin(self, conn):
+        # checkin
+        ## Never hand an open transaction to the next borrower
+        ## Close the connection if it is broken or the pool has been shut down
+        if not conn.broken and conn.getConnection().in_transaction: conn.rollback()
+        conn.lastUsed = time.monotonic()
+        
+        with self.lock:
+            self.inUse -= 1
+            discard = self.closed or conn.broken
+            if discard: self.opened -= 1
+            else: self.idle.append(conn)
+            self.lock.notify()
+        if discard: conn.close()
+    
+    @contextlib.contextmanager
+    def borrow(self, timeout=None):
+        conn = self.checkout(timeout)
+        try:
+            yield conn
+        finally:
+            self.checkin(conn)
+    
+    def getStats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats.update(size=self.size, opened=self.opened, in_use=self.inUse, idle=len(self.idle),
+                         occupancy=self.inUse / self.size if self.size else 0.0,
+                         avg_wait=stats["wait_time"] / stats["checkouts"] if stats["checkouts"] else 0.0)
+        return stats
+    
+    def disconnectDB(self, save=1):
+        # Idle connections never hold an open transaction, so there is nothing left to save;
+        # checked out connections are closed when they are returned
+        with self.lock:
+            self.closed = True
+            idle, self.idle = list(self.idle), collections.deque()
+            self.opened -= len(idle)
+            self.lock.notify_all()
+        for conn in idle: conn.close()
+
+
+# parseEndpoint
+## (host, port) of a "host" or "host:port" replica endpoint
+def parseEndpoint(endpoint):
+    host, _, port = endpoint.strip().partition(":")
+    return host, int(port) if port else REPLICA_PORT
+
+# replicaPools
+## One mysqlPool per replica endpoint, with the primary's credentials and pool options
+def replicaPools(endpoints, MYSQL_USERNAME, MYSQL_PASSWORD, MYSQL_DATABASE, **options):
+    return [mysqlPool(host, MYSQL_USERNAME, MYSQL_PASSWORD, MYSQL_DATABASE, port=port, **options)
+            for host, port in map(parseEndpoint, endpoints)]
@@ -0,0 +1,111 @@
+import LazyImport
+import contextlib
+import threading
+import logging
+import time
+
+# sqlite3 is loaded when the first SQLite database is opened
+sqlite3 = LazyImport.lazyImport("sqlite3")
+
+# Default database - in-memory, gone when the process exits
+SQLITE_PATH = ":memory:"
+
+# Seconds between refreshes of an sqliteCopy
+COPY_INTERVAL = 0.5
+
+# sqliteDB - class
+### Local stand-in for MySQLConnector.mysqlDB: one SQLite connection with the same
+### save/rollback/getConnection/getCursor/getStreamCursor/getPreparedCursor/borrow/disconnectDB interface
+### borrow() serializes callers on a lock, since SQLite runs one write transaction at a time anyway
+class sqliteDB():
+    def __init__(self, path=SQLITE_PATH):
+        self.path = path
+        self.size = 1
+        self.lock = threading.RLock()
+        self.connection = False
+        self.connectDB()
+        self.cursor = self.connection.cursor() if self.connection is not False else False
+
+    def save(self):
+        self.connection.commit()
+
+    def rollback(self):
+        self.connection.rollback()
+
+    def getConnection(self):
+        return self.connection
+
+    def getCursor(self):
+        return self.cursor
+
+    def getStreamCursor(self):
+        # SQLite cursors step through the result as rows are fetched
+        return self.connection.cursor()
+
+    def getPreparedCursor(self, name):
+        # sqlite3 keeps compiled statements in a per-connection cache keyed by their text
+        return self.cursor
+
+    @contextlib.contextmanager
+    def borrow(self):
+        with self.lock:
+            yield self
+
+    def connectDB(self):
+        try:
+            # isolation_level=None: transactions are started explicitly with BEGIN IMMEDIATE
+            self.connection = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            logging.debug(f'Connection to SQLite database: {self.path} was successful')
+        except sqlite3.Error:
+            logging.error(f'Connection to SQLite database: {self.path} was unsuccessful')
+            self.connection = False
+
+    def disconnectDB(self, save=1):
+        if self.getConnection() is not False:
+            with self.lock:
+                if save and self.connection.in_transaction: self.save()
+                self.cursor.close()
+                self.connection.close()
+                self.connection = False
+
+
+# sqliteCopy - class
+### In-process stand-in for a read replica of an SQLite file: an in-memory database that a background thread
+### refreshes from the file every interval seconds with the sqlite3 backup API, so its reads are behind the file
+### by up to interval seconds plus the copy time, like those of an asynchronous replica
+### lag() is the age of the data it holds: seconds since the refresh that copied it started
+class sqliteCopy(sqliteDB):
+    def __init__(self, source, interval=COPY_INTERVAL):
+        super().__init__(":memory:")
+        self.source = source
+        self.interval = interval
+        self.copiedAt = None
+        self.stop = threading.Event()
+        self.refresh()
+        self.copier = threading.Thread(target=self.run, name="SQLiteCopy", daemon=True)
+        self.copier.start()
+
+    def refresh(self):
+        # A connection of its own reads the file, so the copy never waits for the primary's borrow lock
+        started = time.time()
+        source = sqlite3.connect(self.source)
+        try:
+            with self.lock: source.backup(self.connection)
+        finally:
+            source.close()
+        self.copiedAt = started
+
+    def run(self):
+        while not self.stop.wait(self.interval):
+            try:
+                self.refresh()
+            except sqlite3.Error as e:
+                logging.error(f"Copy of SQLite database {self.source} failed: {e}")
+
+    def lag(self):
+        return None if self.copiedAt is None else time.time() - self.copiedAt
+
+    def disconnectDB(self, save=1):
+        self.stop.set()
+        self.copier.join()
+        super().disconnectDB(save)
@@ -0,0 +1,287 @@
+import Bank
+import FxRates
+import Storage
+import MySQLConnector
+import concurrent.futures
+import threading
+import argparse
+import calendar
+import datetime
+import logging
+import time
+
+# Defaults
+SCHEDULE_BATCH    = 500     # due payments claimed per round trip
+SCHEDULE_LEASE    = 300.0   # seconds a claimed batch is reserved for the worker that claimed it
+SCHEDULE_RETRY    = 60.0    # seconds before a failed payment is tried again
+SCHEDULE_ATTEMPTS = 3       # tries of one occurrence before it is skipped
+SCHEDULE_POLL     = 1.0     # seconds an idle worker waits before looking for due payments again
+SCHEDULE_THREADS  = 8       # payments of one batch executed at the same time
+
+# Recurrence of a payment
+PERIODS = ("once", "daily", "weekly", "monthly")
+
+# Benchmark
+BENCH_PAYMENTS = 100000
+BENCH_ACCOUNTS = 1000
+BENCH_WORKERS  = 4
+
+
+# toDatetime
+## Timestamps come back as datetime (MySQL, memory) or as text (SQLite)
+def toDatetime(value):
+    return value if isinstance(value, datetime.datetime) else datetime.datetime.fromisoformat(value)
+
+# addMonths
+## Same day and time months later, on the last day of the month where that day does not exist
+def addMonths(ts, months):
+    year, month = divmod(ts.month - 1 + months, 12)
+    year, month = ts.year + year, month + 1
+    return ts.replace(year=year, month=month, day=min(ts.day, calendar.monthrange(year, month)[1]))
+
+# occurrence
+## Due time of occurrence n (0 - first_run) of a payment; counted from first_run so a monthly payment on the
+## 31st comes back to the 31st after a short month
+def occurrence(first_run, period, n):
+    first_run = toDatetime(first_run)
+    if period == "daily": return first_run + datetime.timedelta(days=n)
+    if period == "weekly": return first_run + datetime.timedelta(weeks=n)
+    if period == "monthly": return addMonths(first_run, n)
+    return first_run
+
+# transferError
+## Text of the switch of a failed transfer result (Bank.TRANSFER_ERRORS)
+def transferError(result):
+    return Bank.TRANSFER_ERRORS.get(result[1], f"error {result[1]}")
+
+
+# Scheduler - class
+### Standing orders kept in the scheduled_payments table and paid by any number of workers in parallel
+### A worker claims a batch of due payments (SKIP LOCKED, then a lease), pays each one with Bank.transfer and
+### moves it on to its next occurrence. Every occurrence is paid under the idempotency key
+### "schedule:<id>:<occurrence>", so a payment whose worker died after paying and before rescheduling is only
+### replayed, never paid twice, by the worker that claims it when the lease runs out. Updates only apply while the
+### payment still has the occurrence count the worker claimed, so a slow worker cannot move it on twice either.
+### A failed payment (missing account, insufficient funds) is tried again after SCHEDULE_RETRY seconds and
+### skipped after SCHEDULE_ATTEMPTS tries. Times are in the database's clock (UTC for SQLite).
+##    __init__
+##    schedule      ## Add one payment, return its id
+##    scheduleMany  ## Add (source, target, amount, first_run, period, count) payments in one transaction, return their ids
+##    cancel        ## Stop an active payment
+##    getPayment    ## The payment as a dict
+##    runDue        ## Claim, pay and reschedule one batch; return the number of payments claimed
+##    pay           ## Pay one claimed payment and return its update
+##    run           ## Worker loop until stop is set
+##    getStats      ## Paid, failed, skipped and lost update counters
+##    close         ## Stop the payment threads
+class Scheduler():
+
+    def __init__(self, bank, storage=None, batchSize=SCHEDULE_BATCH, lease=SCHEDULE_LEASE, threads=SCHEDULE_THREADS):
+        # __init__
+        ## bank runs the transfers (a Bank or a ShardedBank); storage holds the schedule (bank.dbObj by default)
+        self.bank = bank
+        self.dbObj = storage if storage is not None else bank.dbObj
+        self.batchSize = batchSize
+        self.lease = lease
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads, thread_name_prefix="Scheduler")
+        self.statsLock = threading.Lock()
+        self.stats = {"paid": 0, "failed": 0, "skipped": 0, "lost_updates": 0}
+
+    def schedule(self, src_acc_no, trgt_acc_no, amount, first_run, period="monthly", count=None):
+        payment_ids = self.scheduleMany([(src_acc_no, trgt_acc_no, amount, first_run, period, count)])
+        return payment_ids[0] if payment_ids else False
+
+    def scheduleMany(self, payments):
+        # scheduleMany
+        ## Validate every payment: positive int amount (minor units), different accounts, known period, count None or > 0
+        ## Insert them with multi-row INSERTs in one transaction and return their ids, False on error
+        rows = []
+        for src_acc_no, trgt_acc_no, amount, first_run, period, count in payments:
+            if not FxRates.checkMinor(amount) > 0: raise ValueError(f"Amount must be positive: {amount!r}")
+            if int(src_acc_no) == int(trgt_acc_no): raise ValueError("Source and target account are the same")
+            if period not in PERIODS: raise ValueError(f"Unknown period: {period!r}")
+            if count is not None and int(count) < 1: raise ValueError(f"Count must be positive: {count!r}")
+            remaining = 1 if period == "once" else (int(count) if count is not None else None)
+            rows.append((int(src_acc_no), int(trgt_acc_no), int(amount), period, toDatetime(first_run), remaining))
+        try:
+            with self.dbObj.borrow() as dbObj:
+                try:
+                    Bank.startTransaction(dbObj)
+                    payment_ids = dbObj.addScheduledPayments(rows)
+                    Bank.saveTransaction(dbObj)
+                    return payment_ids
+                except Exception as e:
+                    Bank.rollbackTransaction(dbObj)
+                    logging.error(e)
+        except Exception as e:
+            logging.error(e)
+        return False
+
+    def cancel(self, payment_id):
+        try:
+            with self.dbObj.borrow() as dbObj:
+                Bank.startTransaction(dbObj)
+                cancelled = dbObj.cancelScheduledPayment(payment_id)
+                Bank.saveTransaction(dbObj)
+                return cancelled
+        except Exception as e:
+            logging.error(e)
+        return False
+
+    def getPayment(self, payment_id):
+        try:
+            with self.dbObj.borrow() as dbObj: row = dbObj.selectScheduledPayment(payment_id)
+            if row is not None: return dict(zip(Storage.SCHEDULE_COLUMNS, row))
+        except Exception as e:
+            logging.error(e)
+        return False
+
+    def runDue(self):
+        # runDue
+        ## Claim up to batchSize due payments in one short transaction
+        ## Pay them on the payment threads (each transfer is its own transaction)
+        ## Write every payment's next state in one transaction
+        ## Return the number of payments claimed (0 - nothing was due), False on error
+        try:
+            with self.dbObj.borrow() as dbObj:
+                try:
+                    Bank.startTransaction(dbObj)
+                    claimed = dbObj.claimScheduledPayments(self.batchSize, self.lease)
+                    Bank.saveTransaction(dbObj)
+                except Exception:
+                    Bank.rollbackTransaction(dbObj)
+                    raise
+            if not claimed: return 0
+
+            updates = list(self.executor.map(self.pay, claimed))
+            with self.dbObj.borrow() as dbObj:
+                try:
+                    Bank.startTransaction(dbObj)
+                    retryAt = dbObj.now(SCHEDULE_RETRY)
+                    updates = [update[:7] + (retryAt if update[7] else None,) + update[8:] for update in updates]
+                    applied = dbObj.updateScheduledPayments(updates)
+                    Bank.saveTransaction(dbObj)
+                except Exception:
+                    Bank.rollbackTransaction(dbObj)
+                    raise
+
+            with self.statsLock: self.stats["lost_updates"] += len(updates) - applied
+            logging.debug("Scheduler paid a batch of %d payments", len(claimed))
+            return len(claimed)
+        except Exception as e:
+            logging.error(e)
+        return False
+
+    def pay(self, row):
+        # pay
+        ## Transfer the payment under the key of its occurrence
+        ## Paid, or failed for the last allowed time: move on to the next occurrence (done after the last one)
+        ## Failed otherwise: keep the occurrence and count the attempt; the lease is set to the retry time
+        ## Return (id, runs claimed, next_run, runs, remaining, attempts, status, retry, last_result)
+        ## where retry tells runDue to hold the payment until the retry time
+        payment = dict(zip(Storage.SCHEDULE_COLUMNS, row))
+        runs, remaining, attempts = payment["runs"], payment["remaining"], payment["attempts"]
+        key = f"schedule:{payment['id']}:{runs}"
+        result = self.bank.transfer(payment["source_account"], payment["target_account"], payment["amount"], key=key)
+
+        if result[0] is False and attempts + 1 < SCHEDULE_ATTEMPTS:
+            with self.statsLock: self.stats["failed"] += 1
+            return (payment["id"], runs, payment["next_run"], runs, remaining, attempts + 1, "active", True,
+                    f"failed ({attempts + 1}/{SCHEDULE_ATTEMPTS}): {transferError(result)}")
+
+        with self.statsLock: self.stats["paid" if result[0] is not False else "skipped"] += 1
+        lastResult = "paid" if result[0] is not False else f"skipped: {transferError(result)}"
+        remaining = remaining - 1 if remaining is not None else None
+        done = remaining == 0
+        next_run = payment["next_run"] if done else occurrence(payment["first_run"], payment["period"], runs + 1)
+        return (payment["id"], runs, next_run, runs + 1, remaining, 0, "done" if done else "active", False, lastResult)
+
+    def run(self, stop, poll=SCHEDULE_POLL):
+        # run
+        ## Pay batch after batch while payments are due, then look again every poll seconds
+        while not stop.is_set():
+            if not self.runDue(): stop.wait(poll)
+
+    def getStats(self):
+        with self.statsLock: return dict(self.stats)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+########## Benchmark ##########
+
+# benchmarkScheduler
+## Schedule payments monthly payments (due now) between accounts 1..accounts and clear them with workers
+## Scheduler threads in parallel; every payment must be paid exactly once
+## Return (seconds, payments per second, merged worker stats)
+def benchmarkScheduler(backend, path, payments=BENCH_PAYMENTS, accounts=BENCH_ACCOUNTS, workers=BENCH_WORKERS,
+                       batchSize=SCHEDULE_BATCH, threads=SCHEDULE_THREADS):
+    storage = Bank.openStorage(backend, path)
+    bank = Bank.Bank(storage)
+    first = bank.createAccounts([(f"payer{i}", payments) for i in range(accounts)])[0]
+    with storage.borrow() as dbObj: due = toDatetime(dbObj.now(-1))
+    schedulers = [Scheduler(bank, batchSize=batchSize, threads=threads) for _ in range(workers)]
+    rows = [(first + i % accounts, first + (i + 1) % accounts, 1, due, "monthly", None) for i in range(payments)]
+    for start in range(0, payments, 10000): schedulers[0].scheduleMany(rows[start:start + 10000])
+
+    def work(scheduler):
+        # A worker stops once a claim comes back empty: everything due has been claimed
+        while scheduler.runDue(): pass
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor: list(executor.map(work, schedulers))
+    elapsed = time.perf_counter() - start
+
+    stats = {}
+    for scheduler in schedulers:
+        for name, value in scheduler.getStats().items(): stats[name] = stats.get(name, 0) + value
+        scheduler.close()
+    storage.disconnectDB(MySQLConnector.SAVE_ON_DISCONNECT)
+    return elapsed, payments / elapsed, stats
+
+
+def main():
+    # main
+    ## Parse the options
+    ## bench: schedule payments due now and time how long parallel workers take to clear them
+    ## run: run scheduler workers against the configured database until interrupted
+    parser = argparse.ArgumentParser(description="Scheduled payment workers")
+    parser.add_argument("command", choices=("run", "bench"))
+    parser.add_argument("--workers", type=int, default=BENCH_WORKERS)
+    parser.add_argument("--batch-size", type=int, default=SCHEDULE_BATCH)
+    parser.add_argument("--threads", type=int, default=SCHEDULE_THREADS, help="payments executed at once per worker")
+    parser.add_argument("--payments", type=int, default=BENCH_PAYMENTS)
+    parser.add_argument("--accounts", type=int, default=BENCH_ACCOUNTS)
+    parser.add_argument("--backend", choices=("mysql", "sqlite", "memory"), default=Bank.STORAGE_BACKEND)
+    parser.add_argument("--path", default=Bank.SQLITE_PATH, help="SQLite database file for --backend sqlite")
+    args = parser.parse_args()
+
+    if args.command == "bench":
+        elapsed, rate, stats = benchmarkScheduler(args.backend, args.path, args.payments, args.accounts, args.workers,
+                                                  args.batch_size, args.threads)
+        print(f"{args.payments} payments with {args.workers} workers in {elapsed:.1f}s ({rate:.0f} payments/s)")
+        print(" ".join(f"{name}={value}" for name, value in stats.items()))
+        return stats
+
+    storage = Bank.openStorage(args.backend, args.path)
+    if not storage.isConnected():
+        Bank.printString("Connection to database was UNSUCCESSFUL", length=Bank.DEFAULT_PAGE_WIDTH)
+        return False
+    bank = Bank.Bank(storage)
+    stop = threading.Event()
+    schedulers = [Scheduler(bank, batchSize=args.batch_size, threads=args.threads) for _ in range(args.workers)]
+    workers = [threading.Thread(target=scheduler.run, args=(stop,), name=f"SchedulerWorker{n}") for n, scheduler in enumerate(schedulers)]
+    for worker in workers: worker.start()
+    try:
+        while any(worker.is_alive() for worker in workers): time.sleep(1)
+    except KeyboardInterrupt:
+        stop.set()
+    finally:
+        for worker in workers: worker.join()
+        for scheduler in schedulers: scheduler.close()
+        storage.disconnectDB(MySQLConnector.SAVE_ON_DISCONNECT)
+    return True
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,351 @@
+import Bank
+import Metrics
+import IdempotencyCache
+import BalanceCache
+import GroupCommit
+import Benchmark
+import MySQLConnector
+import concurrent.futures
+import multiprocessing
+import collections
+import itertools
+import threading
+import argparse
+import logging
+import random
+import queue
+import time
+
+# Defaults
+SHARD_PROCESSES = multiprocessing.cpu_count()
+BENCH_PROCESSES = (1, 2, 4)
+BENCH_CLIENTS   = 32
+BENCH_SECONDS   = 5.0
+CALL_TIMEOUT    = 30.0      # seconds a call waits for its worker before raising TimeoutError (None - forever)
+WATCH_INTERVAL  = 0.5       # seconds between checks that the workers are still running
+
+
+# shardOf
+## Worker that owns an account: every operation on one account runs in the same process
+def shardOf(acc_no, shards):
+    return hash(int(acc_no)) % shards
+
+
+########## Worker process ##########
+
+# Bank methods a worker may be asked to run ("metrics" returns the worker's raw metrics instead)
+WORKER_CALLS = ("createAccount", "createAccounts", "checkBalance", "getAccount", "deposit", "withdraw",
+                "transfer", "applyBatch", "invalidate", "getStats", "takeSnapshot", "balanceAsOf", "statement",
+                "stripeAccount", "refreshStripes", "setFxRates", "refreshFxRates")
+
+# runWorker
+## Body of worker process shard: open its own storage and Bank (with its own balance cache and group commit)
+## Report ("ready", storage size) or ("failed", reason), then run requests on a thread pool sized to the storage
+## Requests are (request id, call, args, kwargs); replies are (request id, ok, result) - None stops the worker
+def runWorker(shard, backend, path, requests, replies):
+    storage = Bank.openStorage(backend, path)
+    if not storage.isConnected():
+        replies.put((shard, "failed", "Connection to database was UNSUCCESSFUL"))
+        return
+    cache = BalanceCache.BalanceCache(Bank.CACHE_SIZE, Bank.CACHE_TTL) if Bank.CACHE_SIZE > 0 else None
+    group = GroupCommit.GroupCommit(Bank.GROUP_COMMIT_WINDOW, Bank.GROUP_COMMIT_MAX_OPS) if Bank.GROUP_COMMIT_MAX_OPS > 0 else None
+    bank = Bank.Bank(storage, cache=cache, group=group)
+    replies.put((shard, "ready", storage.size))
+
+    def handle(request_id, call, args, kwargs):
+        try:
+            if call == "metrics": result = Metrics.METRICS.raw()
+            elif call in WORKER_CALLS: result = getattr(bank, call)(*args, **kwargs)
+            else: raise ValueError(f"Unknown call: {call}")
+            replies.put((request_id, True, result))
+        except IdempotencyCache.KeyReused as e:
+            # Raised again in the caller, so the server can tell a reused key from a failure
+            replies.put((request_id, False, e))
+        except Exception as e:
+            logging.error(e)
+            replies.put((request_id, False, repr(e)))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=storage.size, thread_name_prefix=f"Shard{shard}") as executor:
+        for request in iter(requests.get, None): executor.submit(handle, *request)
+    if group is not None: group.close()
+    storage.disconnectDB(MySQLConnector.SAVE_ON_DISCONNECT)
+
+
+########## Supervisor ##########
+
+# ShardedBank - class
+### Supervisor with the Bank interface that forks one worker process per shard and routes every call by
+### account number (shardOf), so each account is only ever read, written and cached by one worker
+### Calls block until the worker replies (at most timeout seconds) and may come from many threads at once
+### A worker that exits fails the calls it has not answered, and every later call routed to it, with RuntimeError
+### Cross-shard paths:
+###     transfer   - runs on the source account's worker (where the funds check happens) in one database
+###                  transaction; the target's worker then drops the target from its cache before the call returns
+###     applyBatch - runs on the worker of the first account in the batch; the owners of every other changed
+###                  account drop them from their caches before the call returns
+###     createAccount - round robin (or by idempotency key, so a retry meets the same key cache)
+###     stripeAccount - runs on the account's worker; every other worker then rereads the striped accounts,
+###                  since transfers and batches may touch the account from there
+###     setFxRates - runs on one worker; every other worker then reloads its FX rate cache
+### Every worker has its own storage, so the backend must be shared: MySQL or an SQLite file
+##    __init__
+##    started            ## What a worker reported at startup
+##    receive            ## Reply thread of one worker: hand its replies to their Futures, fail its calls once it exited
+##    exit               ## Fail the calls of a worker that exited
+##    call               ## Run a call on one worker and wait for the result
+##    gather             ## Results of several submitted calls, waiting at most timeout seconds for all of them
+##    createAccount, createAccounts, checkBalance, getAccount, deposit, withdraw, transfer, applyBatch,
+##    takeSnapshot, balanceAsOf, statement, stripeAccount, setFxRates
+##    getStats           ## Stats of every worker
+##    exportMetrics      ## Metrics of all workers (and of this process) added together, in Prometheus text format
+##    close              ## Stop the workers
+class ShardedBank():
+
+    def __init__(self, processes=SHARD_PROCESSES, backend=None, path=None, timeout=CALL_TIMEOUT):
+        # __init__
+        ## Backend and path default to config.ini
+        ## Fork the workers and wait until each has opened its storage (or exited)
+        ## size (the number of calls the workers can run at once) is the sum of their storage sizes
+        backend = Bank.STORAGE_BACKEND if backend is None else backend
+        path = Bank.SQLITE_PATH if path is None else path
+        if backend == "memory" or (backend == "sqlite" and path == ":memory:"):
+            raise ValueError("Worker processes need a shared database: MySQL or an SQLite file")
+        self.shards = processes
+        self.timeout = timeout
+        self.closing = False                # set by close, whose workers exit on purpose
+        self.stopped = threading.Event()    # set by close once the workers are gone; stops the reply threads
+        # A queue each way per worker: a worker killed while replying can only block its own queue
+        self.replies = [multiprocessing.Queue() for _ in range(processes)]
+        self.requests = [multiprocessing.Queue() for _ in range(processes)]
+        self.workers = [multiprocessing.Process(target=runWorker, args=(shard, backend, path, self.requests[shard], self.replies[shard]),
+                                                name=f"BankShard{shard}", daemon=True) for shard in range(processes)]
+        for worker in self.workers: worker.start()
+
+        self.size = 0
+        for shard in range(processes):
+            state, detail = self.started(shard)
+            if state != "ready":
+                self.close()
+                raise RuntimeError(f"Shard {shard}: {detail}")
+            self.size += detail
+
+        self.pending = {}                   # request id -> (shard, Future)
+        self.pendingLock = threading.Lock()
+        self.exited = {}                    # shard -> reason, for workers that are gone
+        self.ids = itertools.count()
+        self.nextShard = itertools.cycle(range(processes))
+        self.receivers = [threading.Thread(target=self.receive, args=(shard,), name=f"ShardedBankReplies{shard}", daemon=True)
+                          for shard in range(processes)]
+        for receiver in self.receivers: receiver.start()
+
+    def started(self, shard):
+        # (state, detail) a worker reported at startup, or ("failed", exit code) if it exited first
+        while True:
+            try:
+                return self.replies[shard].get(timeout=WATCH_INTERVAL)[1:]
+            except queue.Empty:
+                worker = self.workers[shard]
+                if not worker.is_alive(): return "failed", f"exited with code {worker.exitcode}"
+
+    def receive(self, shard):
+        # receive
+        ## Hand every reply of a worker to the Future waiting for it, until close stops the thread
+        ## Once the worker has exited and every reply it sent is handed over, fail its unanswered calls
+        replies, worker = self.replies[shard], self.workers[shard]
+        while not self.stopped.is_set():
+            try:
+                request_id, ok, result = replies.get(timeout=WATCH_INTERVAL)
+            except queue.Empty:
+                if not worker.is_alive() and not self.closing:
+                    self.exit(shard, f"Shard {shard} exited with code {worker.exitcode}")
+                    return
+                continue
+            with self.pendingLock: future = self.pending.pop(request_id, (None, None))[1]
+            if future is None: continue
+            if ok: future.set_result(result)
+            else: future.set_exception(result if isinstance(result, Exception) else RuntimeError(result))
+
+    def exit(self, shard, reason):
+        # Fail the unanswered calls of a worker that is gone, and every later call routed to it
+        logging.error(reason)
+        with self.pendingLock:
+            self.exited[shard] = reason
+            failed = [request_id for request_id, (owner, future) in self.pending.items() if owner == shard]
+            failed = [self.pending.pop(request_id)[1] for request_id in failed]
+        for future in failed: future.set_exception(RuntimeError(reason))
+
+    def submit(self, shard, call, *args, **kwargs):
+        future = concurrent.futures.Future()
+        request_id = next(self.ids)
+        with self.pendingLock:
+            if shard in self.exited:
+                future.set_exception(RuntimeError(self.exited[shard]))
+                return future
+            self.pending[request_id] = (shard, future)
+        self.requests[shard].put((request_id, call, args, kwargs))
+        return future
+
+    def gather(self, futures):
+        # Results in the order of futures; a call not answered within timeout seconds raises TimeoutError
+        # (its Future stays pending until the worker replies or exits)
+        done, waiting = concurrent.futures.wait(futures, self.timeout)
+        if waiting: raise TimeoutError(f"{len(waiting)} shard calls not answered within {self.timeout}s")
+        return [future.result() for future in futures]
+
+    def call(self, shard, call, *args, **kwargs):
+        try:
+            return self.gather([self.submit(shard, call, *args, **kwargs)])[0]
+        except TimeoutError:
+            raise TimeoutError(f"Shard {shard} did not answer {call} within {self.timeout}s") from None
+
+    def invalidateElsewhere(self, shard, acc_nos):
+        # Drop accounts changed by a worker other than their owner from the owners' caches, and wait for it
+        owners = collections.defaultdict(set)
+        for acc_no in acc_nos:
+            owner = shardOf(acc_no, self.shards)
+            if owner != shard: owners[owner].add(int(acc_no))
+        self.gather([self.submit(owner, "invalidate", *accounts) for owner, accounts in owners.items()])
+
+    def createAccount(self, name=Bank.DEFAULT_ACCOUNT_NAME, balance=Bank.DEFAULT_BALANCE, v=Bank.VERBOSE_MAIN_FUNCTIONS, key=None,
+                      currency=Bank.DEFAULT_CURRENCY):
+        shard = hash(key) % self.shards if key is not None else next(self.nextShard)
+        return self.call(shard, "createAccount", name, balance, v, key=key, currency=currency)
+
+    def createAccounts(self, rows, v=Bank.VERBOSE_MAIN_FUNCTIONS, currency=Bank.DEFAULT_CURRENCY):
+        return self.call(next(self.nextShard), "createAccounts", rows, v, currency=currency)
+
+    def checkBalance(self, acc_no, v=Bank.VERBOSE_MAIN_FUNCTIONS):
+        return self.call(shardOf(acc_no, self.shards), "checkBalance", acc_no, v)
+
+    def getAccount(self, acc_no):
+        return self.call(shardOf(acc_no, self.shards), "getAccount", acc_no)
+
+    def deposit(self, acc_no, deposit_amount, v=Bank.VERBOSE_MAIN_FUNCTIONS, key=None):
+        return self.call(shardOf(acc_no, self.shards), "deposit", acc_no, deposit_amount, v, key=key)
+
+    def withdraw(self, acc_no, withdraw_amount, v=Bank.VERBOSE_MAIN_FUNCTIONS, key=None):
+        return self.call(shardOf(acc_no, self.shards), "withdraw", acc_no, withdraw_amount, v, key=key)
+
+    def transfer(self, src_acc_no, trgt_acc_no, transfer_amount, v=Bank.VERBOSE_MAIN_FUNCTIONS, mode=None, key=None):
+        shard = shardOf(src_acc_no, self.shards)
+        result = self.call(shard, "transfer", src_acc_no, trgt_acc_no, transfer_amount, v, mode=mode, key=key)
+        if result[0] is not False: self.invalidateElsewhere(shard, (trgt_acc_no,))
+        return result
+
+    def applyBatch(self, ops, chunkSize=Bank.BATCH_CHUNK_SIZE, v=Bank.VERBOSE_MAIN_FUNCTIONS, key=None):
+        ops = list(ops)
+        shard = shardOf(ops[0][1], self.shards) if ops and len(ops[0]) > 1 else 0
+        results = self.call(shard, "applyBatch", ops, chunkSize, v, key=key)
+        self.invalidateElsewhere(shard, {acc_no for op, (ok, _) in zip(ops, results) if ok for acc_no in op[1:-1]})
+        return results
+
+    def takeSnapshot(self, lag=None):
+        # Snapshots cover every account of the shared database, so one worker takes them
+        return self.call(0, "takeSnapshot", lag)
+
+    def balanceAsOf(self, acc_no, ts):
+        return self.call(shardOf(acc_no, self.shards), "balanceAsOf", acc_no, ts)
+
+    def statement(self, acc_no, start, end):
+        return self.call(shardOf(acc_no, self.shards), "statement", acc_no, start, end)
+
+    def stripeAccount(self, acc_no, stripes):
+        shard = shardOf(acc_no, self.shards)
+        result = self.call(shard, "stripeAccount", acc_no, stripes)
+        if result is not False:
+            self.gather([self.submit(other, "refreshStripes") for other in range(self.shards) if other != shard])
+        return result
+
+    def setFxRates(self, rates):
+        result = self.call(0, "setFxRates", list(rates))
+        if result is not False:
+            self.gather([self.submit(other, "refreshFxRates") for other in range(1, self.shards)])
+        return result
+
+    def getStats(self):
+        return {"shards": self.gather([self.submit(shard, "getStats") for shard in range(self.shards)])}
+
+    def exportMetrics(self):
+        # Workers run the Bank operations; this process counts admission control in front of them
+        registry = Metrics.Metrics()
+        registry.merge(Metrics.METRICS.raw())
+        for raw in self.gather([self.submit(shard, "metrics") for shard in range(self.shards)]): registry.merge(raw)
+        return registry.prometheus()
+
+    def close(self):
+        self.closing = True
+        for requests, worker in zip(self.requests, self.workers):
+            if worker.is_alive(): requests.put(None)
+        for worker in self.workers: worker.join()
+        # Not a None reply: a killed worker may have died holding the lock of its replies queue
+        self.stopped.set()
+
+
+########## Scaling benchmark ##########
+
+# runClients
+## Drive bank with clients threads running the workload mix on the account numbers accounts for seconds
+## Return operations per second
+def runClients(bank, workload, accounts, clients, seconds):
+    def client(seed):
+        rng = random.Random(seed)
+        pick = Benchmark.operationPicker(workload, Benchmark.accountPicker(accounts, 0.0, rng), rng)
+        deadline = time.perf_counter() + seconds
+        count = 0
+        while time.perf_counter() < deadline:
+            action, args = pick()
+            getattr(bank, action)(*args)
+            count += 1
+        return count
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=clients) as executor:
+        total = sum(executor.map(client, range(clients)))
+    return total / (time.perf_counter() - start)
+
+# benchmarkScaling
+## Throughput of the workload with 1..N worker processes against the same database, on the account numbers accounts
+## Return a list of (processes, ops/s, speedup over the first entry)
+def benchmarkScaling(backend, path, processes=BENCH_PROCESSES, workload=Benchmark.BENCH_WORKLOAD,
+                     accounts=range(1, Benchmark.BENCH_ACCOUNTS + 1), clients=BENCH_CLIENTS, seconds=BENCH_SECONDS):
+    results = []
+    for n in processes:
+        bank = ShardedBank(n, backend, path)
+        try:
+            rate = runClients(bank, workload, accounts, clients, seconds)
+        finally:
+            bank.close()
+        results.append((n, rate, rate / results[0][1] if results else 1.0))
+        logging.info(f"scaling processes={n} {rate:.1f} ops/s")
+    return results
+
+
+def main():
+    # main
+    ## Parse the benchmark options
+    ## Create the accounts first if asked to (once, before any worker starts)
+    ## Measure throughput at every process count and print the table
+    parser = argparse.ArgumentParser(description="Measure Bank throughput with 1..N sharded worker processes")
+    parser.add_argument("--processes", type=int, nargs="+", default=list(BENCH_PROCESSES))
+    parser.add_argument("--workload", choices=sorted(Benchmark.WORKLOADS), default=Benchmark.BENCH_WORKLOAD)
+    parser.add_argument("--accounts", type=int, default=Benchmark.BENCH_ACCOUNTS, help="accounts used (1..N unless --seed-accounts creates them)")
+    parser.add_argument("--seed-accounts", action="store_true", help="create the accounts first")
+    parser.add_argument("--clients", type=int, default=BENCH_CLIENTS)
+    parser.add_argument("--seconds", type=float, default=BENCH_SECONDS)
+    parser.add_argument("--backend", choices=("mysql", "sqlite"), default=Bank.STORAGE_BACKEND)
+    parser.add_argument("--path", default="bench.db", help="SQLite database file for --backend sqlite")
+    args = parser.parse_args()
+
+    accounts = range(1, args.accounts + 1)
+    if args.seed_accounts:
+        storage = Bank.openStorage(args.backend, args.path)
+        accounts = Benchmark.seedAccounts(Bank.Bank(storage), args.accounts)
+        storage.disconnectDB(MySQLConnector.SAVE_ON_DISCONNECT)
+
+    results = benchmarkScaling(args.backend, args.path, args.processes, args.workload, accounts, args.clients, args.seconds)
+    print(f"{'processes':>10} {'ops/s':>12} {'speedup':>8}")
+    for n, rate, speedup in results: print(f"{n:>10} {rate:>12.1f} {speedup:>8.2f}")
+    return results
+
+if __name__ == "__main__":
+    main()
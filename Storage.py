@@ -0,0 +1,911 @@
+import contextlib
+import datetime
+import collections
+import itertools
+import threading
+import logging
+import Metrics
+import FxRates
+import time
+
+# Metrics labels of every distinct query text, filled by SQLSession.statementLabels
+STATEMENT_LABELS = {}
+
+# Hot statements - prepared once per connection and reused (SQLSession.run)
+### {lock} is replaced by the dialect's LOCK_SUFFIX
+STATEMENTS = {
+    "selectRow":         "SELECT account_no, name, balance, open_date, currency FROM accounts WHERE account_no = %s;",
+    "selectRowLocked":   "SELECT account_no, name, balance, open_date, currency FROM accounts WHERE account_no = %s{lock};",
+    "selectPair":        "SELECT account_no, name, balance, currency FROM accounts WHERE account_no IN (%s, %s) ORDER BY account_no;",
+    "selectPairLocked":  "SELECT account_no, name, balance, currency FROM accounts WHERE account_no IN (%s, %s) ORDER BY account_no{lock};",
+    "updateBalance":     "UPDATE accounts SET balance = %s WHERE account_no = %s;",
+    "updatePair":        "UPDATE accounts SET balance = CASE account_no WHEN %s THEN %s WHEN %s THEN %s END WHERE account_no IN (%s, %s);",
+    "transfer":          "UPDATE accounts SET balance = balance + CASE WHEN account_no = %s THEN -%s ELSE %s END "
+                         "WHERE account_no IN (%s, %s) AND (account_no <> %s OR balance >= %s);",
+    "getBalance":        "SELECT balance FROM accounts WHERE account_no = %s;",
+    "addAccount":        "INSERT INTO accounts (name, balance, currency) VALUES (%s, %s, %s);",
+    "selectResult":      "SELECT result FROM idempotency_keys WHERE idempotency_key = %s;",
+    "creditStripe":      "UPDATE account_stripes SET balance = balance + %s WHERE account_no = %s AND stripe = %s;",
+    "sumStripes":        "SELECT COALESCE(SUM(balance), 0) FROM account_stripes WHERE account_no = %s;",
+    "stripedBalance":    "SELECT SUM(balance) FROM (SELECT balance FROM accounts WHERE account_no = %s "
+                         "UNION ALL SELECT balance FROM account_stripes WHERE account_no = %s) AS parts;",
+}
+
+# Statements checked by checkPlans with a sample account number for every parameter;
+# each must find its rows through the primary key
+PLANNED_STATEMENTS = ("selectRow", "selectRowLocked", "selectPair", "selectPairLocked", "updateBalance", "updatePair", "transfer", "getBalance")
+
+# Rows per multi-row INSERT statement
+LEDGER_INSERT_ROWS   = 500
+ACCOUNT_INSERT_ROWS  = 500
+SNAPSHOT_INSERT_ROWS = 500
+SCHEDULE_INSERT_ROWS = 500
+
+# Columns of a scheduled payment row, in the order sessions return them
+SCHEDULE_COLUMNS = ("id", "source_account", "target_account", "amount", "period", "first_run", "next_run",
+                    "runs", "remaining", "attempts", "status", "lease_until", "last_result")
+
+# Read replicas (ReplicatedStorage)
+REPLICA_MAX_LAG      = 1.0      # seconds a replica may be behind the primary and still serve reads
+REPLICA_LAG_INTERVAL = 1.0      # seconds between lag measurements of a replica (by its probe thread)
+REPLICA_LAG_TIMEOUT  = 2.0      # seconds a measurement may be overdue before the replica's lag counts as unknown
+REPLICA_PINS_KEPT    = 10000    # read-your-writes tokens remembered (least recently pinned dropped first)
+
+# Keyset position after every ledger row of a timestamp: (ts, LEDGER_LAST_ID) starts a scan at ts > ts
+LEDGER_LAST_ID = 2 ** 63 - 1
+
+# Storage interface
+### Bank talks to a storage object instead of MySQL cursors. A storage lends out sessions with borrow();
+### a session runs one transaction at a time through the methods of AccountSession.
+###     MySQLStorage   - MySQLConnector.mysqlPool (or a single mysqlDB)
+###     SQLiteStorage  - SQLiteConnector.sqliteDB, local stand-in needing no server
+###     MemoryStorage  - MemoryStorage.py, array-backed in-process engine
+###     ReplicatedStorage - a primary storage plus read replicas for unlocked reads
+
+
+########## Interface ##########
+
+# AccountSession - class
+### One borrowed connection. Rows are (account_no, name, balance, open_date, currency) tuples; balances are in minor units
+### of the account's currency
+### Ledger entries are (idempotency_key, account_no, kind, amount, balance_before, balance_after) tuples;
+### ledger rows read back are (id, ts, idempotency_key, kind, amount, balance_before, balance_after)
+### Timestamps are in the database's clock (UTC for SQLite) and compared as the database stores them
+### replica is True for sessions lent by borrowRead from a replica: what they read may be behind the primary
+##    startTransaction        ## Begin a transaction
+##    save                    ## Commit
+##    rollback                ## Roll back
+##    selectRowByAccNbr       ## One account row or None, locked until commit/rollback if lock is set
+##    selectRowsByAccNbrs     ## (account_no, name, balance, currency) rows in account number order, locked in that order if lock is set
+##    updateBalanceByAccNbr   ## Set one balance
+##    updateBalancesByAccNbrs ## Set several balances from an {account number: balance} mapping
+##    transferByAccNbrs       ## Conditional transfer, returns the number of rows changed (2 when applied)
+##    addAccount              ## Insert an account (name, balance, currency), returns its account number
+##    addAccounts             ## Insert (account_no or None, name, balance, currency) rows with multi-row INSERTs, returns their account numbers
+##    streamAccounts          ## Generator over every account row in account number order, fetched batchSize rows at a time
+##    getBalance              ## Balance or None
+##    addLedgerEntries        ## Append ledger entries with multi-row INSERTs (same transaction as the balance change)
+##    selectLedgerPage        ## Up to limit ledger rows of one account after the (ts, id) keyset position (up to ts until)
+##    selectLedgerSum         ## (entries, sum of amounts) of the ledger rows of one account with after < ts <= until
+##    selectLedgerChanges     ## Up to limit (id, ts, account_no, amount) rows of every account after the keyset position, up to until
+##    now                     ## The database's current time plus offset seconds
+##    selectSnapshotWatermark ## Timestamp of the latest balance snapshot, or None
+##    selectSnapshotAsOf      ## Latest (ts, ledger_id, balance) snapshot of one account at or before ts, or None
+##    addSnapshots            ## Insert (account_no, ts, ledger_id, balance) snapshot rows with multi-row INSERTs
+##    addScheduledPayments    ## Insert (source, target, amount, period, first_run, remaining) payments, returns their ids
+##    selectScheduledPayment  ## One scheduled payment row (SCHEDULE_COLUMNS) or None
+##    claimScheduledPayments  ## Lease up to limit due payments for lease seconds, skipping rows other workers hold; returns their rows
+##    updateScheduledPayments ## Apply (id, runs claimed, next_run, runs, remaining, attempts, status, lease_until, last_result)
+##                            ## updates, each only if the payment still has the claimed runs; returns how many applied
+##    cancelScheduledPayment  ## Mark an active payment cancelled; True if it was active
+##    selectStripeCounts      ## {account number: stripes} of every striped account
+##    addStripes              ## Add stripes 1..stripes of an account, with balance 0
+##    deleteStripes           ## Remove every stripe of an account
+##    selectStripes           ## (stripe, balance) rows of an account in stripe order, locked in that order if lock is set
+##    creditStripe            ## Add amount to one stripe, returns the number of rows changed (0 if the stripe does not exist)
+##    clearStripes            ## Set every stripe of an account to 0
+##    sumStripes              ## Total of an account's stripes (0 if it has none)
+##    selectStripedBalance    ## Account row balance plus its stripes read by one statement, or None
+##    selectAccountBounds     ## (lowest, highest) account number in accounts, transactions and account_stripes, or (None, None)
+##    selectBalanceRange      ## (account_no, balance) rows with first <= account_no < last in account number order
+##    selectLedgerTotals      ## (account_no, entries, sum of amounts, lowest balance_after) of the ledger rows with
+##                            ## first <= account_no < last, one row per account in account number order
+##    selectStripeTotals      ## (account_no, stripes, sum of balances, lowest balance) likewise for account_stripes
+##    selectFxRates           ## (base, quote, rate) rows of the fx_rates table
+##    replaceFxRates          ## Insert or replace (base, quote, rate) rows of the fx_rates table (rate as a Decimal)
+##    selectResultByKey       ## Stored result (JSON text) of a committed idempotency key, or None
+##    addResultByKey          ## Store the result of an idempotency key (same transaction; a duplicate key raises)
+class AccountSession():
+    replica = False
+
+    def startTransaction(self): raise NotImplementedError
+
+    def save(self): raise NotImplementedError
+
+    def rollback(self): raise NotImplementedError
+
+    def selectRowByAccNbr(self, acc_no, lock=False): raise NotImplementedError
+
+    def selectRowsByAccNbrs(self, acc_nos, lock=False): raise NotImplementedError
+
+    def updateBalanceByAccNbr(self, acc_no, balance): raise NotImplementedError
+
+    def updateBalancesByAccNbrs(self, balances): raise NotImplementedError
+
+    def transferByAccNbrs(self, src_acc_no, trgt_acc_no, amount): raise NotImplementedError
+
+    def addAccount(self, name, balance, currency=FxRates.DEFAULT_CURRENCY): raise NotImplementedError
+
+    def addAccounts(self, rows): raise NotImplementedError
+
+    def streamAccounts(self, batchSize=1000): raise NotImplementedError
+
+    def getBalance(self, acc_no): raise NotImplementedError
+
+    def addLedgerEntries(self, entries): raise NotImplementedError
+
+    def selectLedgerPage(self, acc_no, after=None, limit=100, until=None): raise NotImplementedError
+
+    def selectLedgerSum(self, acc_no, after, until): raise NotImplementedError
+
+    def selectLedgerChanges(self, after, until, limit=1000): raise NotImplementedError
+
+    def now(self, offset=0.0): raise NotImplementedError
+
+    def selectSnapshotWatermark(self): raise NotImplementedError
+
+    def selectSnapshotAsOf(self, acc_no, ts): raise NotImplementedError
+
+    def addSnapshots(self, rows): raise NotImplementedError
+
+    def addScheduledPayments(self, rows): raise NotImplementedError
+
+    def selectScheduledPayment(self, payment_id): raise NotImplementedError
+
+    def claimScheduledPayments(self, limit, lease): raise NotImplementedError
+
+    def updateScheduledPayments(self, updates): raise NotImplementedError
+
+    def cancelScheduledPayment(self, payment_id): raise NotImplementedError
+
+    def selectStripeCounts(self): raise NotImplementedError
+
+    def addStripes(self, acc_no, stripes): raise NotImplementedError
+
+    def deleteStripes(self, acc_no): raise NotImplementedError
+
+    def selectStripes(self, acc_no, lock=False): raise NotImplementedError
+
+    def creditStripe(self, acc_no, stripe, amount): raise NotImplementedError
+
+    def clearStripes(self, acc_no): raise NotImplementedError
+
+    def sumStripes(self, acc_no): raise NotImplementedError
+
+    def selectStripedBalance(self, acc_no): raise NotImplementedError
+
+    def selectAccountBounds(self): raise NotImplementedError
+
+    def selectBalanceRange(self, first, last): raise NotImplementedError
+
+    def selectLedgerTotals(self, first, last): raise NotImplementedError
+
+    def selectStripeTotals(self, first, last): raise NotImplementedError
+
+    def selectFxRates(self): raise NotImplementedError
+
+    def replaceFxRates(self, rows): raise NotImplementedError
+
+    def selectResultByKey(self, key): raise NotImplementedError
+
+    def addResultByKey(self, key, result): raise NotImplementedError
+
+
+# AccountStorage - class
+### A backend that lends out AccountSessions
+##    borrow        ## Context manager yielding a session for the life of one operation
+##    borrowRead    ## Like borrow, for unlocked reads only - may lend a session on a replica
+##    read          ## Result of function(session) on a borrowRead session
+##    readYourWrites ## Context manager: reads of this thread see the writes it commits inside (token identifies the caller)
+##    pinWrites     ## Called after a committed write - pins the token of readYourWrites to the primary
+##    replicationLag ## Seconds this storage is behind its primary (0 - not a replica, None - not replicating)
+##    isConnected   ## False once the backend failed to connect or was disconnected
+##    getStats      ## Backend counters (pool occupancy, lock waits, ...)
+##    checkPlans    ## Startup check - warnings for hot statements that do not use the primary key
+##    disconnectDB  ## Release every connection
+class AccountStorage():
+    size = 1    # sessions that can be borrowed at the same time
+
+    @contextlib.contextmanager
+    def borrow(self): raise NotImplementedError
+
+    @contextlib.contextmanager
+    def borrowRead(self):
+        with self.borrow() as session: yield session
+
+    def read(self, function):
+        with self.borrowRead() as session: return function(session)
+
+    def readYourWrites(self, token): return contextlib.nullcontext()
+
+    def pinWrites(self): pass
+
+    def replicationLag(self): return 0.0
+
+    def isConnected(self): return True
+
+    def getStats(self): return {}
+
+    def checkPlans(self): return []
+
+    def disconnectDB(self, save=1): pass
+
+
+########## SQL backends ##########
+
+# SQLSession - class
+### AccountSession running SQL through a connection object with getCursor/save/rollback
+### Queries are written with %s placeholders and a FOR UPDATE suffix; dialects override PLACEHOLDER,
+### LOCK_SUFFIX, SKIP_LOCKED_SUFFIX, START_TRANSACTION, LASTROWID_IS_FIRST, the EXPLAIN syntax and how timestamps are bound
+### The hot statements in STATEMENTS run through run(), on a prepared cursor the connection keeps per statement
+class SQLSession(AccountSession):
+    PLACEHOLDER = "%s"
+    LOCK_SUFFIX = " FOR UPDATE"
+    SKIP_LOCKED_SUFFIX = " FOR UPDATE SKIP LOCKED"
+    START_TRANSACTION = "START TRANSACTION;"
+    LASTROWID_IS_FIRST = True   # lastrowid of a multi-row INSERT is its first generated id (MySQL), else its last
+    EXPLAIN = "EXPLAIN "
+    queries = {}
+    statements = {}             # statement name -> final text for this dialect
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.cursor = conn.getCursor()
+
+    def translate(self, query):
+        # Rewrite placeholders once per distinct query for dialects that do not use %s
+        if self.PLACEHOLDER == "%s": return query
+        translated = self.queries.get(query)
+        if translated is None: translated = self.queries[query] = query.replace("%s", self.PLACEHOLDER)
+        return translated
+
+    def execute(self, query, params=(), cursor=None):
+        cursor = cursor or self.cursor
+        if not Metrics.METRICS.enabled:
+            cursor.execute(self.translate(query), params)
+            return cursor
+        start = time.perf_counter()
+        cursor.execute(self.translate(query), params)
+        Metrics.METRICS.observe("bank_query_seconds", time.perf_counter() - start, self.statementLabels(query))
+        return cursor
+
+    def statementText(self, name):
+        text = self.statements.get(name)
+        if text is None: text = self.statements[name] = STATEMENTS[name].replace("{lock}", self.LOCK_SUFFIX)
+        return text
+
+    def run(self, name, params=()):
+        # Same text on the same prepared cursor every time, so the server parses and plans it once per connection
+        return self.execute(self.statementText(name), params, self.conn.getPreparedCursor(name))
+
+    def explain(self, name):
+        # Plan of a hot statement with every parameter set to an existing account number; returns (column names, rows)
+        sample = self.execute("SELECT MIN(account_no) FROM accounts;").fetchall()[0][0] or 1
+        text = self.statementText(name)
+        cursor = self.execute(self.EXPLAIN + text, (sample,) * text.count("%s"))
+        return [column[0] for column in cursor.description], cursor.fetchall()
+
+    def usesPrimaryKey(self, columns, rows):
+        # MySQL: every table access names PRIMARY as its key, or was answered by a const lookup that found
+        # no row ("no matching row in const table" - only primary and unique keys are read that way)
+        key, extra = columns.index("key"), columns.index("Extra")
+        return bool(rows) and all(row[key] == "PRIMARY" or "const table" in str(row[extra] or "") for row in rows)
+
+    def statementLabels(self, query):
+        # Metrics labels per distinct query: its statement type (SELECT, UPDATE, INSERT, ...)
+        labels = STATEMENT_LABELS.get(query)
+        if labels is None: labels = STATEMENT_LABELS[query] = (("statement", query.split(None, 1)[0].upper()),)
+        return labels
+
+    def timestamp(self, ts):
+        # Timestamp parameter as the driver binds it
+        return ts
+
+    def startTransaction(self): self.execute(self.START_TRANSACTION)
+
+    def save(self): self.conn.save()
+
+    def rollback(self): self.conn.rollback()
+
+    def selectRowByAccNbr(self, acc_no, lock=False):
+        # fetchall: a prepared cursor must be read to the end before the connection runs anything else
+        rows = self.run("selectRowLocked" if lock else "selectRow", (int(acc_no),)).fetchall()
+        return rows[0] if rows else None
+
+    def selectRowsByAccNbrs(self, acc_nos, lock=False):
+        if len(acc_nos) == 2: return self.run("selectPairLocked" if lock else "selectPair", tuple(int(acc_no) for acc_no in acc_nos)).fetchall()
+        placeholders = ", ".join(["%s"] * len(acc_nos))
+        query = f"SELECT account_no, name, balance, currency FROM accounts WHERE account_no IN ({placeholders}) ORDER BY account_no"
+        query += self.LOCK_SUFFIX + ";" if lock else ";"
+        return self.execute(query, tuple(int(acc_no) for acc_no in acc_nos)).fetchall()
+
+    def updateBalanceByAccNbr(self, acc_no, balance):
+        self.run("updateBalance", (int(balance), int(acc_no)))
+
+    def updateBalancesByAccNbrs(self, balances):
+        if len(balances) == 2:
+            (acc_a, balance_a), (acc_b, balance_b) = balances.items()
+            self.run("updatePair", (int(acc_a), int(balance_a), int(acc_b), int(balance_b), int(acc_a), int(acc_b)))
+            return
+        cases = " ".join(["WHEN %s THEN %s"] * len(balances))
+        placeholders = ", ".join(["%s"] * len(balances))
+        params = [value for acc_no, balance in balances.items() for value in (int(acc_no), int(balance))]
+        params += [int(acc_no) for acc_no in balances]
+        self.execute(f"UPDATE accounts SET balance = CASE account_no {cases} END WHERE account_no IN ({placeholders});", tuple(params))
+
+    def transferByAccNbrs(self, src_acc_no, trgt_acc_no, amount):
+        # Both rows are locked in primary key order; the source row only matches if balance >= amount
+        return self.run("transfer", (int(src_acc_no), int(amount), int(amount), int(src_acc_no), int(trgt_acc_no),
+                                     int(src_acc_no), int(amount))).rowcount
+
+    def addAccount(self, name, balance, currency=FxRates.DEFAULT_CURRENCY):
+        return self.run("addAccount", (name, int(balance), currency)).lastrowid
+
+    def addAccounts(self, rows):
+        # Generated account numbers of one INSERT are consecutive, so lastrowid locates all of them
+        rows = list(rows)
+        explicit = sum(row[0] is not None for row in rows)
+        if explicit not in (0, len(rows)): raise ValueError("Either every row or no row may carry an account number")
+        acc_nos = []
+        for start in range(0, len(rows), ACCOUNT_INSERT_ROWS):
+            chunk = rows[start:start + ACCOUNT_INSERT_ROWS]
+            if explicit:
+                values = ", ".join(["(%s, %s, %s, %s)"] * len(chunk))
+                self.execute(f"INSERT INTO accounts (account_no, name, balance, currency) VALUES {values};",
+                             tuple(value for acc_no, name, balance, currency in chunk for value in (int(acc_no), name, int(balance), currency)))
+                acc_nos.extend(int(acc_no) for acc_no, name, balance, currency in chunk)
+            else:
+                values = ", ".join(["(%s, %s, %s)"] * len(chunk))
+                lastrowid = self.execute(f"INSERT INTO accounts (name, balance, currency) VALUES {values};",
+                                         tuple(value for acc_no, name, balance, currency in chunk for value in (name, int(balance), currency))).lastrowid
+                first = lastrowid if self.LASTROWID_IS_FIRST else lastrowid - len(chunk) + 1
+                acc_nos.extend(range(first, first + len(chunk)))
+        return acc_nos
+
+    def streamAccounts(self, batchSize=1000):
+        # Own unbuffered cursor: the result is never held in memory as a whole
+        cursor = self.conn.getStreamCursor()
+        try:
+            cursor.execute(self.translate("SELECT account_no, name, balance, open_date, currency FROM accounts ORDER BY account_no;"))
+            while True:
+                rows = cursor.fetchmany(batchSize)
+                if not rows: return
+                yield from rows
+        finally:
+            cursor.close()
+
+    def getBalance(self, acc_no):
+        rows = self.run("getBalance", (int(acc_no),)).fetchall()
+        return rows[0][0] if rows else None
+
+    def addLedgerEntries(self, entries):
+        for start in range(0, len(entries), LEDGER_INSERT_ROWS):
+            chunk = entries[start:start + LEDGER_INSERT_ROWS]
+            values = ", ".join(["(%s, %s, %s, %s, %s, %s)"] * len(chunk))
+            self.execute("INSERT INTO transactions (idempotency_key, account_no, kind, amount, balance_before, balance_after) "
+                         f"VALUES {values};", tuple(value for entry in chunk for value in entry))
+
+    def selectLedgerPage(self, acc_no, after=None, limit=100, until=None):
+        # Keyset pagination on the (account_no, ts) index - no OFFSET, so every page costs the same
+        columns = "id, ts, idempotency_key, kind, amount, balance_before, balance_after"
+        conditions, params = ["account_no = %s"], [int(acc_no)]
+        if after is not None:
+            ts, last_id = self.timestamp(after[0]), int(after[1])
+            conditions.append("(ts > %s OR (ts = %s AND id > %s))")
+            params += [ts, ts, last_id]
+        if until is not None:
+            conditions.append("ts <= %s")
+            params.append(self.timestamp(until))
+        return self.execute(f"SELECT {columns} FROM transactions WHERE {' AND '.join(conditions)} ORDER BY ts, id LIMIT %s;",
+                            tuple(params) + (int(limit),)).fetchall()
+
+    def selectLedgerSum(self, acc_no, after, until):
+        # Range scan of the (account_no, ts) index
+        bound, params = ("ts > %s AND ", (self.timestamp(after),)) if after is not None else ("", ())
+        entries, total = self.execute(f"SELECT COUNT(*), SUM(amount) FROM transactions WHERE account_no = %s AND {bound}ts <= %s;",
+                                      (int(acc_no),) + params + (self.timestamp(until),)).fetchall()[0]
+        return int(entries), int(total or 0)
+
+    def selectLedgerChanges(self, after, until, limit=1000):
+        # Keyset pagination on the (ts, id) index over every account
+        until = self.timestamp(until)
+        if after is None:
+            return self.execute("SELECT id, ts, account_no, amount FROM transactions WHERE ts <= %s ORDER BY ts, id LIMIT %s;",
+                                (until, int(limit))).fetchall()
+        ts, last_id = self.timestamp(after[0]), int(after[1])
+        return self.execute("SELECT id, ts, account_no, amount FROM transactions WHERE (ts > %s OR (ts = %s AND id > %s)) "
+                            "AND ts <= %s ORDER BY ts, id LIMIT %s;", (ts, ts, last_id, until, int(limit))).fetchall()
+
+    def now(self, offset=0.0):
+        return self.execute("SELECT NOW(6) + INTERVAL %s MICROSECOND;", (int(offset * 1000000),)).fetchall()[0][0]
+
+    def selectSnapshotWatermark(self):
+        return self.execute("SELECT MAX(ts) FROM account_snapshots;").fetchall()[0][0]
+
+    def selectSnapshotAsOf(self, acc_no, ts):
+        rows = self.execute("SELECT ts, ledger_id, balance FROM account_snapshots WHERE account_no = %s AND ts <= %s "
+                            "ORDER BY ts DESC LIMIT 1;", (int(acc_no), self.timestamp(ts))).fetchall()
+        return rows[0] if rows else None
+
+    def addSnapshots(self, rows):
+        for start in range(0, len(rows), SNAPSHOT_INSERT_ROWS):
+            chunk = rows[start:start + SNAPSHOT_INSERT_ROWS]
+            values = ", ".join(["(%s, %s, %s, %s)"] * len(chunk))
+            self.execute(f"INSERT INTO account_snapshots (account_no, ts, ledger_id, balance) VALUES {values};",
+                         tuple(value for acc_no, ts, ledger_id, balance in chunk
+                               for value in (int(acc_no), self.timestamp(ts), int(ledger_id), int(balance))))
+
+    def addScheduledPayments(self, rows):
+        # Generated ids of one INSERT are consecutive, as for addAccounts
+        rows = list(rows)
+        payment_ids = []
+        for start in range(0, len(rows), SCHEDULE_INSERT_ROWS):
+            chunk = rows[start:start + SCHEDULE_INSERT_ROWS]
+            values = ", ".join(["(%s, %s, %s, %s, %s, %s, %s)"] * len(chunk))
+            lastrowid = self.execute("INSERT INTO scheduled_payments (source_account, target_account, amount, period, first_run, next_run, remaining) "
+                                     f"VALUES {values};",
+                                     tuple(value for source, target, amount, period, first_run, remaining in chunk
+                                           for value in (int(source), int(target), int(amount), period, self.timestamp(first_run),
+                                                         self.timestamp(first_run), remaining))).lastrowid
+            first = lastrowid if self.LASTROWID_IS_FIRST else lastrowid - len(chunk) + 1
+            payment_ids.extend(range(first, first + len(chunk)))
+        return payment_ids
+
+    def selectScheduledPayment(self, payment_id):
+        rows = self.execute(f"SELECT {', '.join(SCHEDULE_COLUMNS)} FROM scheduled_payments WHERE id = %s;", (int(payment_id),)).fetchall()
+        return rows[0] if rows else None
+
+    def claimScheduledPayments(self, limit, lease):
+        # Due rows come from the (status, next_run) index; SKIP LOCKED passes over rows another worker is
+        # claiming right now instead of waiting for it, and the lease keeps them away from every other
+        # worker after this transaction commits
+        now, leaseUntil = self.now(), self.now(lease)
+        rows = self.execute(f"SELECT {', '.join(SCHEDULE_COLUMNS)} FROM scheduled_payments "
+                            "WHERE status = 'active' AND next_run <= %s AND (lease_until IS NULL OR lease_until <= %s) "
+                            f"ORDER BY next_run LIMIT %s{self.SKIP_LOCKED_SUFFIX};", (now, now, int(limit))).fetchall()
+        if rows:
+            placeholders = ", ".join(["%s"] * len(rows))
+            self.execute(f"UPDATE scheduled_payments SET lease_until = %s WHERE id IN ({placeholders});",
+                         (leaseUntil,) + tuple(row[0] for row in rows))
+        return rows
+
+    def updateScheduledPayments(self, updates):
+        applied = 0
+        for payment_id, claimedRuns, next_run, runs, remaining, attempts, status, lease_until, last_result in updates:
+            applied += self.execute("UPDATE scheduled_payments SET next_run = %s, runs = %s, remaining = %s, attempts = %s, "
+                                    "status = %s, lease_until = %s, last_result = %s WHERE id = %s AND runs = %s;",
+                                    (self.timestamp(next_run), int(runs), remaining, int(attempts), status,
+                                     self.timestamp(lease_until), last_result, int(payment_id), int(claimedRuns))).rowcount
+        return applied
+
+    def cancelScheduledPayment(self, payment_id):
+        return self.execute("UPDATE scheduled_payments SET status = 'cancelled' WHERE id = %s AND status = 'active';",
+                            (int(payment_id),)).rowcount == 1
+
+    def selectStripeCounts(self):
+        return dict(self.execute("SELECT account_no, COUNT(*) FROM account_stripes GROUP BY account_no;").fetchall())
+
+    def addStripes(self, acc_no, stripes):
+        values = ", ".join(["(%s, %s, 0)"] * stripes)
+        self.execute(f"INSERT INTO account_stripes (account_no, stripe, balance) VALUES {values};",
+                     tuple(value for stripe in range(1, stripes + 1) for value in (int(acc_no), stripe)))
+
+    def deleteStripes(self, acc_no):
+        self.execute("DELETE FROM account_stripes WHERE account_no = %s;", (int(acc_no),))
+
+    def selectStripes(self, acc_no, lock=False):
+        query = "SELECT stripe, balance FROM account_stripes WHERE account_no = %s ORDER BY stripe"
+        return self.execute(query + (self.LOCK_SUFFIX if lock else "") + ";", (int(acc_no),)).fetchall()
+
+    def creditStripe(self, acc_no, stripe, amount):
+        # Locks the one stripe row only - credits to other stripes of the account do not wait for it
+        return self.run("creditStripe", (int(amount), int(acc_no), int(stripe))).rowcount
+
+    def clearStripes(self, acc_no):
+        self.execute("UPDATE account_stripes SET balance = 0 WHERE account_no = %s;", (int(acc_no),))
+
+    def sumStripes(self, acc_no):
+        return self.run("sumStripes", (int(acc_no),)).fetchall()[0][0]
+
+    def selectStripedBalance(self, acc_no):
+        # One statement, so a sweep committing in between cannot be counted twice or missed
+        return self.run("stripedBalance", (int(acc_no), int(acc_no))).fetchall()[0][0]
+
+    def selectAccountBounds(self):
+        # MIN/MAX of an indexed leading column are single index seeks
+        return tuple(self.execute("SELECT MIN(lowest), MAX(highest) FROM ("
+                                  "SELECT MIN(account_no) AS lowest, MAX(account_no) AS highest FROM accounts "
+                                  "UNION ALL SELECT MIN(account_no), MAX(account_no) FROM transactions "
+                                  "UNION ALL SELECT MIN(account_no), MAX(account_no) FROM account_stripes) AS bounds;").fetchall()[0])
+
+    def selectBalanceRange(self, first, last):
+        return self.execute("SELECT account_no, balance FROM accounts WHERE account_no >= %s AND account_no < %s ORDER BY account_no;",
+                            (int(first), int(last))).fetchall()
+
+    def selectLedgerTotals(self, first, last):
+        # Range scan of the (account_no, ts) index
+        return self.execute("SELECT account_no, COUNT(*), SUM(amount), MIN(balance_after) FROM transactions "
+                            "WHERE account_no >= %s AND account_no < %s GROUP BY account_no ORDER BY account_no;",
+                            (int(first), int(last))).fetchall()
+
+    def selectStripeTotals(self, first, last):
+        return self.execute("SELECT account_no, COUNT(*), SUM(balance), MIN(balance) FROM account_stripes "
+                            "WHERE account_no >= %s AND account_no < %s GROUP BY account_no ORDER BY account_no;",
+                            (int(first), int(last))).fetchall()
+
+    def selectFxRates(self):
+        return self.execute("SELECT base, quote, rate FROM fx_rates;").fetchall()
+
+    def replaceFxRates(self, rows):
+        # REPLACE is understood by MySQL and SQLite alike; the rate is bound as text so no digit is lost
+        values = ", ".join(["(%s, %s, %s)"] * len(rows))
+        self.execute(f"REPLACE INTO fx_rates (base, quote, rate) VALUES {values};",
+                     tuple(value for base, quote, rate in rows for value in (base, quote, str(rate))))
+
+    def selectResultByKey(self, key):
+        rows = self.run("selectResult", (key,)).fetchall()
+        return rows[0][0] if rows else None
+
+    def addResultByKey(self, key, result):
+        # The primary key makes a concurrent transaction with the same key wait for this one, then fail
+        self.execute("INSERT INTO idempotency_keys (idempotency_key, result) VALUES (%s, %s);", (key, result))
+
+
+# MySQLStorage - class
+### MySQL backend over a MySQLConnector.mysqlPool (or a single mysqlDB)
+class MySQLStorage(AccountStorage):
+
+    def __init__(self, databaseObject):
+        self.dbObj = databaseObject
+        self.size = getattr(databaseObject, "size", 1)
+
+    @contextlib.contextmanager
+    def borrow(self):
+        with self.dbObj.borrow() as conn:
+            yield SQLSession(conn)
+
+    def isConnected(self):
+        if hasattr(self.dbObj, "isConnected"): return self.dbObj.isConnected()
+        return self.dbObj.getConnection() is not False
+
+    def getStats(self):
+        return self.dbObj.getStats() if hasattr(self.dbObj, "getStats") else {}
+
+    def replicationLag(self):
+        # Seconds_Behind_Source of SHOW REPLICA STATUS (SHOW SLAVE STATUS before MySQL 8.0.22), in whole seconds;
+        # None if the server does not replicate or the replication SQL thread is stopped
+        with self.dbObj.borrow() as conn:
+            cursor = conn.getCursor()
+            try:
+                cursor.execute("SHOW REPLICA STATUS;")
+            except Exception:
+                cursor.execute("SHOW SLAVE STATUS;")
+            row = cursor.fetchone()
+            if row is None: return None
+            status = dict(zip((column[0] for column in cursor.description), row))
+        lag = status.get("Seconds_Behind_Source", status.get("Seconds_Behind_Master"))
+        return None if lag is None else float(lag)
+
+    def checkPlans(self):
+        with self.borrow() as session: return planWarnings(session)
+
+    def disconnectDB(self, save=1):
+        self.dbObj.disconnectDB(save)
+
+
+# SQLiteSession - class
+### SQLite dialect: ? placeholders, no FOR UPDATE - BEGIN IMMEDIATE takes the write lock for the whole
+### transaction up front, which covers every row lock the MySQL queries ask for
+### Prepared statements come from sqlite3's per-connection statement cache
+class SQLiteSession(SQLSession):
+    PLACEHOLDER = "?"
+    LOCK_SUFFIX = ""
+    SKIP_LOCKED_SUFFIX = ""
+    START_TRANSACTION = "BEGIN IMMEDIATE;"
+    LASTROWID_IS_FIRST = False
+    EXPLAIN = "EXPLAIN QUERY PLAN "
+    queries = {}
+    statements = {}
+
+    def usesPrimaryKey(self, columns, rows):
+        # Plan rows end with a detail such as "SEARCH accounts USING INTEGER PRIMARY KEY (rowid=?)"
+        return bool(rows) and all("PRIMARY KEY" in row[-1] for row in rows if row[-1].startswith(("SEARCH", "SCAN")))
+
+    def timestamp(self, ts):
+        # Stored as text in strftime('%Y-%m-%d %H:%M:%f') form, which sorts like the time it holds
+        return ts.isoformat(" ", "milliseconds") if isinstance(ts, datetime.datetime) else ts
+
+    def now(self, offset=0.0):
+        return self.execute("SELECT strftime('%Y-%m-%d %H:%M:%f', 'now', %s);", (f"{float(offset):+} seconds",)).fetchall()[0][0]
+
+
+# SQLiteStorage - class
+### SQLite backend over a SQLiteConnector.sqliteDB; creates the accounts, transactions, account_snapshots,
+### scheduled_payments, account_stripes, fx_rates and idempotency_keys tables if they are missing, and adds
+### the ADDED_COLUMNS to tables created before them
+### Rates are stored as text: SQLite has no exact decimal type
+class SQLiteStorage(AccountStorage):
+    SCHEMA = ("CREATE TABLE IF NOT EXISTS accounts ("
+              "account_no INTEGER PRIMARY KEY AUTOINCREMENT, "
+              "name VARCHAR(15) NOT NULL, "
+              "balance INTEGER NOT NULL CHECK (balance >= 0), "
+              "open_date TEXT DEFAULT CURRENT_TIMESTAMP, "
+              "currency CHAR(3) NOT NULL DEFAULT 'USD');",
+              "CREATE TABLE IF NOT EXISTS transactions ("
+              "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+              "idempotency_key VARCHAR(64) NOT NULL, "
+              "account_no INTEGER NOT NULL, "
+              "kind VARCHAR(12) NOT NULL, "
+              "amount INTEGER NOT NULL, "
+              "balance_before INTEGER NOT NULL, "
+              "balance_after INTEGER NOT NULL, "
+              "ts TEXT NOT NULL DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now')), "
+              "UNIQUE (idempotency_key, account_no));",
+              "CREATE INDEX IF NOT EXISTS transactions_account_ts ON transactions (account_no, ts);",
+              "CREATE INDEX IF NOT EXISTS transactions_ts ON transactions (ts, id);",
+              "CREATE TABLE IF NOT EXISTS account_snapshots ("
+              "account_no INTEGER NOT NULL, "
+              "ts TEXT NOT NULL, "
+              "ledger_id INTEGER NOT NULL, "
+              "balance INTEGER NOT NULL, "
+              "PRIMARY KEY (account_no, ts));",
+              "CREATE TABLE IF NOT EXISTS scheduled_payments ("
+              "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+              "source_account INTEGER NOT NULL, "
+              "target_account INTEGER NOT NULL, "
+              "amount INTEGER NOT NULL, "
+              "period VARCHAR(8) NOT NULL, "
+              "first_run TEXT NOT NULL, "
+              "next_run TEXT NOT NULL, "
+              "runs INTEGER NOT NULL DEFAULT 0, "
+              "remaining INTEGER, "
+              "attempts INTEGER NOT NULL DEFAULT 0, "
+              "status VARCHAR(10) NOT NULL DEFAULT 'active', "
+              "lease_until TEXT, "
+              "last_result VARCHAR(64));",
+              "CREATE INDEX IF NOT EXISTS scheduled_due ON scheduled_payments (status, next_run);",
+              "CREATE TABLE IF NOT EXISTS account_stripes ("
+              "account_no INTEGER NOT NULL, "
+              "stripe INTEGER NOT NULL, "
+              "balance INTEGER NOT NULL CHECK (balance >= 0), "
+              "PRIMARY KEY (account_no, stripe));",
+              "CREATE TABLE IF NOT EXISTS fx_rates ("
+              "base CHAR(3) NOT NULL, "
+              "quote CHAR(3) NOT NULL, "
+              "rate TEXT NOT NULL, "
+              "updated_at TEXT DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now')), "
+              "PRIMARY KEY (base, quote));",
+              "CREATE TABLE IF NOT EXISTS idempotency_keys ("
+              "idempotency_key VARCHAR(80) PRIMARY KEY, "
+              "result TEXT NOT NULL, "
+              "created_at TEXT DEFAULT CURRENT_TIMESTAMP);")
+
+    ADDED_COLUMNS = (("accounts", "currency", "CHAR(3) NOT NULL DEFAULT 'USD'"),)
+
+    def __init__(self, databaseObject):
+        self.dbObj = databaseObject
+        with self.dbObj.borrow() as conn:
+            cursor = conn.getCursor()
+            for statement in self.SCHEMA: cursor.execute(statement)
+            for table, column, definition in self.ADDED_COLUMNS:
+                if column not in [row[1] for row in cursor.execute(f"PRAGMA table_info({table});").fetchall()]:
+                    cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition};")
+            conn.save()
+        logging.debug(f"SQLite storage ready at {self.dbObj.path}")
+
+    @contextlib.contextmanager
+    def borrow(self):
+        with self.dbObj.borrow() as conn:
+            yield SQLiteSession(conn)
+
+    def isConnected(self):
+        return self.dbObj.getConnection() is not False
+
+    def replicationLag(self):
+        # An SQLiteConnector.sqliteCopy knows the age of its copy; any other database is its own primary
+        return self.dbObj.lag() if hasattr(self.dbObj, "lag") else 0.0
+
+    def checkPlans(self):
+        with self.borrow() as session: return planWarnings(session)
+
+    def disconnectDB(self, save=1):
+        self.dbObj.disconnectDB(save)
+
+
+########## Read replicas ##########
+
+# ReplicatedStorage - class
+### A primary storage plus read replicas (MySQLStorage over MySQLConnector.replicaPools, or SQLiteStorage over
+### SQLiteConnector.sqliteCopy as an in-process stand-in). borrow() always lends a primary session: writes,
+### locking reads and everything else. borrowRead() lends a replica session for unlocked reads, taking the replicas
+### in turn and skipping any whose lag is unknown or above maxLag; when none qualifies the read goes to the primary.
+### read() runs a read again on the primary when the replica session raises.
+### Lags are measured off the request path by one probe thread per replica, every lagInterval seconds; a replica
+### whose measurement is more than lagTimeout seconds overdue (the probe hangs on it) counts as unknown.
+### Read-your-writes: inside readYourWrites(token) a thread that commits a write (pinWrites) pins token to the primary
+### for pin seconds - the longest a qualifying replica can take to apply the write (maxLag, plus lagInterval and
+### lagTimeout for the age of the measurement, plus a second for lags reported in whole seconds) - so reads under
+### token see its writes. Pins are kept in this process only.
+##    __init__
+##    borrow, borrowRead, readYourWrites, pinWrites
+##    read          ## Result of function(session) on a borrowRead session, read again on the primary if a replica fails
+##    pickReplica   ## Next replica whose lag qualifies, or None
+##    lagOf         ## Last measured lag of one replica, None if unknown or overdue
+##    probe         ## Probe thread of one replica: measure its lag every lagInterval seconds
+##    replicaFailed ## Skip a replica that failed until its lag is measured again
+##    getStats      ## Primary stats with reads per route and the last lag of every replica
+class ReplicatedStorage(AccountStorage):
+
+    def __init__(self, primary, replicas, maxLag=REPLICA_MAX_LAG, lagInterval=REPLICA_LAG_INTERVAL, readYourWrites=True,
+                 pin=None, pinsKept=REPLICA_PINS_KEPT, lagTimeout=REPLICA_LAG_TIMEOUT):
+        self.primary = primary
+        self.replicas = list(replicas)
+        self.size = primary.size
+        self.maxLag = maxLag
+        self.lagInterval = lagInterval
+        self.lagTimeout = lagTimeout
+        self.pinning = readYourWrites
+        self.pin = maxLag + lagInterval + lagTimeout + 1.0 if pin is None else pin
+        self.pinsKept = pinsKept
+        self.lock = threading.Lock()
+        self.local = threading.local()          # token of the readYourWrites block the thread is in
+        self.pins = collections.OrderedDict()   # token -> time.monotonic() until which its reads go to the primary
+        self.lags = [(None, float("-inf"))] * len(self.replicas)   # (lag, time.monotonic() measured) per replica
+        self.turn = itertools.count()
+        self.stats = {"replica_reads": 0, "primary_reads": 0, "pinned_reads": 0, "lag_fallbacks": 0, "replica_errors": 0,
+                      "replica_retries": 0}
+        self.stopped = threading.Event()        # set by disconnectDB; stops the probe threads
+        self.probes = [threading.Thread(target=self.probe, args=(index,), name=f"ReplicaLag{index}", daemon=True)
+                       for index in range(len(self.replicas))]
+        for probe in self.probes: probe.start()
+
+    @contextlib.contextmanager
+    def borrow(self):
+        with self.primary.borrow() as session: yield session
+
+    @contextlib.contextmanager
+    def borrowRead(self):
+        # borrowRead
+        ## Pinned token: primary. Otherwise the next qualifying replica; primary if there is none
+        ## A replica that cannot lend a session, or whose session raises (other than ValueError - a row it does not
+        ## have yet), is not asked again until its lag is measured again
+        token = getattr(self.local, "token", None)
+        with self.lock:
+            pinned = token is not None and self.pins.get(token, 0) > time.monotonic()
+            if pinned: self.stats["pinned_reads"] += 1
+        index = None if pinned else self.pickReplica()
+        with contextlib.ExitStack() as stack:
+            session = None
+            if index is not None:
+                try:
+                    session = stack.enter_context(self.replicas[index].borrow())
+                    session.replica = True
+                    with self.lock: self.stats["replica_reads"] += 1
+                except Exception as e:
+                    self.replicaFailed(index, e)
+            if session is None: session = stack.enter_context(self.primary.borrow())
+            try:
+                yield session
+            except Exception as e:
+                if session.replica and not isinstance(e, ValueError): self.replicaFailed(index, e)
+                raise
+
+    def read(self, function):
+        # read
+        ## function(session) on a borrowRead session; if it raises on a replica session, run it again on the primary
+        ## (a replica may fail half way through a read, or not have a row the primary has)
+        replica = False
+        try:
+            with self.borrowRead() as session:
+                replica = session.replica
+                return function(session)
+        except Exception as e:
+            if not replica: raise
+            logging.debug(f"Replica read failed, reading from the primary: {e!r}")
+        with self.lock: self.stats["replica_retries"] += 1
+        with self.primary.borrow() as session: return function(session)
+
+    def replicaFailed(self, index, e):
+        logging.warning(f"Replica {index} failed, reading from the primary: {e!r}")
+        with self.lock:
+            self.lags[index] = (None, time.monotonic())
+            self.stats["replica_errors"] += 1
+
+    @contextlib.contextmanager
+    def readYourWrites(self, token):
+        previous = getattr(self.local, "token", None)
+        self.local.token = token if self.pinning else None
+        try:
+            yield
+        finally:
+            self.local.token = previous
+
+    def pinWrites(self):
+        token = getattr(self.local, "token", None)
+        if token is None: return
+        with self.lock:
+            self.pins[token] = time.monotonic() + self.pin
+            self.pins.move_to_end(token)
+            while len(self.pins) > self.pinsKept: self.pins.popitem(last=False)
+
+    def pickReplica(self):
+        # pickReplica
+        ## Start at the next replica in turn; return the index of the first whose lag is known and at most maxLag
+        ## Count the read as a primary read (and a lag fallback if there are replicas) when none qualifies
+        ## (borrowRead counts a replica read once the replica has lent its session)
+        start = next(self.turn)
+        for step in range(len(self.replicas)):
+            index = (start + step) % len(self.replicas)
+            lag = self.lagOf(index)
+            if lag is not None and lag <= self.maxLag: return index
+        with self.lock:
+            self.stats["primary_reads"] += 1
+            if self.replicas: self.stats["lag_fallbacks"] += 1
+        return None
+
+    def lagOf(self, index):
+        # lagOf
+        ## The last lag the probe thread measured - reads never wait for a measurement
+        ## None (skip the replica) if it could not be measured or is more than lagTimeout seconds overdue
+        with self.lock: lag, measured = self.lags[index]
+        return lag if time.monotonic() - measured <= self.lagInterval + self.lagTimeout else None
+
+    def probe(self, index):
+        # probe - thread
+        ## Measure the lag of one replica now and every lagInterval seconds until disconnectDB
+        ## A replica that cannot be measured has no lag (None) until the next measurement
+        while not self.stopped.is_set():
+            try:
+                lag = self.replicas[index].replicationLag()
+            except Exception as e:
+                logging.warning(f"Lag of replica {index} could not be measured: {e}")
+                lag = None
+            with self.lock: self.lags[index] = (lag, time.monotonic())
+            if lag is None or lag > self.maxLag: logging.debug(f"Replica {index} lags {lag} seconds")
+            self.stopped.wait(self.lagInterval)
+
+    def isConnected(self):
+        return self.primary.isConnected()
+
+    def getStats(self):
+        stats = dict(self.primary.getStats())
+        with self.lock:
+            stats.update(self.stats)
+            stats["replica_lags"] = [lag for lag, measured in self.lags]
+            stats["pinned_tokens"] = len(self.pins)
+        return stats
+
+    def checkPlans(self):
+        return self.primary.checkPlans()
+
+    def disconnectDB(self, save=1):
+        self.stopped.set()
+        for replica in self.replicas: replica.disconnectDB(0)
+        self.primary.disconnectDB(save)
+
+
+# planWarnings
+## EXPLAIN every statement in PLANNED_STATEMENTS on session and return a warning for each one that does not
+## use the primary key (or could not be explained); each warning is logged as well
+def planWarnings(session):
+    warnings = []
+    for name in PLANNED_STATEMENTS:
+        try:
+            columns, rows = session.explain(name)
+            if session.usesPrimaryKey(columns, rows): continue
+            warning = f"Statement {name} does not use the primary key: {rows}"
+        except Exception as e:
+            warning = f"Statement {name} could not be explained: {e}"
+        logging.warning(warning)
+        warnings.append(warning)
+    return warnings
@@ -0,0 +1,48 @@
+import os
+import sys
+import threading
+
+import pytest
+
+# The modules live at the top of the repository
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path: sys.path.insert(0, ROOT)
+
+import Bank
+import BankServer
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "workers(n): request slots of the server fixture")
+
+
+# Tests run on the defaults: no developer config.ini, no bank.log
+Bank.CRED_FILE = os.path.join(ROOT, "tests", "no-config.ini")
+Bank.LOG_FILE = os.devnull
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def storage(request, tmp_path):
+    # openStorage on each backend; sqlite uses a database file so pooled sessions share it
+    dbObj = Bank.openStorage(request.param, str(tmp_path / "bank.db"))
+    yield dbObj
+    dbObj.disconnectDB(True)
+
+
+@pytest.fixture
+def bank(storage):
+    return Bank.Bank(storage)
+
+
+@pytest.fixture
+def server(request):
+    # BankServer on the memory backend, listening on a free port; yields (server, port)
+    # @pytest.mark.workers(n) runs it with n request slots
+    marker = request.node.get_closest_marker("workers")
+    dbObj = Bank.openStorage("memory")
+    server = BankServer.BankServer(("127.0.0.1", 0), Bank.Bank(dbObj), marker.args[0] if marker else None, dbObj, admission={})
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server, server.server_address[1]
+    server.shutdown()
+    server.server_close()
+    thread.join()
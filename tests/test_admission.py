@@ -0,0 +1,18 @@
+import pytest
+
+import Admission
+import Bank
+import Metrics
+
+
+def test_shed_operations_are_counted_as_counters():
+    Metrics.METRICS.reset()
+    bank = Admission.AdmissionControl(Bank.Bank(Bank.openStorage("memory")), rate=1, burst=1)
+    acc_no = bank.createAccount("Ada", 0, client="c1")
+    with pytest.raises(Admission.Rejected):
+        bank.deposit(acc_no, 1, client="c1")
+    text = bank.exportMetrics()
+    assert "# TYPE bank_admission_shed_total counter" in text
+    assert 'bank_admission_shed_total{reason="rate_limited"} 1' in text
+    assert "# TYPE bank_admission_in_flight gauge" in text
+    assert "bank_admission_shed_rate_limited" not in text
@@ -0,0 +1,39 @@
+import pytest
+
+import Audit
+import MemoryStorage
+
+
+def runAudit(storage, tmp_path):
+    audit = Audit.Audit("memory", None, 1, 4, str(tmp_path / "checkpoint.json"), str(tmp_path / "report.jsonl"), storage=storage)
+    return audit.run()
+
+
+def test_consistent_bank_has_no_findings(bank, storage, tmp_path):
+    src, trgt = bank.createAccount("Ada", 100), bank.createAccount("Bob", 0)
+    bank.transfer(src, trgt, 30)
+    bank.deposit(trgt, 5)
+    totals = runAudit(storage, tmp_path)
+    assert totals["accounts"] == 2
+    assert sum(totals["findings"].values()) == 0
+
+
+def test_changed_balance_is_a_mismatch(bank, storage, tmp_path):
+    acc_nos = [bank.createAccount(f"user{i}", 100) for i in range(6)]
+    with storage.borrow() as session:
+        session.startTransaction()
+        session.updateBalancesByAccNbrs({acc_nos[4]: 1})
+        session.save()
+    totals = runAudit(storage, tmp_path)
+    assert totals["findings"] == {Audit.FINDING_MISMATCH: 1, Audit.FINDING_NEGATIVE: 0, Audit.FINDING_ORPHAN: 0}
+
+
+def test_ledger_of_uncommitted_account_is_an_orphan(bank, storage, tmp_path):
+    if not isinstance(storage, MemoryStorage.MemoryStorage): pytest.skip("reserves numbers on the memory engine")
+    bank.createAccount("Ada", 100)
+    # A number reserved by a transaction that never committed, with ledger entries on it
+    acc_no = storage.reserve("ghost", 50, "EUR")
+    storage.appendLedger([("ghost-open", acc_no, "open", 50, 0, 50)])
+    totals = runAudit(storage, tmp_path)
+    assert totals["accounts"] == 1
+    assert totals["findings"][Audit.FINDING_ORPHAN] == 1
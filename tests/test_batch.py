@@ -0,0 +1,34 @@
+import IdempotencyCache
+import pytest
+
+
+def test_batch_applies_every_operation_in_order(bank):
+    a, b = bank.createAccount("Ada", 100), bank.createAccount("Bob", 0)
+    results = bank.applyBatch([("deposit", a, 10), ("withdraw", a, 200), ("transfer", a, b, 60), ("withdraw", b, 20),
+                               ("deposit", 999, 5), ("refund", a, 1), ("transfer", a, a, 1)], chunkSize=3)
+    assert [ok for ok, value in results] == [True, False, True, True, False, False, False]
+    assert results[0][1] == 110 and results[2][1] == (50, 60) and results[3][1] == 40
+    assert (bank.checkBalance(a), bank.checkBalance(b)) == (50, 40)
+    assert [row[3] for row in bank.history(b)] == ["open", "transfer_in", "withdraw"]
+
+
+def test_batch_with_key_replays_committed_chunks(bank):
+    a = bank.createAccount("Ada", 0)
+    ops = [("deposit", a, amount) for amount in (1, 2, 3, 4, 5)]
+    first = bank.applyBatch(ops, chunkSize=2, key="batch-1")
+    assert bank.applyBatch(ops, chunkSize=2, key="batch-1") == first
+    assert bank.checkBalance(a) == 15
+    with pytest.raises(IdempotencyCache.KeyReused):
+        bank.applyBatch([("deposit", a, 9)], chunkSize=2, key="batch-1")
+
+
+def test_concurrent_batches_keep_money_constant(bank):
+    import threading
+    accounts = [bank.createAccount(f"user{i}", 1000) for i in range(6)]
+    def run(seed):
+        ops = [("transfer", accounts[(seed + i) % 6], accounts[(seed + 3 * i + 1) % 6], 7) for i in range(40)]
+        bank.applyBatch([op for op in ops if op[1] != op[2]], chunkSize=8)
+    threads = [threading.Thread(target=run, args=(seed,)) for seed in range(4)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    assert sum(bank.checkBalance(acc_no) for acc_no in accounts) == 6000
@@ -0,0 +1,9 @@
+import Benchmark
+
+
+def test_private_backend_runs_on_the_seeded_accounts():
+    options = {"backend": "memory", "path": ":memory:", "workload": "transfer-heavy", "accounts": 20, "first": 500,
+               "skew": 1.1, "threads": 2, "ops": 50, "seconds": 0, "seed": 0}
+    samples, retries, stats, elapsed = Benchmark.runProcess(options, 0)
+    assert sum(len(latencies) for latencies, aborts in samples.values()) == 100
+    assert sum(aborts for latencies, aborts in samples.values()) == 0
@@ -0,0 +1,24 @@
+import csv
+
+import BulkIO
+
+
+def test_explicit_numbers_are_free_again_after_rollback(bank):
+    # The second row violates balance >= 0, so the whole chunk rolls back
+    assert bank.createAccounts([(5, "Ada", 10), (6, "Bob", -1)]) is False
+    assert bank.createAccounts([(5, "Ada", 10), (6, "Bob", 1)]) == [5, 6]
+    assert bank.checkBalance(5) == 10
+
+
+def test_import_export_round_trip(bank, storage, tmp_path):
+    source = tmp_path / "accounts.csv"
+    with open(source, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(("account_no", "name", "balance"))
+        writer.writerows((acc_no, f"user{acc_no}", acc_no * 10) for acc_no in (1, 2, 4, 7, 9))
+    assert BulkIO.importAccounts(bank, str(source), chunkSize=2)[0] == 5
+    target = tmp_path / "export.csv"
+    assert BulkIO.exportAccounts(storage, str(target), fetchSize=2)[0] == 5
+    with open(target, newline="") as f:
+        rows = [(int(row["account_no"]), row["name"], int(row["balance"])) for row in csv.DictReader(f)]
+    assert rows == [(acc_no, f"user{acc_no}", acc_no * 10) for acc_no in (1, 2, 4, 7, 9)]
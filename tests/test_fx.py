@@ -0,0 +1,73 @@
+import datetime
+import decimal
+
+import pytest
+
+import Bank
+import FxRates
+import Scheduler
+
+
+def test_minor_units():
+    assert FxRates.toMinor("12.34", "USD") == 1234
+    assert FxRates.toMinor("500", "JPY") == 500
+    assert FxRates.fromMinor(1234, "USD") == decimal.Decimal("12.34")
+    with pytest.raises(ValueError):
+        FxRates.toMinor("1.5", "JPY")
+    with pytest.raises(ValueError):
+        FxRates.checkCurrency("US")
+
+
+def test_factors_cover_the_inverse_pair():
+    table = FxRates.buildTable([("USD", "EUR", "0.9"), ("USD", "JPY", "150"), ("EUR", "EUR", "1"), ("EUR", "GBP", "-1")], 1)
+    assert set(table.rates) == {("USD", "EUR"), ("USD", "JPY")}
+    # 1 cent is 1.5 yen, rounded half to even
+    assert FxRates.convertMinor(1, table.factors[("USD", "JPY")]) == 2
+    assert FxRates.convertMinor(3, table.factors[("USD", "JPY")]) == 4
+    assert FxRates.convertMinor(150, table.factors[("JPY", "USD")]) == 100
+    assert FxRates.convertMinor(900, table.factors[("EUR", "USD")]) == 1000
+
+
+def test_transfer_converts_to_the_target_currency(bank):
+    usd, eur = bank.createAccount("Ada", 10000, currency="USD"), bank.createAccount("Bob", 0, currency="eur")
+    assert bank.transfer(usd, eur, 1000) == (False, 2)     # no rate yet
+    version = bank.fx.table().version
+    assert bank.setFxRates([("USD", "EUR", "0.9")]) == version + 1
+    assert bank.transfer(usd, eur, 1000)[2:] == (9000, 900)
+    assert bank.transfer(eur, usd, 450)[2:] == (450, 9500)
+    assert bank.getAccount(eur)[3] == "EUR"
+
+
+def test_batch_converts_cross_currency_transfers(bank):
+    usd, jpy = bank.createAccount("Ada", 10000, currency="USD"), bank.createAccount("Bob", 0, currency="JPY")
+    bank.setFxRates([("USD", "JPY", "150")])
+    results = bank.applyBatch([("transfer", usd, jpy, 100), ("transfer", usd, jpy, 1)])
+    assert [ok for ok, value in results] == [True, True]
+    assert bank.checkBalance(jpy) == 152
+    assert bank.checkBalance(usd) == 9899
+
+
+def test_rates_reload_after_ttl(bank, storage):
+    other = Bank.Bank(storage)
+    other.fx.ttl = 0.0
+    bank.setFxRates([("USD", "EUR", "0.9")])
+    assert other.fx.convert(100, "USD", "EUR") == 90
+    bank.setFxRates([("USD", "EUR", "0.5")])
+    assert other.fx.convert(100, "USD", "EUR") == 50
+
+
+def test_non_integer_amounts_are_rejected_before_any_write(bank):
+    a, b = bank.createAccount("Ada", 100), bank.createAccount("Bob", 0)
+    assert bank.deposit(a, 10.5) is False
+    assert bank.withdraw(a, 0.5) is False
+    assert bank.deposit(a, True) is False
+    assert bank.transfer(a, b, 10.5) == (False, 0)
+    assert bank.createAccount("Cy", 1.5) is False
+    assert bank.createAccounts([("Cy", 1.5)]) is False
+    results = bank.applyBatch([("deposit", a, 0.7), ("transfer", a, b, 2.5), ("deposit", a, 1)])
+    assert [ok for ok, _ in results] == [False, False, True]
+    assert results[2][1] == bank.checkBalance(a) == 101
+    assert bank.checkBalance(b) == 0
+    assert [row[3] for row in bank.history(a)] == ["open", "deposit"]
+    with pytest.raises(ValueError):
+        Scheduler.Scheduler(bank, threads=1).schedule(a, b, 1.5, datetime.datetime(2999, 1, 1))
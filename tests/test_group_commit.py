@@ -0,0 +1,24 @@
+import threading
+
+import Bank
+import GroupCommit
+
+
+def test_group_commit_applies_concurrent_deposits(storage):
+    bank = Bank.Bank(storage, group=GroupCommit.GroupCommit(window=0.001, maxOps=64))
+    acc_no = bank.createAccount("Ada", 0)
+    threads = [threading.Thread(target=lambda: [bank.deposit(acc_no, 1) for _ in range(10)]) for _ in range(8)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    bank.group.close()
+    assert bank.checkBalance(acc_no) == 80
+    assert bank.group.getStats()["operations"] == 80
+
+
+def test_deposit_after_close_commits_on_its_own(storage):
+    bank = Bank.Bank(storage, group=GroupCommit.GroupCommit())
+    acc_no = bank.createAccount("Ada", 0)
+    bank.group.close()
+    assert bank.group.submit(("deposit", acc_no, 1)) is None
+    assert bank.deposit(acc_no, 5) == 5
+    assert bank.withdraw(acc_no, 2) == 3
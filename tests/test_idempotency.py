@@ -0,0 +1,40 @@
+import pytest
+
+import IdempotencyCache
+
+
+def test_retry_with_same_key_replays(bank):
+    acc_no = bank.createAccount("Ada", 100, key="open-ada")
+    assert bank.createAccount("Ada", 100, key="open-ada") == acc_no
+    assert bank.deposit(acc_no, 7, key="k1") == 107
+    assert bank.deposit(acc_no, 7, key="k1") == 107
+    assert bank.checkBalance(acc_no) == 107
+
+
+def test_key_reused_for_other_operation_is_rejected(bank):
+    acc_no = bank.createAccount("Ada", 100)
+    assert bank.deposit(acc_no, 7, key="k1") == 107
+    with pytest.raises(IdempotencyCache.KeyReused):
+        bank.withdraw(acc_no, 3, key="k1")
+    with pytest.raises(IdempotencyCache.KeyReused):
+        bank.deposit(acc_no, 8, key="k1")
+    assert bank.checkBalance(acc_no) == 107
+
+
+def test_key_reused_is_rejected_after_cache_is_cleared(bank):
+    src, trgt = bank.createAccount("Ada", 100), bank.createAccount("Bob", 0)
+    assert bank.transfer(src, trgt, 10, key="t1")[2:] == (90, 10)
+    bank.keys.clear()
+    assert bank.transfer(src, trgt, 10, key="t1")[2:] == (90, 10)
+    bank.keys.clear()
+    with pytest.raises(IdempotencyCache.KeyReused):
+        bank.transfer(src, trgt, 20, key="t1")
+
+
+def test_batch_key_reused_for_other_ops_is_rejected(bank):
+    acc_no = bank.createAccount("Ada", 0)
+    assert bank.applyBatch([("deposit", acc_no, 5)], key="b1") == [(True, 5)]
+    assert bank.applyBatch([("deposit", acc_no, 5)], key="b1") == [(True, 5)]
+    with pytest.raises(IdempotencyCache.KeyReused):
+        bank.applyBatch([("deposit", acc_no, 6)], key="b1")
+    assert bank.checkBalance(acc_no) == 5
@@ -0,0 +1,29 @@
+import subprocess
+import sys
+
+import LazyImport
+from conftest import ROOT
+
+# Interpreter that cannot import mysql or tabulate (None in sys.modules), whatever is installed here
+WITHOUT_DRIVERS = "import sys; sys.modules['mysql'] = None; sys.modules['tabulate'] = None; sys.path.insert(0, sys.argv[1]); "
+
+
+def test_missing_package_is_a_missing_module():
+    module = LazyImport.lazyImport("no_such_package.connector")
+    assert isinstance(module, LazyImport.MissingModule)
+    try:
+        module.connect
+    except ModuleNotFoundError as e:
+        assert e.name == "no_such_package.connector"
+    else:
+        raise AssertionError("attribute of a missing module did not raise")
+
+
+def test_bank_runs_on_memory_backend_without_mysql_driver(tmp_path):
+    code = WITHOUT_DRIVERS + ("import Bank\n"
+                              "bank = Bank.Bank(Bank.openStorage('memory'))\n"
+                              "acc_no = bank.createAccount('Ada', 100)\n"
+                              "print(bank.deposit(acc_no, 5), bank.checkBalance(acc_no))\n")
+    done = subprocess.run([sys.executable, "-c", code, ROOT], cwd=tmp_path, capture_output=True, text=True, timeout=60)
+    assert done.returncode == 0, done.stderr
+    assert done.stdout.split() == ["105", "105"]
@@ -0,0 +1,75 @@
+import time
+
+import Bank
+
+
+def now(storage, offset=0.0):
+    with storage.borrow() as session: return session.now(offset)
+
+
+def staleCredits(storage, acc_no, amount):
+    # Two credits to different stripes that each saw the other's stripe before it committed,
+    # so both log the same balance_after - what concurrent credits to a striped account write
+    with storage.borrow() as session: before = session.selectStripedBalance(acc_no)
+    for stripe in (1, 2):
+        with storage.borrow() as session:
+            session.startTransaction()
+            session.creditStripe(acc_no, stripe, amount)
+            session.addLedgerEntries([Bank.ledgerEntry(Bank.newKey(), acc_no, "deposit", before, before + amount)])
+            session.save()
+
+
+def test_history_pages_in_order(bank):
+    acc_no = bank.createAccount("Ada", 100)
+    for amount in range(1, 8): bank.deposit(acc_no, amount)
+    rows = list(bank.history(acc_no, pageSize=3))
+    assert [row[3] for row in rows] == ["open"] + ["deposit"] * 7
+    assert [row[6] for row in rows] == [100, 101, 103, 106, 110, 115, 121, 128]
+
+
+def test_balance_as_of_and_statement(bank, storage):
+    acc_no = bank.createAccount("Ada", 100)
+    bank.deposit(acc_no, 50)
+    time.sleep(0.01)
+    middle = now(storage)
+    time.sleep(0.01)
+    bank.withdraw(acc_no, 30)
+    end = now(storage)
+    assert bank.balanceAsOf(acc_no, middle) == 150
+    assert bank.balanceAsOf(acc_no, end) == 120
+    statement = bank.statement(acc_no, middle, end)
+    assert (statement["opening"], statement["closing"], statement["credits"], statement["debits"]) == (150, 120, 0, 30)
+    assert bank.balanceAsOf(acc_no + 1, end) is False
+
+
+def test_snapshot_then_balance_as_of(bank, storage):
+    acc_no = bank.createAccount("Ada", 100)
+    bank.deposit(acc_no, 10)
+    time.sleep(0.01)
+    assert bank.takeSnapshot(lag=0) == 1
+    assert bank.takeSnapshot(lag=0) == 0
+    time.sleep(0.01)
+    bank.deposit(acc_no, 5)
+    assert bank.balanceAsOf(acc_no, now(storage)) == 115
+    time.sleep(0.01)
+    assert bank.takeSnapshot(lag=0) == 1
+    assert bank.balanceAsOf(acc_no, now(storage)) == 115
+
+
+def test_striped_balances_add_up_ledger_amounts(bank, storage):
+    acc_no = bank.createAccount("Ada", 100)
+    assert bank.stripeAccount(acc_no, 2) == 2
+    start = now(storage)
+    time.sleep(0.01)
+    staleCredits(storage, acc_no, 5)
+    assert bank.checkBalance(acc_no) == 110
+    assert bank.balanceAsOf(acc_no, now(storage)) == 110
+    statement = bank.statement(acc_no, start, now(storage))
+    assert statement["closing"] == 110
+    assert [entry[6] for entry in statement["entries"]] == [105, 110]
+    time.sleep(0.01)
+    assert bank.takeSnapshot(lag=0) == 1
+    staleCredits(storage, acc_no, 1)
+    time.sleep(0.01)
+    assert bank.takeSnapshot(lag=0) == 1
+    assert bank.balanceAsOf(acc_no, now(storage)) == 112
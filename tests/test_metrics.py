@@ -0,0 +1,22 @@
+import Metrics
+
+
+def test_failing_hook_does_not_fail_the_operation():
+    registry = Metrics.Metrics()
+    calls = []
+
+    def broken(name, seconds, ok): raise RuntimeError("tracer down")
+    registry.addHook(broken)
+    registry.addHook(lambda name, seconds, ok: calls.append((name, ok)))
+
+    @registry.operation("deposit")
+    def deposit(): return 107
+
+    assert deposit() == 107
+    assert calls == [("deposit", True)]
+
+
+def test_label_values_are_escaped():
+    registry = Metrics.Metrics()
+    registry.inc("bank_errors_total", (("reason", 'bad "quote" \\ and\nnewline'),))
+    assert 'bank_errors_total{reason="bad \\"quote\\" \\\\ and\\nnewline"} 1' in registry.prometheus().splitlines()
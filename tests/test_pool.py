@@ -0,0 +1,127 @@
+import threading
+import time
+import types
+
+import pytest
+
+import MySQLConnector
+
+
+class FakeError(Exception):
+    pass
+
+
+class FakeCursor():
+    def close(self):
+        pass
+
+
+class FakeConnection():
+    def __init__(self):
+        self.in_transaction = False
+        self.rollbacks = 0
+        self.dead = self.closed = False
+    
+    def cursor(self, buffered=True, prepared=False):
+        return FakeCursor()
+    
+    def commit(self):
+        self.in_transaction = False
+    
+    def rollback(self):
+        if self.dead: raise FakeError("link is gone")
+        self.rollbacks += 1
+        self.in_transaction = False
+    
+    def ping(self, reconnect=False):
+        if self.dead: raise FakeError("link is gone")
+    
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def connections(monkeypatch):
+    opened = []
+    def connect(**options):
+        opened.append(FakeConnection())
+        return opened[-1]
+    fake = types.SimpleNamespace(connect=connect, Error=FakeError,
+                                 errors=types.SimpleNamespace(PoolError=type("PoolError", (FakeError,), {})))
+    monkeypatch.setattr(MySQLConnector, "connector", fake)
+    return opened
+
+
+def newPool(**options):
+    return MySQLConnector.mysqlPool("localhost", "user", "secret", "bank", **options)
+
+
+def test_pool_is_bounded_and_counts_timeouts(connections):
+    pool = newPool(size=2, timeout=0.05)
+    first, second = pool.checkout(), pool.checkout()
+    with pytest.raises(FakeError, match="No connection available"):
+        pool.checkout()
+    stats = pool.getStats()
+    assert (len(connections), stats["opened"], stats["in_use"], stats["timeouts"]) == (2, 2, 2, 1)
+    assert stats["occupancy"] == 1.0
+    pool.checkin(first)
+    assert pool.checkout() is first
+    assert len(connections) == 2
+
+
+def test_waiter_gets_the_returned_connection(connections):
+    pool = newPool(size=1, timeout=5)
+    conn = pool.checkout()
+    got = []
+    waiter = threading.Thread(target=lambda: got.append(pool.checkout()))
+    waiter.start()
+    time.sleep(0.05)
+    pool.checkin(conn)
+    waiter.join()
+    assert got == [conn]
+    assert pool.getStats()["waits"] == 1
+
+
+def test_checkin_rolls_back_an_open_transaction(connections):
+    pool = newPool(size=1)
+    with pool.borrow() as conn:
+        conn.getConnection().in_transaction = True
+    assert connections[0].rollbacks == 1
+    assert not connections[0].in_transaction
+
+
+def test_broken_connections_are_replaced(connections):
+    pool = newPool(size=1, pingIdle=0)
+    with pool.borrow() as conn:
+        conn.getConnection().in_transaction = True
+        conn.getConnection().dead = True
+    assert connections[0].closed
+    assert pool.getStats()["opened"] == 0
+    with pool.borrow():
+        connections[1].dead = True
+    with pool.borrow() as conn:
+        assert conn.getConnection() is connections[2]
+    assert pool.getStats()["failed_health_checks"] == 1
+
+
+def test_idle_connections_are_evicted(connections):
+    pool = newPool(size=2, maxIdle=0.01)
+    first, second = pool.checkout(), pool.checkout()
+    pool.checkin(first)
+    pool.checkin(second)
+    time.sleep(0.02)
+    assert pool.evictIdle() == 2
+    assert connections[0].closed and connections[1].closed
+    assert pool.getStats()["evicted"] == 2
+
+
+def test_disconnect_refuses_checkouts(connections):
+    pool = newPool(size=2)
+    assert pool.isConnected()
+    borrowed = pool.checkout()
+    pool.disconnectDB()
+    with pytest.raises(FakeError, match="closed"):
+        pool.checkout()
+    pool.checkin(borrowed)
+    assert connections[0].closed
+    assert pool.getStats()["opened"] == 0
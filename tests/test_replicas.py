@@ -0,0 +1,96 @@
+import contextlib
+import time
+
+import pytest
+
+import Bank
+import SQLiteConnector
+import Storage
+
+
+class BrokenSession(Storage.AccountSession):
+    def selectRowByAccNbr(self, acc_no, lock=False): raise RuntimeError("Lost connection to MySQL server during query")
+
+
+# Replica whose sessions fail half way through a read; its lag takes lagSeconds to measure
+class BrokenReplica(Storage.AccountStorage):
+
+    def __init__(self, lagSeconds=0.0):
+        self.lagSeconds = lagSeconds
+
+    @contextlib.contextmanager
+    def borrow(self):
+        yield BrokenSession()
+
+    def replicationLag(self):
+        time.sleep(self.lagSeconds)
+        return 0.0
+
+
+# Replica whose lag can be measured but which cannot lend a session
+class UnreachableReplica(BrokenReplica):
+
+    @contextlib.contextmanager
+    def borrow(self):
+        raise RuntimeError("Too many connections")
+        yield
+
+
+@pytest.fixture
+def primary(tmp_path):
+    storage = Bank.openStorage("sqlite", str(tmp_path / "bank.db"))
+    yield storage
+    storage.disconnectDB(True)
+
+
+def waitFor(condition, seconds=2.0):
+    deadline = time.monotonic() + seconds
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_failed_replica_read_is_read_again_on_the_primary(primary):
+    storage = Storage.ReplicatedStorage(primary, [BrokenReplica()], lagInterval=0.05)
+    waitFor(lambda: storage.lagOf(0) == 0.0)
+    bank = Bank.Bank(storage)
+    acc_no = bank.createAccount("Ada", 100)
+    assert bank.checkBalance(acc_no) == 100
+    assert bank.getAccount(acc_no)[:2] == ("Ada", 100)
+    stats = storage.getStats()
+    assert stats["replica_retries"] >= 1 and stats["replica_errors"] >= 1
+    storage.stopped.set()
+
+
+def test_reads_never_wait_for_a_lag_measurement(primary):
+    storage = Storage.ReplicatedStorage(primary, [BrokenReplica(lagSeconds=3.0)], lagInterval=0.05, lagTimeout=0.1)
+    bank = Bank.Bank(storage)
+    acc_no = bank.createAccount("Ada", 100)
+    start = time.monotonic()
+    assert bank.checkBalance(acc_no) == 100
+    assert time.monotonic() - start < 1.0
+    assert storage.getStats()["replica_reads"] == 0
+    storage.stopped.set()
+
+
+def test_reads_go_to_a_fresh_replica(primary, tmp_path):
+    bank = Bank.Bank(primary)
+    acc_no = bank.createAccount("Ada", 100)
+    storage = Storage.ReplicatedStorage(primary, [Storage.SQLiteStorage(SQLiteConnector.sqliteCopy(str(tmp_path / "bank.db"), 0.05))],
+                                        maxLag=1.0, lagInterval=0.05)
+    waitFor(lambda: storage.lagOf(0) is not None)
+    assert Bank.Bank(storage).checkBalance(acc_no) == 100
+    assert storage.getStats()["replica_reads"] == 1
+    storage.stopped.set()
+    storage.replicas[0].disconnectDB(0)
+
+
+def test_failed_replica_borrow_is_not_counted_as_a_replica_read(primary):
+    storage = Storage.ReplicatedStorage(primary, [UnreachableReplica()], lagInterval=0.05)
+    waitFor(lambda: storage.lagOf(0) == 0.0)
+    bank = Bank.Bank(storage)
+    acc_no = bank.createAccount("Ada", 100)
+    assert bank.checkBalance(acc_no) == 100
+    stats = storage.getStats()
+    assert (stats["replica_reads"], stats["replica_errors"]) == (0, 1)
+    storage.stopped.set()
@@ -0,0 +1,163 @@
+import http.client
+import json
+import time
+
+import pytest
+
+import BankServer
+
+
+def request(conn, method, path, body=None, headers=None):
+    conn.request(method, path, body=None if body is None else json.dumps(body), headers=headers or {})
+    response = conn.getresponse()
+    payload = response.read()
+    return response, json.loads(payload) if response.getheader("Content-Type") == "application/json" else payload
+
+
+def test_unknown_route_drains_body_on_keep_alive_connection(server):
+    conn = http.client.HTTPConnection("127.0.0.1", server[1], timeout=5)
+    response, payload = request(conn, "POST", "/nope", {"x": 1})
+    assert response.status == 404
+    response, payload = request(conn, "POST", "/accounts", {"name": "Ada", "balance": 10})
+    assert response.status == 201 and payload["account_no"] > 0
+
+
+def test_oversize_body_closes_connection(server, monkeypatch):
+    monkeypatch.setattr(BankServer, "MAX_BODY_SIZE", 8)
+    conn = http.client.HTTPConnection("127.0.0.1", server[1], timeout=5)
+    response, payload = request(conn, "POST", "/accounts", {"name": "Ada", "balance": 10})
+    assert response.status == 413
+    assert response.getheader("Connection") == "close"
+
+
+def test_bad_json_is_400_and_keeps_connection(server):
+    conn = http.client.HTTPConnection("127.0.0.1", server[1], timeout=5)
+    conn.request("POST", "/accounts", body="{not json")
+    response = conn.getresponse()
+    response.read()
+    assert response.status == 400
+    response, payload = request(conn, "POST", "/accounts", {"name": "Ada", "balance": 10})
+    assert response.status == 201
+
+
+def test_bad_arguments_are_400(server):
+    conn = http.client.HTTPConnection("127.0.0.1", server[1], timeout=5)
+    assert request(conn, "POST", "/accounts", {"name": "Ada", "balance": "lots"})[0].status == 400
+    assert request(conn, "POST", "/accounts", {"name": "Ada", "colour": "red"})[0].status == 400
+    assert request(conn, "POST", "/transfers", {"source": 1, "amount": 1})[0].status == 400
+    assert request(conn, "POST", "/batch", {"ops": "deposit"})[0].status == 400
+    assert request(conn, "GET", "/accounts/1/statement?start=yesterday&end=today")[0].status == 400
+
+
+def test_internal_type_error_is_500(server, monkeypatch):
+    def broken(*args, **kwargs): raise TypeError("bug")
+    monkeypatch.setattr(server[0].bank.bank, "getAccount", broken)
+    conn = http.client.HTTPConnection("127.0.0.1", server[1], timeout=5)
+    response, payload = request(conn, "GET", "/accounts/1")
+    assert response.status == 500 and payload == {"error": "Internal error"}
+
+
+@pytest.mark.workers(1)
+def test_idle_keep_alive_connection_does_not_hold_the_only_slot(server):
+    idle = http.client.HTTPConnection("127.0.0.1", server[1], timeout=5)
+    assert request(idle, "POST", "/accounts", {"name": "Ada", "balance": 10})[0].status == 201
+    started = time.monotonic()
+    other = http.client.HTTPConnection("127.0.0.1", server[1], timeout=5)
+    assert request(other, "GET", "/accounts/1")[0].status == 200
+    assert time.monotonic() - started < BankServer.KEEPALIVE_TIMEOUT / 2
+
+
+def test_query_string_is_only_read_by_routes_that_declare_it(server):
+    conn = http.client.HTTPConnection("127.0.0.1", server[1], timeout=5)
+    acc_no = request(conn, "POST", "/accounts?foo=1", {"name": "Ada", "balance": 10})[1]["account_no"]
+    assert request(conn, "GET", f"/accounts/{acc_no}?foo=1")[0].status == 200
+    response, payload = request(conn, "POST", f"/accounts/{acc_no}/deposit?amount=3", {"amount": 5})
+    assert response.status == 200 and payload["balance"] == 15
+    response, payload = request(conn, "GET", f"/accounts/{acc_no}/balance?as_of=2999-01-01T00:00:00&foo=1")
+    assert response.status == 200 and payload["balance"] == 15
+
+
+def test_declined_transfer_reports_switch_2(server):
+    conn = http.client.HTTPConnection("127.0.0.1", server[1], timeout=5)
+    src = request(conn, "POST", "/accounts", {"name": "Ada", "balance": 5})[1]["account_no"]
+    trgt = request(conn, "POST", "/accounts", {"name": "Bob", "balance": 0})[1]["account_no"]
+    response, payload = request(conn, "POST", "/transfers", {"source": src, "target": trgt, "amount": 6})
+    assert response.status == 400 and payload == {"error": "Transfer declined", "switch": 2}
+
+
+def test_idempotency_key_reused_for_other_request_is_422(server):
+    conn = http.client.HTTPConnection("127.0.0.1", server[1], timeout=5)
+    acc_no = request(conn, "POST", "/accounts", {"name": "Ada", "balance": 100})[1]["account_no"]
+    headers = {"Idempotency-Key": "k1"}
+    assert request(conn, "POST", f"/accounts/{acc_no}/deposit", {"amount": 7}, headers)[1]["balance"] == 107
+    assert request(conn, "POST", f"/accounts/{acc_no}/deposit", {"amount": 7}, headers)[1]["balance"] == 107
+    response, payload = request(conn, "POST", f"/accounts/{acc_no}/withdraw", {"amount": 3}, headers)
+    assert response.status == 422
+
+
+def test_account_routes(server):
+    conn = http.client.HTTPConnection("127.0.0.1", server[1], timeout=5)
+    response, payload = request(conn, "POST", "/accounts", {"name": "Ada", "balance": 100, "currency": "EUR"})
+    acc_no = payload["account_no"]
+    response, payload = request(conn, "GET", f"/accounts/{acc_no}")
+    assert response.status == 200
+    assert (payload["name"], payload["balance"], payload["currency"]) == ("Ada", 100, "EUR")
+    assert request(conn, "POST", f"/accounts/{acc_no}/deposit", {"amount": 25})[1]["balance"] == 125
+    assert request(conn, "POST", f"/accounts/{acc_no}/withdraw", {"amount": 5})[1]["balance"] == 120
+    assert request(conn, "POST", f"/accounts/{acc_no}/withdraw", {"amount": 500})[0].status == 400
+    assert request(conn, "GET", f"/accounts/{acc_no}/balance")[1] == {"account_no": acc_no, "balance": 120}
+    assert request(conn, "GET", "/accounts/999")[0].status == 404
+
+
+def test_transfer_and_batch_routes(server):
+    conn = http.client.HTTPConnection("127.0.0.1", server[1], timeout=5)
+    src = request(conn, "POST", "/accounts", {"name": "Ada", "balance": 100})[1]["account_no"]
+    trgt = request(conn, "POST", "/accounts", {"name": "Bob", "balance": 0})[1]["account_no"]
+    response, payload = request(conn, "POST", "/transfers", {"source": src, "target": trgt, "amount": 40, "mode": "conditional"})
+    assert response.status == 200
+    assert (payload["source"]["balance"], payload["target"]["balance"]) == (60, 40)
+    assert request(conn, "POST", "/transfers", {"source": src, "target": trgt, "amount": 1, "mode": "fast"})[0].status == 400
+    response, payload = request(conn, "POST", "/batch", {"ops": [["deposit", src, 5], ["withdraw", trgt, 100], ["transfer", trgt, src, 10]]})
+    assert response.status == 200
+    assert [result["ok"] for result in payload["results"]] == [True, False, True]
+    assert payload["results"][0]["result"] == 65 and payload["results"][2]["result"] == [30, 75]
+    assert request(conn, "POST", "/batch", {"ops": [], "chunk_size": 0})[0].status == 400
+
+
+def test_schedule_routes(server):
+    conn = http.client.HTTPConnection("127.0.0.1", server[1], timeout=5)
+    src = request(conn, "POST", "/accounts", {"name": "Ada", "balance": 100})[1]["account_no"]
+    trgt = request(conn, "POST", "/accounts", {"name": "Bob", "balance": 0})[1]["account_no"]
+    payment = {"source": src, "target": trgt, "amount": 10, "first_run": "2999-01-01T00:00:00", "period": "weekly", "count": 3}
+    response, payload = request(conn, "POST", "/schedules", payment)
+    assert response.status == 201
+    payment_id = payload["id"]
+    response, payload = request(conn, "GET", f"/schedules/{payment_id}")
+    assert response.status == 200
+    assert (payload["source_account"], payload["target_account"], payload["amount"], payload["period"]) == (src, trgt, 10, "weekly")
+    assert request(conn, "POST", "/schedules", dict(payment, period="hourly"))[0].status == 400
+    assert request(conn, "POST", f"/schedules/{payment_id}/cancel")[1] == {"id": payment_id, "status": "cancelled"}
+    assert request(conn, "POST", f"/schedules/{payment_id}/cancel")[0].status == 404
+    assert request(conn, "GET", "/schedules/999")[0].status == 404
+
+
+def test_stats_and_metrics_routes(server):
+    conn = http.client.HTTPConnection("127.0.0.1", server[1], timeout=5)
+    acc_no = request(conn, "POST", "/accounts", {"name": "Ada", "balance": 100})[1]["account_no"]
+    request(conn, "POST", f"/accounts/{acc_no}/deposit", {"amount": 1})
+    response, payload = request(conn, "GET", "/stats")
+    assert response.status == 200
+    assert {"workers", "scheduler", "pool", "idempotency", "fx"} <= payload.keys()
+    response, payload = request(conn, "GET", "/metrics")
+    assert response.status == 200 and response.getheader("Content-Type").startswith("text/plain")
+    assert b"# TYPE" in payload
+
+
+def test_non_integer_amounts_are_400(server):
+    conn = http.client.HTTPConnection("127.0.0.1", server[1], timeout=5)
+    acc_no = request(conn, "POST", "/accounts", {"name": "Ada", "balance": 100})[1]["account_no"]
+    assert request(conn, "POST", f"/accounts/{acc_no}/deposit", {"amount": 10.99})[0].status == 400
+    assert request(conn, "POST", f"/accounts/{acc_no}/deposit", {"amount": True})[0].status == 400
+    assert request(conn, "POST", f"/accounts/{acc_no}/deposit", {"amount": "10.5"})[0].status == 400
+    assert request(conn, "POST", "/accounts", {"name": "Bob", "balance": 1.5})[0].status == 400
+    assert request(conn, "POST", f"/accounts/{acc_no}/deposit", {"amount": "10"})[1]["balance"] == 110
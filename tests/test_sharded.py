@@ -0,0 +1,41 @@
+import time
+
+import pytest
+
+import Bank
+import ShardedBank
+
+
+@pytest.fixture
+def sharded(tmp_path):
+    path = str(tmp_path / "bank.db")
+    storage = Bank.openStorage("sqlite", path)
+    Bank.Bank(storage).createAccounts([(f"user{i}", 100) for i in range(8)])
+    storage.disconnectDB(True)
+    bank = ShardedBank.ShardedBank(2, "sqlite", path, timeout=10)
+    yield bank
+    bank.close()
+
+
+def accountOn(shard):
+    return next(acc_no for acc_no in range(1, 9) if ShardedBank.shardOf(acc_no, 2) == shard)
+
+
+def test_calls_are_routed_to_the_owner(sharded):
+    src, trgt = accountOn(0), accountOn(1)
+    assert sharded.deposit(src, 5) == 105
+    assert sharded.transfer(src, trgt, 30)[2:] == (75, 130)
+    assert sharded.checkBalance(trgt) == 130
+    assert len(sharded.getStats()["shards"]) == 2
+
+
+def test_exited_worker_fails_its_calls(sharded):
+    acc_no = accountOn(1)
+    sharded.workers[1].kill()
+    start = time.monotonic()
+    with pytest.raises(RuntimeError, match="Shard 1 exited"):
+        sharded.checkBalance(acc_no)
+    with pytest.raises(RuntimeError, match="Shard 1 exited"):
+        sharded.getStats()
+    assert time.monotonic() - start < 5
+    assert sharded.checkBalance(accountOn(0)) == 100
@@ -0,0 +1,40 @@
+import threading
+import time
+
+import Bank
+
+
+def test_credits_go_to_stripes_and_debits_sweep_them(bank, storage):
+    acc_no = bank.createAccount("Shop", 10)
+    assert bank.stripeAccount(acc_no, 4) == 4
+    for _ in range(20): bank.deposit(acc_no, 5)
+    with storage.borrow() as session:
+        assert session.getBalance(acc_no) == 10
+        assert session.sumStripes(acc_no) == 100
+    assert bank.checkBalance(acc_no) == 110
+    assert bank.withdraw(acc_no, 60) == 50
+    assert bank.withdraw(acc_no, 51) is False
+    assert bank.stripeAccount(acc_no, 0) == 0
+    with storage.borrow() as session: assert session.getBalance(acc_no) == 50
+
+
+def test_concurrent_credits_add_up(bank):
+    acc_no = bank.createAccount("Shop", 0)
+    bank.stripeAccount(acc_no, 8)
+    threads = [threading.Thread(target=lambda: [bank.deposit(acc_no, 1) for _ in range(50)]) for _ in range(4)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    assert bank.checkBalance(acc_no) == 200
+
+
+def test_other_bank_sees_stripes_after_ttl(bank, storage):
+    other = Bank.Bank(storage)
+    other.stripesTtl = 0.05
+    acc_no = bank.createAccount("Shop", 10)
+    assert other.stripeCount(acc_no) == 0
+    bank.stripeAccount(acc_no, 2)
+    bank.deposit(acc_no, 100)
+    time.sleep(0.1)
+    # Reading the row alone, other could not cover the withdrawal
+    assert other.stripeCount(acc_no) == 2
+    assert other.withdraw(acc_no, 50) == 60
@@ -0,0 +1,59 @@
+import threading
+
+import Bank
+import MemoryStorage
+
+
+def test_failed_transfer_switch(bank):
+    src, trgt = bank.createAccount("Ada", 10), bank.createAccount("Bob", 0)
+    assert bank.transfer(999, trgt, 1) == (False, 0)
+    assert bank.transfer(src, 999, 1) == (False, 1)
+    assert bank.transfer(src, trgt, 11) == (False, 2)
+    assert Bank.TRANSFER_ERRORS[2] == "Transfer declined"
+
+
+def test_transfer_modes_move_the_money(bank):
+    src, trgt = bank.createAccount("Ada", 100), bank.createAccount("Bob", 0)
+    assert bank.transfer(src, trgt, 30, mode=Bank.TRANSFER_LOCKED) == ("Ada", "Bob", 70, 30)
+    assert bank.transfer(src, trgt, 30, mode=Bank.TRANSFER_CONDITIONAL) == ("Ada", "Bob", 40, 60)
+    assert bank.transfer(src, trgt, 41, mode=Bank.TRANSFER_CONDITIONAL) == (False, 2)
+    assert [row[3] for row in bank.history(trgt)] == ["open", "transfer_in", "transfer_in"]
+
+
+def holdRow(storage, acc_no, seconds):
+    # Lock an account's row in another session and release it after seconds (None - hold it until the returned event is set)
+    locked, release = threading.Event(), threading.Event()
+    def hold():
+        with storage.borrow() as session:
+            session.startTransaction()
+            session.selectRowByAccNbr(acc_no, lock=True)
+            locked.set()
+            release.wait(seconds)
+            session.rollback()
+    thread = threading.Thread(target=hold)
+    thread.start()
+    locked.wait()
+    return release, thread
+
+
+def test_lock_wait_timeout_is_retried():
+    storage = MemoryStorage.MemoryStorage(lockTimeout=0.05)
+    bank = Bank.Bank(storage)
+    src, trgt = bank.createAccount("Ada", 100), bank.createAccount("Bob", 0)
+    release, thread = holdRow(storage, trgt, 0.08)
+    assert bank.transfer(src, trgt, 10)[2:] == (90, 10)
+    thread.join()
+    assert bank.retries["transfer"] >= 1
+    assert storage.getStats()["lock_timeouts"] >= 1
+
+
+def test_retries_give_up_while_the_lock_is_held():
+    storage = MemoryStorage.MemoryStorage(lockTimeout=0.02)
+    bank = Bank.Bank(storage)
+    src, trgt = bank.createAccount("Ada", 100), bank.createAccount("Bob", 0)
+    release, thread = holdRow(storage, src, None)
+    assert bank.transfer(src, trgt, 10) == (False, 2)
+    release.set()
+    thread.join()
+    assert bank.retries["transfer"] == Bank.DEADLOCK_RETRIES
+    assert bank.checkBalance(src) == 100